@@ -2,9 +2,13 @@
 SBE__ prefix for "Sierra Big Export"
 '''
 
-import datetime, json, logging, math, os, pprint, sys
+import argparse, concurrent.futures, datetime, json, logging, math, os, pprint, sys
 import requests
 from requests.auth import HTTPBasicAuth
+from lib.client import get_http_client
+from lib.delta import DeltaHelper
+from lib.json_export import JsonExporter
+from lib.scheduler import BackoffRequired
 from lib.sierra import MarcHelper
 from lib.tracker import TrackerHelper
 from lib.validator import FileChecker
@@ -29,30 +33,89 @@ marc_helper = MarcHelper()
 tracker_helper = TrackerHelper()
 
 LOOP_DURATION_IN_MINUTES = int( os.environ['SBE__LOOP_DURATION_IN_MINUTES'] )
+DOWNLOAD_WORKERS = int( os.environ.get('SBE__DOWNLOAD_WORKERS', '4') )  # for pipelined mode
 
 os.nice( 19 )
 
 
-def manage_download():
+def manage_download( daemon=False, delta=False, new_delta=False ):
     """ Controller function.
+        In daemon mode there's no time-limit, and rate-limiting is waited out in-process instead of exiting for cron to re-initiate.
         Called by `if __name__ == '__main__':` """
-    tracker = check_tracker_file()
+    tracker = check_tracker_file( delta, new_delta )
     processing_duration = datetime.datetime.now() + datetime.timedelta( minutes=LOOP_DURATION_IN_MINUTES )
-    while datetime.datetime.now() < processing_duration:
-        log.debug( '\n-------\nstarting next batch entry' )
-        next_batch = tracker_helper.get_next_batch( tracker )
-        if next_batch:
-            download_file( next_batch, tracker )
-        else:
-            log.debug( 'no next batch; quitting' ); break
+    try:
+        while daemon or datetime.datetime.now() < processing_duration:
+            log.debug( '\n-------\nstarting next batch entry' )
+            next_batch = tracker_helper.get_next_batch( tracker )
+            if next_batch:
+                try:
+                    download_file( next_batch, tracker )
+                except BackoffRequired as e:
+                    tracker_helper.release_batch( next_batch )  # with multi-worker leasing, lets another worker take it meanwhile
+                    if not daemon:
+                        log.warning( 'backoff required, ```%s```; quitting until cron re-initiates' % e ); break
+                    marc_helper.scheduler.wait( e )  # the batch is still un-grabbed, so it's retried next loop
+            else:
+                log.debug( 'no next batch; quitting' ); break
+    finally:
+        tracker_helper.range_history.save()
+        tracker_helper.export_tracker_json( tracker )
     # file_checker.validate_marc_files( tracker )  # now done via separate cron job
+    log.info( 'connection_stats, ```%s```' % get_http_client().connection_stats() )
+    log.debug( 'complete' )
+    return
+
+
+def manage_json_download( daemon=False ):
+    """ Controller function for json mode: each batch's bibs are paged from the json `bibs/` endpoint straight into compressed jsonl shards,
+          skipping the export-job and file-download. Uses its own tracker and directory (see SBE__JSON_*).
+        Called by `if __name__ == '__main__':` when run with `--json` """
+    json_exporter = JsonExporter()
+    tracker_helper.TRACKER_FILEPATH = json_exporter.JSON_TRACKER_FILEPATH
+    tracker_helper.store = None  # one row per 2000-bib batch is small; kept as plain json
+    if tracker_helper.worker_id:
+        log.warning( 'SBE__WORKER_ID is ignored in json mode; batches are not leased, so run a single worker' )
+    tracker_helper.FILE_DOWNLOAD_DIR = json_exporter.JSON_EXPORT_DIR
+    tracker = check_tracker_file()
+    json_exporter.recover_shards( tracker )
+    processing_duration = datetime.datetime.now() + datetime.timedelta( minutes=LOOP_DURATION_IN_MINUTES )
+    try:
+        while daemon or datetime.datetime.now() < processing_duration:
+            next_batch = tracker_helper.get_next_batch( tracker )
+            if next_batch is None:
+                log.debug( 'no next batch; quitting' ); break
+            try:
+                file_stats = json_exporter.export_batch( next_batch )
+            except BackoffRequired as e:
+                tracker_helper.release_batch( next_batch )  # a no-op, as json mode doesn't lease; kept in step with the marc loops
+                if not daemon:
+                    log.warning( 'backoff required, ```%s```; quitting until cron re-initiates' % e ); break
+                json_exporter.scheduler.wait( e )  # the batch is still un-grabbed, so it's retried next loop
+                continue
+            tracker_helper.update_tracker( next_batch, tracker, file_stats )
+    finally:
+        tracker_helper.export_tracker_json( tracker )
+    log.info( 'connection_stats, ```%s```' % get_http_client().connection_stats() )
     log.debug( 'complete' )
     return
 
 
-def check_tracker_file():
+def check_tracker_file( delta=False, new_delta=False ):
     """ Ensures file exists, is up-to-date, and contains last-bib and range-info.
+        In delta mode, the helpers are pointed at the delta tracker and download-dir, and batches hold changed bib-ids;
+          a new delta replaces a complete one only with `new_delta`.
         Called by manage_download() """
+    if delta:
+        delta_helper = DeltaHelper()
+        tracker_helper.TRACKER_FILEPATH = delta_helper.DELTA_TRACKER_FILEPATH
+        tracker_helper.store = None  # delta trackers are small; kept as plain json
+        if tracker_helper.worker_id:
+            log.warning( 'SBE__WORKER_ID is ignored in delta mode; batches are not leased, so run a single worker' )
+        tracker_helper.FILE_DOWNLOAD_DIR = marc_helper.FILE_DOWNLOAD_DIR = delta_helper.DELTA_DOWNLOAD_DIR
+        tracker = delta_helper.grab_delta_tracker( tracker_helper, start_new=new_delta )
+        log.debug( 'check_tracker_file() complete for delta' )
+        return tracker
     tracker = tracker_helper.grab_tracker_file()
     tracker_helper.check_tracker_lastbib( tracker )
     tracker_helper.check_tracker_batches( tracker, start_bib=int('1000000'), end_bib=int(tracker['last_bib']) )
@@ -63,19 +126,87 @@ def check_tracker_file():
 def download_file( next_batch, tracker ):
     """ Initiates production of marc file, then downloads it.
         Called by run_loop_work() """
-    token = marc_helper.get_token()
-    ( marc_file_url, err ) = marc_helper.make_bibrange_request( token, next_batch )
-    if err:
-        handled_check = marc_helper.handle_bib_range_request_err( err, next_batch['file_name'] )
-        if handled_check == 'success':
-            tracker_helper.update_tracker( next_batch, tracker )
+    marc_file_url = request_batch( next_batch, tracker )
     if marc_file_url:
-        marc_helper.grab_file( token, marc_file_url, next_batch['file_name'] )
-        tracker_helper.update_tracker( next_batch, tracker )
+        file_stats = marc_helper.grab_file( marc_file_url, next_batch['file_name'], next_batch.get('output_records', None) )
+        file_stats['outcome'] = 'ok' if file_stats['records_valid'] else 'invalid'
+        tracker_helper.update_tracker( next_batch, tracker, file_stats )
     log.debug( 'download complete' )
     return
 
 
+def request_batch( next_batch, tracker ):
+    """ Requests the batch's export-job and handles outcomes that don't produce a download; returns the file-url to download, if any.
+        Failed or over-full ranges are split in the tracker, and their halves requested in turn.
+        Called by download_file() and manage_pipelined_download() """
+    ( marc_file_url, err ) = marc_helper.make_bibrange_request( next_batch )
+    tracker_helper.range_history.record( next_batch )
+    if marc_helper.needs_split( next_batch, err ) and tracker_helper.split_batch( next_batch, tracker ):
+        return None
+    if err:
+        outcome = marc_helper.handle_bib_range_request_err( err )
+        if outcome:
+            tracker_helper.update_tracker( next_batch, tracker, outcome )
+    return marc_file_url
+
+
+def manage_pipelined_download( daemon=False, delta=False, new_delta=False ):
+    """ Controller function for pipelined mode: bib-range jobs are requested here while a bounded pool downloads the returned file-urls.
+        Called by `if __name__ == '__main__':` when run with `--pipelined` """
+    tracker = check_tracker_file( delta, new_delta )
+    processing_duration = datetime.datetime.now() + datetime.timedelta( minutes=LOOP_DURATION_IN_MINUTES )
+    ( in_flight, futures ) = ( {}, set() )  # in_flight: file_name -> batch, so the same batch isn't requested twice
+    with concurrent.futures.ThreadPoolExecutor( max_workers=DOWNLOAD_WORKERS ) as executor:
+        try:
+            while daemon or datetime.datetime.now() < processing_duration:
+                futures = collect_finished_downloads( futures, in_flight, block=(len(futures) >= DOWNLOAD_WORKERS * 2) )
+                next_batch = tracker_helper.get_next_batch( tracker, skip_file_names=in_flight )
+                if next_batch is None:
+                    log.debug( 'no next batch; waiting on in-flight downloads, then quitting' ); break
+                try:
+                    marc_file_url = request_batch( next_batch, tracker )
+                except BackoffRequired as e:
+                    tracker_helper.release_batch( next_batch )
+                    if not daemon:
+                        log.warning( 'backoff required, ```%s```; finishing in-flight downloads, then quitting' % e ); break
+                    marc_helper.scheduler.wait( e )  # in-flight downloads continue meanwhile
+                    continue
+                if marc_file_url:
+                    in_flight[next_batch['file_name']] = next_batch
+                    futures.add( executor.submit(download_and_track, marc_file_url, next_batch, tracker) )
+            while futures:
+                futures = collect_finished_downloads( futures, in_flight, block=True )
+        finally:
+            tracker_helper.range_history.save()
+            tracker_helper.export_tracker_json( tracker )
+    log.info( 'connection_stats, ```%s```' % get_http_client().connection_stats() )
+    log.debug( 'complete' )
+    return
+
+
+def download_and_track( marc_file_url, next_batch, tracker ):
+    """ Downloads one file and marks its batch done; runs in a download-worker thread.
+        Called by manage_pipelined_download() """
+    file_stats = marc_helper.grab_file( marc_file_url, next_batch['file_name'], next_batch.get('output_records', None) )
+    file_stats['outcome'] = 'ok' if file_stats['records_valid'] else 'invalid'
+    tracker_helper.update_tracker( next_batch, tracker, file_stats )
+    return next_batch
+
+
+def collect_finished_downloads( futures, in_flight, block ):
+    """ Reaps completed downloads, re-raising any download exception; when `block` is set, waits for at least one to finish.
+        Called by manage_pipelined_download() """
+    if not futures:
+        return futures
+    timeout = None if block else 0
+    ( done, not_done ) = concurrent.futures.wait( futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED )
+    for future in done:
+        finished_batch = future.result()
+        del in_flight[ finished_batch['file_name'] ]
+        log.debug( 'download finished for, ```%s```' % finished_batch['file_name'] )
+    return not_done
+
+
 
 # def download_file( next_batch, tracker ):
 #     """ Initiates production of marc file, then downloads it.
@@ -90,5 +221,17 @@ def download_file( next_batch, tracker ):
 
 if __name__ == '__main__':
     log.debug( '\n-------\nstarting `main`' )
-    manage_download()
+    parser = argparse.ArgumentParser( description='Exports marc-records from sierra.' )
+    parser.add_argument( '--pipelined', action='store_true', help='overlap bib-range requests with file-downloads (see SBE__DOWNLOAD_WORKERS)' )
+    parser.add_argument( '--daemon', action='store_true', help='run until the export is complete, waiting out rate-limiting in-process' )
+    parser.add_argument( '--delta', action='store_true', help='export only bibs changed since the previous run, and list deletions (see SBE__DELTA_*)' )
+    parser.add_argument( '--new-delta', action='store_true', help='with --delta, start the next delta once the previous one is complete (clears its files)' )
+    parser.add_argument( '--json', action='store_true', help='page bib json into compressed jsonl shards instead of exporting marc files (see SBE__JSON_*)' )
+    args = parser.parse_args()
+    if args.json:
+        manage_json_download( daemon=args.daemon )
+    elif args.pipelined:
+        manage_pipelined_download( daemon=args.daemon, delta=args.delta, new_delta=args.new_delta )
+    else:
+        manage_download( daemon=args.daemon, delta=args.delta, new_delta=args.new_delta )
     log.debug( '`main` complete\n-------\n' )
@@ -0,0 +1,144 @@
+import datetime, json, logging, os, time
+import requests
+from requests.auth import HTTPBasicAuth
+from lib.client import get_http_client
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading auth module' )
+
+
+class TokenManager( object ):
+    """ Obtains, caches, and refreshes the api bearer-token.
+        One instance per set of credentials is shared by MarcHelper, LastBibHelper, and last_bib.py -- see get_token_manager() """
+
+    def __init__( self, api_root_url, httpbasic_key, httpbasic_secret, cache_path=None ):
+        self.API_ROOT_URL = api_root_url
+        self.HTTPBASIC_KEY = httpbasic_key
+        self.HTTPBASIC_SECRET = httpbasic_secret
+        self.cache_path = cache_path  # optional; when set, the token survives across cron-triggered processes
+        self.refresh_margin_seconds = int( os.environ.get('SBE__TOKEN_REFRESH_MARGIN_SECONDS', '60') )
+        self.token = None
+        self.expires_at = 0  # epoch-seconds
+        self.http_client = get_http_client()
+
+    def get_token( self ):
+        """ Returns a still-valid token, from memory, then disk, then the api.
+            Called by MarcHelper, LastBibHelper, last_bib.py """
+        if self.token_is_fresh():
+            return self.token
+        if self.load_cached_token() and self.token_is_fresh():
+            log.debug( 'using disk-cached token' )
+            return self.token
+        return self.fetch_token()
+
+    def token_is_fresh( self ):
+        """ Checks that the token exists and isn't about to expire.
+            Called by get_token() """
+        return self.token is not None and time.time() < ( self.expires_at - self.refresh_margin_seconds )
+
+    def fetch_token( self ):
+        """ Posts to the token endpoint and caches the result.
+            Called by get_token() and invalidate() """
+        token_url = '%stoken' % self.API_ROOT_URL
+        log.debug( 'token_url, ```%s```' % token_url )
+        try:
+            r = self.http_client.post( token_url, endpoint='token', auth=HTTPBasicAuth(self.HTTPBASIC_KEY, self.HTTPBASIC_SECRET) )
+            log.debug( 'token r.status_code, `%s`' % r.status_code )
+            data_dct = r.json()
+            self.token = data_dct['access_token']
+            self.expires_at = time.time() + int( data_dct.get('expires_in', 3600) )
+        except Exception as e:
+            message = 'exception getting token, ```%s```' % str(e)
+            log.error( message )
+            raise Exception( message )
+        log.debug( 'new token obtained; expires at, `%s`' % datetime.datetime.fromtimestamp(self.expires_at).isoformat() )
+        self.save_cached_token()
+        return self.token
+
+    def invalidate( self, stale_token=None ):
+        """ Drops the current token -- unless another caller already replaced it -- and returns a fresh one.
+            Called by authorized_get() on a 401 """
+        if stale_token is not None and stale_token != self.token:
+            return self.get_token()
+        log.debug( 'invalidating token' )
+        self.token = None
+        self.expires_at = 0
+        return self.fetch_token()
+
+    def load_cached_token( self ):
+        """ Loads token from optional disk-cache; returns True if one was found.
+            Called by get_token() """
+        if not self.cache_path:
+            return False
+        try:
+            with open( self.cache_path, 'r' ) as f:
+                cache_dct = json.loads( f.read() )
+            if cache_dct['key'] != self.HTTPBASIC_KEY:
+                return False
+            ( self.token, self.expires_at ) = ( cache_dct['access_token'], cache_dct['expires_at'] )
+        except Exception as e:
+            log.debug( 'no usable token-cache, ```%s```' % e )
+            return False
+        return True
+
+    def save_cached_token( self ):
+        """ Writes token to optional disk-cache, readable only by owner.
+            Called by fetch_token() """
+        if not self.cache_path:
+            return
+        cache_dct = { 'key': self.HTTPBASIC_KEY, 'access_token': self.token, 'expires_at': self.expires_at }
+        temp_path = '%s.tmp' % self.cache_path
+        try:
+            fd = os.open( temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 )
+            with os.fdopen( fd, 'w' ) as f:
+                f.write( json.dumps(cache_dct) )
+            os.replace( temp_path, self.cache_path )
+        except Exception as e:
+            log.warning( 'could not write token-cache, ```%s```; continuing' % e )
+        return
+
+    def authorized_get( self, url, endpoint='default', **kwargs ):
+        """ GETs url with bearer-token over the pooled session; on a 401, re-authenticates once and retries.
+            Called by MarcHelper, LastBibHelper, last_bib.py """
+        extra_headers = kwargs.pop( 'headers', None )
+        token = self.get_token()
+        r = self.http_client.get( url, endpoint=endpoint, headers=self.build_headers(token, extra_headers), **kwargs )
+        if r.status_code == 401:
+            log.warning( '401 for url, ```%s```; re-authenticating once' % url )
+            r.close()
+            token = self.invalidate( stale_token=token )
+            r = self.http_client.get( url, endpoint=endpoint, headers=self.build_headers(token, extra_headers), **kwargs )
+        return r
+
+    def build_headers( self, token, extra_headers ):
+        """ Returns request headers including bearer-token.
+            Called by authorized_get() """
+        headers = dict( extra_headers or {} )
+        headers['Authorization'] = 'Bearer %s' % token
+        return headers
+
+    ## end class TokenManager()
+
+
+token_managers = {}
+
+
+def get_token_manager( api_root_url=None, httpbasic_key=None, httpbasic_secret=None ):
+    """ Returns the shared TokenManager for the given (default: env) credentials.
+        Called by MarcHelper, LastBibHelper, last_bib.py """
+    api_root_url = api_root_url or os.environ['SBE__ROOT_URL']
+    httpbasic_key = httpbasic_key or os.environ['SBE__HTTPBASIC_USERNAME']
+    httpbasic_secret = httpbasic_secret or os.environ['SBE__HTTPBASIC_PASSWORD']
+    manager_key = ( api_root_url, httpbasic_key )
+    if manager_key not in token_managers:
+        token_managers[manager_key] = TokenManager(
+            api_root_url, httpbasic_key, httpbasic_secret, cache_path=os.environ.get('SBE__TOKEN_CACHE_PATH', None) )
+    return token_managers[manager_key]
@@ -0,0 +1,140 @@
+import array, bisect, json, logging, mmap, os, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import marc_file_paths, open_buffer
+from lib.marc_check import bib_number, check_record
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading bib_index module' )
+
+## file layout: one json header-line (padded to 8 bytes), then four parallel arrays sorted by bib --
+##   offsets (uint64), bib-numbers (uint32), lengths (uint32), file-numbers (uint16)
+INDEX_VERSION = 1
+ARRAY_TYPES = ( ('offsets', 'Q'), ('bibs', 'I'), ('lengths', 'I'), ('files', 'H') )
+
+
+def build_index( file_paths, index_path ):
+    """ Indexes every record in `file_paths` by bib-number, into compact arrays sorted by bib; returns the record-count.
+        Records are located with the structural walk from marc_check, so nothing is parsed beyond the 907/001.
+          Offsets are into the uncompressed content, for compressed files; see compression.BlockBuffer.
+        Called by consolidate.Consolidator.consolidate() and `if __name__ == '__main__':` """
+    columns = { name: array.array(type_code) for ( name, type_code ) in ARRAY_TYPES }
+    for ( file_number, file_path ) in enumerate( file_paths ):
+        buffer = open_buffer( file_path )
+        try:
+            ( position, end_of_buffer ) = ( 0, len(buffer) )
+            while position < end_of_buffer:
+                ( record_length, error, bib_id ) = check_record( buffer, position, end_of_buffer, collect_bib_ids=True )
+                if error:
+                    log.warning( 'stopped indexing ```%s``` at offset `%s`, ```%s```' % (file_path, position, error) )
+                    break
+                number = bib_number( bib_id )
+                if number is not None:
+                    columns['offsets'].append( position )
+                    columns['bibs'].append( number )
+                    columns['lengths'].append( record_length )
+                    columns['files'].append( file_number )
+                position += record_length
+        finally:
+            buffer.close()
+    bibs = columns['bibs']
+    if any( bibs[i] > bibs[i + 1] for i in range(len(bibs) - 1) ):  # consolidated shards are already in bib-order
+        order = sorted( range(len(bibs)), key=bibs.__getitem__ )  # stable, so a later file's copy of a bib sorts after the earlier one
+        columns = { name: array.array(column.typecode, (column[i] for i in order)) for ( name, column ) in columns.items() }
+    index_dir = os.path.dirname( os.path.abspath(index_path) )
+    header = json.dumps( {
+        'version': INDEX_VERSION, 'record_count': len( columns['bibs'] ),
+        'files': [ os.path.relpath(os.path.abspath(file_path), index_dir) for file_path in file_paths ] } ).encode( 'utf-8' )
+    header += b' ' * ( (8 - (len(header) + 1) % 8) % 8 ) + b'\n'
+    temp_path = '%s.tmp' % index_path
+    with open( temp_path, 'wb' ) as f:
+        f.write( header )
+        for ( name, type_code ) in ARRAY_TYPES:
+            columns[name].tofile( f )
+    os.replace( temp_path, index_path )
+    log.info( 'indexed `%s` records from `%s` files into ```%s```' % (len(columns['bibs']), len(file_paths), index_path) )
+    return len( columns['bibs'] )
+
+
+class BibIndex( object ):
+    """ Read-side of the bib-index: binary-searches the mmapped bib-array, then returns raw record bytes from the mmapped marc file.
+        Nothing is loaded up front, so opening the index for a spot-check is instant even for the full export.
+        For downstream readers, eg `BibIndex( path ).get_record( 1234567 )`. """
+
+    def __init__( self, index_path ):
+        self.index_path = index_path
+        self.index_dir = os.path.dirname( os.path.abspath(index_path) )
+        self.handle = open( index_path, 'rb' )
+        header_line = self.handle.readline()
+        self.header = json.loads( header_line )
+        if self.header['version'] != INDEX_VERSION:
+            message = 'unsupported bib-index version, `%s`; raising Exception' % self.header['version']
+            log.error( message )
+            raise Exception( message )
+        count = self.header['record_count']
+        self.columns = {}
+        if count:
+            self.buffer = mmap.mmap( self.handle.fileno(), 0, access=mmap.ACCESS_READ )
+            position = len( header_line )
+            for ( name, type_code ) in ARRAY_TYPES:
+                size = array.array( type_code ).itemsize * count
+                self.columns[name] = memoryview( self.buffer )[position:position + size].cast( type_code )
+                position += size
+        self.file_buffers = {}  # file_path -> mmap (or compression.BlockBuffer), opened on first use
+
+    def locate( self, bib_id ):
+        """ Returns ( file_path, offset, length ) for the bib (an int, or a 'b1234567' string), or None.
+            If re-exports put a bib in two files, the later file's copy wins.
+            Called by get_record() """
+        if isinstance( bib_id, str ):
+            bib_id = bib_number( bib_id.lstrip('.') )
+        if bib_id is None or not self.columns:
+            return None
+        position = bisect.bisect_right( self.columns['bibs'], bib_id ) - 1
+        if position < 0 or self.columns['bibs'][position] != bib_id:
+            return None
+        file_path = os.path.join( self.index_dir, self.header['files'][self.columns['files'][position]] )
+        return ( file_path, self.columns['offsets'][position], self.columns['lengths'][position] )
+
+    def get_record( self, bib_id ):
+        """ Returns the bib's raw marc bytes, or None.
+            For downstream readers. """
+        location = self.locate( bib_id )
+        if location is None:
+            return None
+        ( file_path, offset, length ) = location
+        if file_path not in self.file_buffers:
+            self.file_buffers[file_path] = open_buffer( file_path )
+        return self.file_buffers[file_path][offset:offset + length]
+
+    def get_records( self, bib_ids ):
+        """ Yields ( bib_id, raw marc bytes or None ), in bib-order, so reads move forward through each file.
+            For downstream readers. """
+        for bib_id in sorted( bib_ids, key=lambda bib_id: bib_number(bib_id.lstrip('.')) if isinstance(bib_id, str) else bib_id ):
+            yield ( bib_id, self.get_record(bib_id) )
+
+    def close( self ):
+        """ Releases the mmaps; memoryviews into the index must be released first.
+            For downstream readers. """
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        for file_buffer in self.file_buffers.values():
+            file_buffer.close()
+        if getattr( self, 'buffer', None ):
+            self.buffer.close()
+        self.handle.close()
+        return
+
+    ## end class BibIndex()
+
+
+if __name__ == '__main__':
+    log.debug( 'starting bib-index build for download-directory' )
+    build_index( marc_file_paths(os.environ['SBE__FILE_DOWNLOAD_DIR']), os.environ['SBE__BIB_INDEX_PATH'] )
+    log.debug( 'complete' )
@@ -0,0 +1,115 @@
+import array, bisect, datetime, json, logging, mmap, os, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.auth import get_token_manager
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading bib_inventory module' )
+
+## file layout: one json header-line (padded to 8 bytes), then the live bib-ids as one sorted uint32 array
+INVENTORY_VERSION = 1
+PAGE_SIZE = 2000  # the bibs endpoint's limit
+
+
+def build_inventory( inventory_path, start_bib, end_bib, token_manager=None ):
+    """ Pages the lightweight `bibs/?fields=id` endpoint for every live (un-deleted, unsuppressed) bib-id in [start_bib, end_bib], and writes them
+          as a compact sorted array; returns the id-count. That's one cheap query per 2000 live ids, against one `bibs/marc` export-job per 2000-id range.
+        Called by tracker.TrackerHelper.prepare_inventory_batches() and `if __name__ == '__main__':` """
+    start = datetime.datetime.now()
+    token_manager = token_manager or get_token_manager()
+    bib_url = '%sbibs/' % token_manager.API_ROOT_URL
+    ( bib_ids, next_id, page_count ) = ( array.array('I'), start_bib, 0 )
+    while next_id <= end_bib:
+        payload = { 'limit': str(PAGE_SIZE), 'fields': 'id', 'deleted': 'false', 'suppressed': False, 'id': '[%s,%s]' % (next_id, end_bib) }  # the endpoint lists deleted stubs by default; suppressed as in last_bib.py
+        r = token_manager.authorized_get( bib_url, endpoint='bibs', params=payload )
+        page_count += 1
+        if r.status_code == 404:  # sierra's answer to an empty result-set
+            break
+        if r.status_code != 200:
+            message = 'bad status listing bib-ids from `%s`, `%s`; raising Exception' % ( next_id, r.status_code )
+            log.error( message )
+            raise Exception( message )
+        entries = r.json().get( 'entries', [] )
+        bib_ids.extend( int(entry['id']) for entry in entries )
+        if len( entries ) < PAGE_SIZE:
+            break
+        next_id = bib_ids[-1] + 1
+    if any( bib_ids[i] >= bib_ids[i + 1] for i in range(len(bib_ids) - 1) ):  # the api returns ids in order; guard the binary-searches anyway
+        bib_ids = array.array( 'I', sorted(set(bib_ids)) )
+    header = json.dumps( {
+        'version': INVENTORY_VERSION, 'created': datetime.datetime.now().isoformat(), 'start_bib': start_bib, 'end_bib': end_bib,
+        'count': len( bib_ids ) } ).encode( 'utf-8' )
+    header += b' ' * ( (8 - (len(header) + 1) % 8) % 8 ) + b'\n'
+    temp_path = '%s.tmp' % inventory_path
+    with open( temp_path, 'wb' ) as f:
+        f.write( header )
+        bib_ids.tofile( f )
+    os.replace( temp_path, inventory_path )
+    log.info( '`%s` live bibs in `%s-%s` from `%s` queries into ```%s```; time_taken, `%s`' % (
+        len(bib_ids), start_bib, end_bib, page_count, inventory_path, datetime.datetime.now() - start) )
+    return len( bib_ids )
+
+
+def pack_batches( bib_ids, records_per_batch=PAGE_SIZE ):
+    """ Returns ( first_id, last_id, count ) for consecutive runs of `records_per_batch` live ids; only the last run is short.
+        Called by tracker.TrackerHelper.prepare_inventory_batches() """
+    return [ ( bib_ids[position], bib_ids[min(position + records_per_batch, len(bib_ids)) - 1], min(records_per_batch, len(bib_ids) - position) )
+        for position in range( 0, len(bib_ids), records_per_batch ) ]
+
+
+class BibInventory( object ):
+    """ Read-side of the inventory: the mmapped id-array, binary-searched, so a membership check costs a few page-reads however large the catalog.
+        For the tracker's job-planning, and for downstream readers, eg `1234567 in BibInventory( path )`. """
+
+    def __init__( self, inventory_path ):
+        self.inventory_path = inventory_path
+        self.handle = open( inventory_path, 'rb' )
+        header_line = self.handle.readline()
+        self.header = json.loads( header_line )
+        if self.header['version'] != INVENTORY_VERSION:
+            message = 'unsupported bib-inventory version, `%s`; raising Exception' % self.header['version']
+            log.error( message )
+            raise Exception( message )
+        ( self.buffer, self.bib_ids ) = ( None, [] )
+        if self.header['count']:
+            self.buffer = mmap.mmap( self.handle.fileno(), 0, access=mmap.ACCESS_READ )
+            self.bib_ids = memoryview( self.buffer )[len(header_line):].cast( 'I' )
+
+    def __contains__( self, bib_id ):
+        position = bisect.bisect_left( self.bib_ids, bib_id )
+        return position < len( self.bib_ids ) and self.bib_ids[position] == bib_id
+
+    def __len__( self ):
+        return len( self.bib_ids )
+
+    def count_between( self, start_bib, end_bib ):
+        """ Returns the number of live ids in [start_bib, end_bib].
+            For downstream readers. """
+        return bisect.bisect_right( self.bib_ids, end_bib ) - bisect.bisect_left( self.bib_ids, start_bib )
+
+    def close( self ):
+        """ Releases the mmap; the id-memoryview must be released first.
+            Called by tracker.TrackerHelper.prepare_inventory_batches() """
+        if self.buffer is not None:
+            self.bib_ids.release()
+            self.buffer.close()
+        ( self.buffer, self.bib_ids ) = ( None, [] )
+        self.handle.close()
+        return
+
+    ## end class BibInventory()
+
+
+if __name__ == '__main__':
+    log.debug( 'starting bib-inventory build' )
+    with open( os.environ['SBE__LASTBIB_JSON_PATH'] ) as f:
+        last_bib = int( json.loads(f.read())['id'] )
+    build_inventory( os.environ['SBE__BIB_INVENTORY_PATH'], 1000000, last_bib )
+    log.debug( 'complete' )
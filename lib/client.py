@@ -0,0 +1,85 @@
+import json, logging, os
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading client module' )
+
+
+DEFAULT_TIMEOUTS = {
+    'token': 20,
+    'bibs_marc': 30,  # the bib-range file-job request
+    'bibs': 30,  # the json bibs/ endpoint
+    'file': 60,  # the marc-file download
+    'last_bib_url': 10,  # the web-accessible last_bib.json
+    'default': 30,
+    }
+
+
+class HttpClient( object ):
+    """ Single pooled, keep-alive session for all sierra-api traffic, so connections are re-used instead of re-handshaking per request.
+        Shared via get_http_client() """
+
+    def __init__( self ):
+        self.pool_connections = int( os.environ.get('SBE__HTTP_POOL_CONNECTIONS', '4') )  # number of hosts to keep pools for
+        self.pool_maxsize = int( os.environ.get('SBE__HTTP_POOL_MAXSIZE', '10') )  # connections kept per host
+        self.timeouts = dict( DEFAULT_TIMEOUTS )
+        self.timeouts.update( json.loads(os.environ.get('SBE__HTTP_TIMEOUTS_JSON', '{}')) )  # eg '{"file": 120}'
+        self.adapter = HTTPAdapter( pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize )
+        self.session = requests.Session()
+        self.session.mount( 'https://', self.adapter )
+        self.session.mount( 'http://', self.adapter )
+        log.debug( 'pool_connections, `%s`; pool_maxsize, `%s`; timeouts, ```%s```' % (self.pool_connections, self.pool_maxsize, self.timeouts) )
+
+    def get( self, url, endpoint='default', **kwargs ):
+        """ GETs url via the pooled session, applying the endpoint's timeout unless one is passed.
+            Called by auth.TokenManager, tracker.TrackerHelper, etc. """
+        kwargs.setdefault( 'timeout', self.timeouts.get(endpoint, self.timeouts['default']) )
+        return self.session.get( url, **kwargs )
+
+    def post( self, url, endpoint='default', **kwargs ):
+        """ POSTs to url via the pooled session, applying the endpoint's timeout unless one is passed.
+            Called by auth.TokenManager.fetch_token() """
+        kwargs.setdefault( 'timeout', self.timeouts.get(endpoint, self.timeouts['default']) )
+        return self.session.post( url, **kwargs )
+
+    def connection_stats( self ):
+        """ Returns request and connection counts across the per-host pools; `reused` requests skipped a tcp/tls handshake.
+            Called by controller.manage_download() """
+        ( request_count, connection_count ) = ( 0, 0 )
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list( pools.keys() ):
+            pool = pools.get( pool_key )
+            if pool is None:  # evicted meanwhile
+                continue
+            request_count += pool.num_requests
+            connection_count += pool.num_connections
+        reused_count = max( request_count - connection_count, 0 )
+        stats = {
+            'requests': request_count,
+            'new_connections': connection_count,
+            'reused': reused_count,
+            'reuse_ratio': round( float(reused_count) / request_count, 3 ) if request_count else 0.0 }
+        return stats
+
+    ## end class HttpClient()
+
+
+http_client = None
+
+
+def get_http_client():
+    """ Returns the process-wide HttpClient, creating it on first use.
+        Called by auth, sierra, tracker, last_bib, controller """
+    global http_client
+    if http_client is None:
+        http_client = HttpClient()
+    return http_client
@@ -0,0 +1,277 @@
+import bisect, glob, gzip, json, logging, mmap, os, zlib
+
+try:
+    import zstandard  # optional; only needed for SBE__COMPRESSION=zstd, or to read .zst files
+except ImportError:
+    zstandard = None
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading compression module' )
+
+## compressed marc is stored as `<name>.mrc.gz` or `<name>.mrc.zst`. Block-compressed files (shards) are a series of independent gzip-members
+##   or zstd-frames -- which still read back as one ordinary stream -- with a `<file>.blocks.json` sidecar holding each block's
+##   [ uncompressed-offset, compressed-offset ], so a record can be read by decompressing just its block.
+SUFFIXES = { 'gzip': '.gz', 'zstd': '.zst' }
+BLOCKS_SUFFIX = '.blocks.json'
+
+
+def configured_method():
+    """ Returns the SBE__COMPRESSION method -- None, 'gzip', or 'zstd' -- raising if it's unknown or zstandard isn't installed.
+        Called by sierra.MarcHelper and consolidate.Consolidator """
+    method = os.environ.get( 'SBE__COMPRESSION', 'none' ).lower()
+    if method == 'none':
+        return None
+    if method not in SUFFIXES:
+        message = 'unknown SBE__COMPRESSION, `%s`; raising Exception' % method
+        log.error( message )
+        raise Exception( message )
+    if method == 'zstd' and zstandard is None:
+        message = 'SBE__COMPRESSION is `zstd`, but the zstandard package is not installed; raising Exception'
+        log.error( message )
+        raise Exception( message )
+    return method
+
+
+def compression_of( file_path ):
+    """ Returns the file's compression method from its suffix, or None.
+        Called by open_buffer() and open_stream() """
+    for ( method, suffix ) in SUFFIXES.items():
+        if file_path.endswith( suffix ):
+            return method
+    return None
+
+
+def stored_name( file_name, method ):
+    """ Returns the on-disk name for a (logical) marc file-name, eg 'sierra_export_0001.mrc' -> 'sierra_export_0001.mrc.gz'.
+        Called by sierra.MarcHelper.grab_file() and consolidate.Consolidator.open_shard() """
+    return file_name + SUFFIXES[method] if method else file_name
+
+
+def logical_name( file_name ):
+    """ Returns the file-name without any compression suffix, as the tracker knows it.
+        Called by validator.FileChecker and snapshots.SnapshotStore """
+    method = compression_of( file_name )
+    return file_name[:-len( SUFFIXES[method] )] if method else file_name
+
+
+def marc_file_paths( directory, pattern='*.mrc' ):
+    """ Returns the sorted paths matching `pattern`, stored plain or compressed.
+        Called by the modules that read the download-directory """
+    file_paths = glob.glob( '%s/%s' % (directory, pattern) )
+    for suffix in SUFFIXES.values():
+        file_paths.extend( glob.glob('%s/%s%s' % (directory, pattern, suffix)) )
+    return sorted( file_paths )
+
+
+def find_stored( file_path ):
+    """ Returns the path as stored -- plain, or with a compression suffix -- or None if there's no such file.
+        Called by validator.FileChecker.salvage_quarantined_files() """
+    for candidate in [ file_path ] + [ file_path + suffix for suffix in SUFFIXES.values() ]:
+        if os.path.exists( candidate ):
+            return candidate
+    return None
+
+
+class StreamCompressor( object ):
+    """ Compresses a byte-stream, chunk by chunk; with `block_bytes`, starts a new independent gzip-member or zstd-frame every `block_bytes`
+          of input, and keeps the block-table for random access.
+        Used by sierra.MarcHelper.stream_to_temp_file(), consolidate.Consolidator, and write_marc_file() """
+
+    def __init__( self, method, block_bytes=None ):
+        self.method = method
+        self.block_bytes = block_bytes
+        ( self.uncompressed_bytes, self.compressed_bytes ) = ( 0, 0 )
+        ( self.compressor, self.blocks, self.block_start ) = ( None, [], 0 )
+
+    def compress( self, data ):
+        """ Returns the compressed bytes for `data`, ending and starting blocks as needed.
+            Called by writers """
+        output = []
+        ( view, position ) = ( memoryview(data), 0 )
+        while position < len( view ):
+            if self.compressor is None:
+                self.start_block()
+            take = len( view ) - position
+            if self.block_bytes:
+                take = min( take, self.block_bytes - (self.uncompressed_bytes - self.block_start) )
+            self.emit( output, self.compressor.compress(view[position:position + take]) )
+            ( position, self.uncompressed_bytes ) = ( position + take, self.uncompressed_bytes + take )
+            if self.block_bytes and self.uncompressed_bytes - self.block_start >= self.block_bytes:
+                self.emit( output, self.end_block() )
+        return b''.join( output )
+
+    def flush( self ):
+        """ Returns the bytes ending the last block.
+            Called by writers, once all data is compressed """
+        output = []
+        if self.compressor is not None:
+            self.emit( output, self.end_block() )
+        return b''.join( output )
+
+    def emit( self, output, compressed ):
+        """ Queues compressed bytes for return, keeping the running compressed-offset that block-starts are noted at.
+            Called by compress() and flush() """
+        output.append( compressed )
+        self.compressed_bytes += len( compressed )
+        return
+
+    def start_block( self ):
+        """ Starts a new member/frame, noting where it begins.
+            Called by compress() """
+        self.blocks.append( [self.uncompressed_bytes, self.compressed_bytes] )
+        self.block_start = self.uncompressed_bytes
+        if self.method == 'gzip':
+            self.compressor = zlib.compressobj( 6, zlib.DEFLATED, 31 )  # wbits 31: gzip header and trailer
+        else:
+            self.compressor = zstandard.ZstdCompressor( level=3 ).compressobj()
+        return
+
+    def end_block( self ):
+        """ Finishes the current member/frame; returns its final bytes.
+            Called by compress() and flush() """
+        compressed = self.compressor.flush()
+        self.compressor = None
+        return compressed
+
+    ## end class StreamCompressor()
+
+
+def write_block_table( file_path, compressor ):
+    """ Writes the `.blocks.json` sidecar for a block-compressed file.
+        Called by consolidate.Consolidator.close_shard() """
+    temp_path = '%s%s.tmp' % ( file_path, BLOCKS_SUFFIX )
+    with open( temp_path, 'w' ) as f:
+        f.write( json.dumps({'method': compressor.method, 'uncompressed_bytes': compressor.uncompressed_bytes, 'blocks': compressor.blocks}) )
+    os.replace( temp_path, '%s%s' % (file_path, BLOCKS_SUFFIX) )
+    return
+
+
+def write_marc_file( file_path, chunks, method ):
+    """ Writes `chunks` to file_path (plus the method's suffix) via a temp-file; returns the path written.
+        Called by validator.FileChecker.salvage_file() """
+    file_path = stored_name( file_path, method )
+    compressor = StreamCompressor( method ) if method else None
+    with open( '%s.part' % file_path, 'wb' ) as f:
+        for chunk in chunks:
+            f.write( compressor.compress(chunk) if compressor else chunk )
+        if compressor:
+            f.write( compressor.flush() )
+    os.replace( '%s.part' % file_path, file_path )
+    return file_path
+
+
+def decompress_block( method, data ):
+    """ Returns one gzip-member's or zstd-frame's content.
+        Called by BlockBuffer.load_block() """
+    if method == 'gzip':
+        return zlib.decompressobj( 31 ).decompress( data )
+    return zstandard.ZstdDecompressor().decompressobj().decompress( data )
+
+
+class LoadedBuffer( bytes ):
+    """ A fully-read file's content, with the close() the other buffers have.
+        Returned by open_buffer() """
+
+    def close( self ):
+        return
+
+
+class BlockBuffer( object ):
+    """ Read-only, sliceable view of a block-compressed file's uncompressed content; each access decompresses only the block(s) it touches,
+          keeping the most recent ones, so walking records in order decompresses each block once.
+        Supports what the marc_check record-walk uses: len(), integer indexing, and slicing.
+        Returned by open_buffer() """
+
+    def __init__( self, file_path, block_table, cached_blocks=4 ):
+        self.method = block_table['method']
+        self.length = block_table['uncompressed_bytes']
+        self.uncompressed_starts = [ block[0] for block in block_table['blocks'] ]
+        self.compressed_starts = [ block[1] for block in block_table['blocks'] ] + [ os.path.getsize(file_path) ]
+        self.handle = open( file_path, 'rb' )
+        ( self.cache, self.cached_blocks ) = ( {}, cached_blocks )  # block-number -> content; insertion-ordered, oldest evicted first
+
+    def __len__( self ):
+        return self.length
+
+    def __getitem__( self, key ):
+        if isinstance( key, slice ):
+            ( start, stop, step ) = key.indices( self.length )
+            if step != 1:
+                raise ValueError( 'BlockBuffer slices must be contiguous' )
+            return self.read( start, max(stop - start, 0) )
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError( 'BlockBuffer index out of range' )
+        block_number = bisect.bisect_right( self.uncompressed_starts, key ) - 1
+        return self.load_block( block_number )[ key - self.uncompressed_starts[block_number] ]
+
+    def read( self, offset, length ):
+        """ Returns `length` uncompressed bytes from `offset`.
+            Called by __getitem__() """
+        parts = []
+        while length > 0:
+            block_number = bisect.bisect_right( self.uncompressed_starts, offset ) - 1
+            ( block, block_offset ) = ( self.load_block(block_number), offset - self.uncompressed_starts[block_number] )
+            part = block[block_offset:block_offset + length]
+            if not part:
+                break
+            parts.append( part )
+            ( offset, length ) = ( offset + len(part), length - len(part) )
+        return parts[0] if len( parts ) == 1 else b''.join( parts )
+
+    def load_block( self, block_number ):
+        """ Returns a block's content, from the cache or the file.
+            Called by __getitem__() and read() """
+        if block_number not in self.cache:
+            self.handle.seek( self.compressed_starts[block_number] )
+            data = self.handle.read( self.compressed_starts[block_number + 1] - self.compressed_starts[block_number] )
+            if len( self.cache ) >= self.cached_blocks:
+                del self.cache[ next(iter(self.cache)) ]
+            self.cache[block_number] = decompress_block( self.method, data )
+        return self.cache[block_number]
+
+    def close( self ):
+        self.cache = {}
+        self.handle.close()
+        return
+
+    ## end class BlockBuffer()
+
+
+def open_buffer( file_path ):
+    """ Returns the marc file's content as a read-only buffer with close(): an mmap for plain files; a BlockBuffer for block-compressed ones;
+          else the decompressed bytes, which for download-files is a few MB.
+        Called by the record-walking readers (marc_check, bib_index, content_manifest, consolidate, field_extract) """
+    method = compression_of( file_path )
+    if method is None:
+        if os.path.getsize( file_path ) == 0:
+            return LoadedBuffer( b'' )
+        with open( file_path, 'rb' ) as fh:
+            return mmap.mmap( fh.fileno(), 0, access=mmap.ACCESS_READ )  # the mapping outlives the handle
+    if os.path.exists( '%s%s' % (file_path, BLOCKS_SUFFIX) ):
+        with open( '%s%s' % (file_path, BLOCKS_SUFFIX), 'r' ) as f:
+            return BlockBuffer( file_path, json.loads(f.read()) )
+    with open_stream( file_path ) as stream:
+        return LoadedBuffer( stream.read() )
+
+
+def open_stream( file_path ):
+    """ Returns a binary file-object reading the marc file's uncompressed content, eg for pymarc.
+        Called by open_buffer() and validator.check_marc_file() """
+    method = compression_of( file_path )
+    if method == 'gzip':
+        return gzip.open( file_path, 'rb' )  # reads across concatenated members
+    if method == 'zstd':
+        if zstandard is None:
+            message = 'reading ```%s``` needs the zstandard package; raising Exception' % file_path
+            log.error( message )
+            raise Exception( message )
+        return zstandard.ZstdDecompressor().stream_reader( open(file_path, 'rb'), read_across_frames=True, closefd=True )
+    return open( file_path, 'rb' )
@@ -0,0 +1,174 @@
+import datetime, glob, hashlib, json, logging, os, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.bib_index import build_index
+from lib.compression import BLOCKS_SUFFIX, StreamCompressor, configured_method, marc_file_paths, open_buffer, stored_name, write_block_table
+from lib.content_manifest import build_manifest, parse_ignore_tags
+from lib.marc_check import bib_number, check_buffer_structure
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading consolidate module' )
+
+
+class Consolidator( object ):
+    """ Merges the per-range download files into a few size-bounded shards, with a manifest of each shard's bib-range, record-count, and checksum.
+        Downstream jobs can then open a handful of large files, and go straight to the shard holding a given bib (see shards_for_bib()).
+        With SBE__COMPRESSION set, each shard is written as independently-decompressible blocks, with a `.blocks.json` table of their offsets,
+          so the bib-index can still read a single record without decompressing the whole shard. `bytes` in the manifest are then uncompressed. """
+
+    def __init__( self ):
+        self.FILE_DOWNLOAD_DIR = os.environ['SBE__FILE_DOWNLOAD_DIR']
+        self.SHARD_DIR = os.environ['SBE__SHARD_DIR']
+        self.shard_max_bytes = int( os.environ.get('SBE__SHARD_MAX_BYTES', str(1024 * 1024 * 1024)) )
+        self.manifest_path = '%s/manifest.json' % self.SHARD_DIR
+        self.index_file_name = 'bib_index.bin'
+        self.content_manifest_file_name = 'content_manifest.tsv'
+        self.manifest_ignore_tags = parse_ignore_tags( os.environ.get('SBE__MANIFEST_IGNORE_TAGS', '') )  # eg '005', so a bare timestamp-change isn't a change
+        self.compression = configured_method()  # when set, shards are block-compressed; see lib/compression.py
+        self.block_bytes = int( os.environ.get('SBE__COMPRESSION_BLOCK_BYTES', str(1024 * 1024)) )  # uncompressed bytes per independently-readable block
+        self.shard = None  # the shard being written
+
+    def consolidate( self ):
+        """ Streams every structurally-valid download file, in bib-order, into shards; non-marc and invalid files are left out.
+            Each source is read twice: by scan_sources(), to check it and find its bib-range for ordering, then by append_source(), to copy it.
+            The shards are then read twice more: indexed by bib (see bib_index.py), for random access, and content-hashed per record (see content_manifest.py), for diffing.
+            Called by `if __name__ == '__main__':` """
+        start = datetime.datetime.now()
+        sources = self.scan_sources()
+        shards = []
+        for source in sources:
+            if self.shard and self.shard['bytes'] + source['bytes'] > self.shard_max_bytes:
+                shards.append( self.close_shard() )
+            if self.shard is None:
+                self.open_shard( len(shards) )
+            self.append_source( source )
+        if self.shard:
+            shards.append( self.close_shard() )
+        self.remove_stale_shards( shards )
+        shard_paths = [ '%s/%s' % (self.SHARD_DIR, shard['file_name']) for shard in shards ]
+        build_index( shard_paths, '%s/%s' % (self.SHARD_DIR, self.index_file_name) )
+        build_manifest( shard_paths, '%s/%s' % (self.SHARD_DIR, self.content_manifest_file_name), self.manifest_ignore_tags )
+        manifest = {
+            'created': datetime.datetime.now().isoformat(), 'shard_max_bytes': self.shard_max_bytes,
+            'record_count': sum( shard['record_count'] for shard in shards ), 'shards': shards,
+            'bib_index_file_name': self.index_file_name, 'content_manifest_file_name': self.content_manifest_file_name }
+        temp_path = '%s.tmp' % self.manifest_path
+        with open( temp_path, 'w' ) as f:
+            f.write( json.dumps(manifest, sort_keys=True, indent=2) )
+        os.replace( temp_path, self.manifest_path )
+        log.info( '`%s` files consolidated into `%s` shards, `%s` records; time_taken, `%s`' % (
+            len(sources), len(shards), manifest['record_count'], datetime.datetime.now() - start) )
+        return manifest
+
+    def scan_sources( self ):
+        """ Returns the valid download files with their sizes and bib-ranges, ordered by lowest bib.
+            Called by consolidate() """
+        sources = []
+        for file_path in marc_file_paths( self.FILE_DOWNLOAD_DIR ):
+            if os.path.getsize( file_path ) == 0:
+                continue
+            buffer = open_buffer( file_path )
+            try:
+                ( structure, marc_bytes ) = ( check_buffer_structure(buffer, collect_bib_ids=True), len(buffer) )
+            finally:
+                buffer.close()
+            if not structure['valid']:
+                log.warning( 'skipping invalid ```%s```, ```%s```' % (file_path, structure['error']) )
+                continue
+            numbers = [ number for number in (bib_number(bib_id) for bib_id in structure['bib_ids']) if number is not None ]
+            sources.append( {
+                'file_path': file_path, 'bytes': marc_bytes, 'record_count': structure['record_count'],
+                'min_bib': min( numbers ) if numbers else None, 'max_bib': max( numbers ) if numbers else None } )
+        sources.sort( key=lambda source: (source['min_bib'] is None, source['min_bib'] or 0, source['file_path']) )
+        log.debug( '`%s` source files' % len(sources) )
+        return sources
+
+    def open_shard( self, shard_number ):
+        """ Starts a new shard's temp-file.
+            Called by consolidate() """
+        file_name = stored_name( 'sierra_shard_%s.mrc' % str(shard_number).rjust(4, '0'), self.compression )
+        temp_path = '%s/%s.part' % ( self.SHARD_DIR, file_name )
+        self.shard = {
+            'file_name': file_name, 'handle': open( temp_path, 'wb' ), 'hasher': hashlib.sha256(),
+            'compressor': StreamCompressor( self.compression, self.block_bytes ) if self.compression else None,
+            'bytes': 0, 'record_count': 0, 'min_bib': None, 'max_bib': None, 'sources': [] }
+        return
+
+    def append_source( self, source ):
+        """ Copies a source file into the current shard, noting its (uncompressed) offset so a reader can seek straight to it.
+            Called by consolidate() """
+        buffer = open_buffer( source['file_path'] )
+        try:
+            compressor = self.shard['compressor']
+            self.write_shard( compressor.compress(buffer[0:len(buffer)]) if compressor else buffer )
+        finally:
+            buffer.close()
+        self.shard['sources'].append( {
+            'file_name': os.path.basename( source['file_path'] ), 'offset': self.shard['bytes'], 'bytes': source['bytes'],
+            'record_count': source['record_count'], 'min_bib': source['min_bib'], 'max_bib': source['max_bib'] } )
+        self.shard['bytes'] += source['bytes']
+        self.shard['record_count'] += source['record_count']
+        if source['min_bib'] is not None:
+            self.shard['min_bib'] = source['min_bib'] if self.shard['min_bib'] is None else min( self.shard['min_bib'], source['min_bib'] )
+            self.shard['max_bib'] = source['max_bib'] if self.shard['max_bib'] is None else max( self.shard['max_bib'], source['max_bib'] )
+        return
+
+    def write_shard( self, output ):
+        """ Writes bytes, as stored, to the current shard; the sha256 covers the stored, possibly compressed, bytes.
+            Called by append_source() and close_shard() """
+        self.shard['handle'].write( output )
+        self.shard['hasher'].update( output )
+        return
+
+    def close_shard( self ):
+        """ Syncs and renames the current shard (and any block-table) into place; returns its manifest entry.
+            Called by consolidate() """
+        compressor = self.shard.pop( 'compressor' )
+        if compressor:
+            self.write_shard( compressor.flush() )
+        handle = self.shard.pop( 'handle' )
+        handle.flush()
+        os.fsync( handle.fileno() )
+        handle.close()
+        file_path = '%s/%s' % ( self.SHARD_DIR, self.shard['file_name'] )
+        if compressor:
+            write_block_table( file_path, compressor )  # before the shard, so a shard that's in place always has its table
+        os.replace( '%s.part' % file_path, file_path )
+        entry = self.shard
+        entry['sha256'] = entry.pop( 'hasher' ).hexdigest()
+        if compressor:
+            ( entry['compression'], entry['stored_bytes'], entry['block_count'] ) = ( compressor.method, compressor.compressed_bytes, len(compressor.blocks) )
+        self.shard = None
+        log.debug( 'shard written, ```%s```; `%s` records, `%s` bytes' % (file_path, entry['record_count'], entry['bytes']) )
+        return entry
+
+    def remove_stale_shards( self, shards ):
+        """ Removes shards (and block-tables) left from a previous consolidation that was larger, or compressed differently.
+            Called by consolidate() """
+        current = set( shard['file_name'] for shard in shards ) | set( '%s%s' % (shard['file_name'], BLOCKS_SUFFIX) for shard in shards if shard.get('compression') )
+        for file_path in glob.glob( '%s/sierra_shard_*.mrc*' % self.SHARD_DIR ):
+            if os.path.basename( file_path ) not in current:
+                log.debug( 'removing stale shard ```%s```' % file_path )
+                os.remove( file_path )
+        return
+
+    ## end class Consolidator()
+
+
+def shards_for_bib( manifest, bib_id ):
+    """ Returns the file-names of shards whose bib-range includes `bib_id` (an int); usually one, more if re-exports overlap.
+        For downstream readers. """
+    return [ shard['file_name'] for shard in manifest['shards']
+        if shard['min_bib'] is not None and shard['min_bib'] <= bib_id <= shard['max_bib'] ]
+
+
+if __name__ == '__main__':
+    log.debug( 'starting consolidation' )
+    consolidator = Consolidator()
+    consolidator.consolidate()
+    log.debug( 'complete' )
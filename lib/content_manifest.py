@@ -0,0 +1,212 @@
+import argparse, datetime, hashlib, heapq, json, logging, os, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import marc_file_paths, open_buffer
+from lib.marc_check import bib_number, check_record
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading content_manifest module' )
+
+## manifest layout: a '#'-prefixed json header-line, then one tab-separated line per bib, sorted by bib-number --
+##   bib-number, content-hash (hex), file (relative to the manifest), offset, length
+
+
+def parse_ignore_tags( tags_string ):
+    """ Returns the comma-separated tags (eg '005,998') as a set of bytes.
+        Called by build_manifest() callers """
+    return set( tag.strip().encode('ascii') for tag in tags_string.split(',') if tag.strip() )
+
+
+def build_manifest( file_paths, manifest_path, ignore_tags=frozenset() ):
+    """ Writes the bib -> content-hash manifest for every record in `file_paths`; returns the bib-count.
+        Memory stays bounded: files are taken in order of their first bib and scanned one at a time; each file's entries are merged into a heap,
+          and entries below the next file's lowest bib are written out. A bib present twice (eg a re-export) keeps the later file's copy.
+        Called by consolidate.Consolidator.consolidate() and `if __name__ == '__main__':` """
+    manifest_dir = os.path.dirname( os.path.abspath(manifest_path) )
+    relative_paths = [ os.path.relpath(os.path.abspath(file_path), manifest_dir) for file_path in file_paths ]
+    first_bibs = [ ( first_bib_number(file_path), file_number ) for ( file_number, file_path ) in enumerate( file_paths ) ]
+    ordered_files = sorted( entry for entry in first_bibs if entry[0] is not None )
+    header = { 'created': datetime.datetime.now().isoformat(), 'ignore_tags': sorted( tag.decode('ascii') for tag in ignore_tags ) }
+    ( pending, previous, bib_count ) = ( [], None, 0 )
+    temp_path = '%s.tmp' % manifest_path
+    with open( temp_path, 'w' ) as f:
+        f.write( '# %s\n' % json.dumps(header, sort_keys=True) )
+        for position in range( len(ordered_files) + 1 ):
+            entries = scan_file( file_paths[ordered_files[position][1]], ordered_files[position][1], ignore_tags ) if position < len( ordered_files ) else []
+            next_start = entries[0][0] if entries else None
+            while pending and ( position == len(ordered_files) or (next_start is not None and pending[0][0] < next_start) ):
+                entry = heapq.heappop( pending )
+                if previous is not None and previous[0] != entry[0]:
+                    f.write( format_line(previous, relative_paths) )
+                    bib_count += 1
+                previous = entry  # same bib again: the later file's entry replaces it
+            if next_start is not None and previous is not None and next_start < previous[0]:
+                message = 'records in ```%s``` precede bibs already written; its records are out of order; raising Exception' % file_paths[ordered_files[position][1]]
+                log.error( message )
+                raise Exception( message )
+            for entry in entries:
+                heapq.heappush( pending, entry )
+        if previous is not None:
+            f.write( format_line(previous, relative_paths) )
+            bib_count += 1
+    os.replace( temp_path, manifest_path )
+    log.info( '`%s` bibs from `%s` files in manifest ```%s```' % (bib_count, len(file_paths), manifest_path) )
+    return bib_count
+
+
+def first_bib_number( file_path ):
+    """ Returns the bib-number of the file's first record, which sierra's id-ordered output makes its lowest; None if unreadable.
+        Called by build_manifest() """
+    buffer = open_buffer( file_path )
+    try:
+        ( record_length, error, bib_id ) = check_record( buffer, 0, len(buffer), collect_bib_ids=True )
+    finally:
+        buffer.close()
+    return None if error else bib_number( bib_id )
+
+
+def scan_file( file_path, file_number, ignore_tags ):
+    """ Returns the file's ( bib-number, file-number, hash-hex, offset, length ) entries, sorted.
+        Called by build_manifest() """
+    entries = []
+    buffer = open_buffer( file_path )
+    try:
+        ( position, end_of_buffer ) = ( 0, len(buffer) )
+        while position < end_of_buffer:
+            ( record_length, error, bib_id ) = check_record( buffer, position, end_of_buffer, collect_bib_ids=True )
+            if error:
+                log.warning( 'stopped hashing ```%s``` at offset `%s`, ```%s```' % (file_path, position, error) )
+                break
+            number = bib_number( bib_id )
+            if number is not None:
+                entries.append( (number, file_number, hash_record(buffer, position, record_length, ignore_tags), position, record_length) )
+            position += record_length
+    finally:
+        buffer.close()
+    entries.sort()
+    return entries
+
+
+def hash_record( buffer, position, record_length, ignore_tags ):
+    """ Returns the record's content-hash; with `ignore_tags`, those fields -- and the leader's lengths, which they'd shift -- are left out.
+        Called by scan_file() """
+    hasher = hashlib.blake2b( digest_size=16 )
+    if not ignore_tags:
+        hasher.update( buffer[position:position + record_length] )
+        return hasher.hexdigest()
+    hasher.update( buffer[position + 5:position + 12] )
+    hasher.update( buffer[position + 17:position + 24] )
+    base_address = int( buffer[position + 12:position + 17] )
+    ( directory, data_start ) = ( buffer[position + 24:position + base_address - 1], position + base_address )
+    for entry in range( 0, len(directory), 12 ):
+        tag = directory[entry:entry + 3]
+        if tag in ignore_tags:
+            continue
+        ( field_length, field_start ) = ( int(directory[entry + 3:entry + 7]), int(directory[entry + 7:entry + 12]) )
+        hasher.update( tag )
+        hasher.update( buffer[data_start + field_start:data_start + field_start + field_length] )  # includes the field-terminator, so fields can't run together
+    return hasher.hexdigest()
+
+
+def format_line( entry, relative_paths ):
+    """ Returns the manifest line for an entry.
+        Called by build_manifest() """
+    ( number, file_number, content_hash, offset, length ) = entry
+    return '%s\t%s\t%s\t%s\t%s\n' % ( number, content_hash, relative_paths[file_number], offset, length )
+
+
+def read_manifest( manifest_path ):
+    """ Yields ( bib-number, content-hash, file_path, offset, length ) in bib-order, one line at a time.
+        Called by diff_manifests() """
+    manifest_dir = os.path.dirname( os.path.abspath(manifest_path) )
+    with open( manifest_path, 'r' ) as f:
+        for line in f:
+            if line.startswith( '#' ):
+                continue
+            ( number, content_hash, relative_path, offset, length ) = line.rstrip( '\n' ).split( '\t' )
+            yield ( int(number), content_hash, os.path.join(manifest_dir, relative_path), int(offset), int(length) )
+
+
+def diff_manifests( old_manifest_path, new_manifest_path, output_dir ):
+    """ Merge-joins two manifests, writing `added.txt`, `changed.txt`, and `deleted.txt` (bib-numbers, one per line),
+          and `updates.mrc` holding the new export's added and changed records. Memory is bounded: one line of each manifest at a time.
+        Returns the counts.
+        Called by `if __name__ == '__main__':` """
+    counts = { 'added': 0, 'changed': 0, 'deleted': 0, 'unchanged': 0 }
+    handles = { name: open('%s/%s.txt' % (output_dir, name), 'w') for name in ('added', 'changed', 'deleted') }
+    reader = RecordReader()
+    updates_path = '%s/updates.mrc' % output_dir
+    try:
+        with open( '%s.part' % updates_path, 'wb' ) as updates:
+            ( old_lines, new_lines ) = ( read_manifest(old_manifest_path), read_manifest(new_manifest_path) )
+            ( old, new ) = ( next(old_lines, None), next(new_lines, None) )
+            while old is not None or new is not None:
+                if new is None or ( old is not None and old[0] < new[0] ):
+                    outcome = 'deleted'
+                    handles[outcome].write( '%s\n' % old[0] )
+                    old = next( old_lines, None )
+                else:
+                    if old is None or new[0] < old[0]:
+                        outcome = 'added'
+                    else:
+                        outcome = 'unchanged' if old[1] == new[1] else 'changed'
+                        old = next( old_lines, None )
+                    if outcome != 'unchanged':
+                        handles[outcome].write( '%s\n' % new[0] )
+                        updates.write( reader.read(new[2], new[3], new[4]) )
+                    new = next( new_lines, None )
+                counts[outcome] += 1
+        os.replace( '%s.part' % updates_path, updates_path )
+    finally:
+        reader.close()
+        for handle in handles.values():
+            handle.close()
+    log.info( 'diff of ```%s``` -> ```%s```, ```%s```' % (old_manifest_path, new_manifest_path, counts) )
+    return counts
+
+
+class RecordReader( object ):
+    """ Reads raw records by file/offset/length, keeping one marc file open (mmapped, or block-decompressed) at a time --
+          manifests are in bib-order, so reads move through the files in turn.
+        Used by diff_manifests() """
+
+    def __init__( self ):
+        ( self.file_path, self.buffer ) = ( None, None )
+
+    def read( self, file_path, offset, length ):
+        """ Returns the record's bytes.
+            Called by diff_manifests() """
+        if file_path != self.file_path:
+            self.close()
+            ( self.file_path, self.buffer ) = ( file_path, open_buffer(file_path) )
+        return self.buffer[offset:offset + length]
+
+    def close( self ):
+        """ Releases the current file.
+            Called by read() and diff_manifests() """
+        if self.buffer is not None:
+            self.buffer.close()
+        ( self.file_path, self.buffer ) = ( None, None )
+        return
+
+    ## end class RecordReader()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='Builds or compares per-record content-hash manifests.' )
+    parser.add_argument( '--diff', nargs=3, metavar=('OLD_MANIFEST', 'NEW_MANIFEST', 'OUTPUT_DIR'), help='write added/changed/deleted lists and updates.mrc' )
+    args = parser.parse_args()
+    if args.diff:
+        log.debug( 'starting manifest diff' )
+        diff_manifests( *args.diff )
+    else:
+        log.debug( 'starting manifest build for download-directory' )
+        build_manifest(
+            marc_file_paths( os.environ['SBE__FILE_DOWNLOAD_DIR'] ), os.environ['SBE__CONTENT_MANIFEST_PATH'],
+            parse_ignore_tags( os.environ.get('SBE__MANIFEST_IGNORE_TAGS', '') ) )
+    log.debug( 'complete' )
@@ -0,0 +1,129 @@
+import datetime, json, logging, os, pprint
+from lib.auth import get_token_manager
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading delta module' )
+
+
+class DeltaHelper( object ):
+    """ Manages the delta-export tracker: only bibs created/updated since the previous run are exported, and deletions are listed.
+        The delta tracker has the same shape as tracker.json, with batches carrying explicit `bib_ids`. """
+
+    def __init__( self ):
+        self.API_ROOT_URL = os.environ['SBE__ROOT_URL']
+        self.FULL_TRACKER_FILEPATH = os.environ['SBE__TRACKER_JSON_PATH']
+        self.DELTA_TRACKER_FILEPATH = os.environ['SBE__DELTA_TRACKER_JSON_PATH']
+        self.DELTA_DOWNLOAD_DIR = os.environ['SBE__DELTA_DOWNLOAD_DIR']
+        self.batch_size = int( os.environ.get('SBE__DELTA_BATCH_SIZE', '500') )  # ids per request; bounded by url-length, not the 2000-record limit
+        self.deletes_file_name = 'sierra_delta_deletes.txt'
+        self.token_manager = get_token_manager()
+
+    def grab_delta_tracker( self, tracker_helper, start_new=False ):
+        """ Returns the in-progress delta tracker, or prepares a new one if there's none yet.
+            A complete delta is returned as-is -- its files stay in the download-dir for consumers -- unless `start_new` is set (`--new-delta`),
+              since preparing the next one clears the directory; cron can then keep re-running `--delta` harmlessly.
+            `tracker_helper` has been pointed at the delta tracker-path and download-dir by the controller.
+            Called by controller.check_tracker_file() """
+        previous = None
+        try:
+            with open( self.DELTA_TRACKER_FILEPATH, 'rb' ) as f:
+                previous = json.loads( f.read() )
+        except Exception as e:
+            log.warning( 'no delta tracker, ```%s```; will create one' % e )
+        if previous and [ entry for entry in previous['batches'] if entry['last_grabbed'] is None ]:
+            log.debug( 'resuming in-progress delta' )
+            return previous
+        if previous and not start_new:
+            log.debug( 'previous delta complete; a new one is started only with `--new-delta`' )
+            return previous
+        since = self.determine_since( previous )
+        tracker_helper.clear_download_directory()
+        tracker = self.prepare_delta_tracker( since )
+        with open( self.DELTA_TRACKER_FILEPATH, 'wb' ) as f:
+            f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+        return tracker
+
+    def determine_since( self, previous ):
+        """ Returns the utc timestamp to query changes from: the previous delta's start, else the full export's start.
+            The full export's start is its earliest batch-grab, which is conservative -- records updated mid-export are re-exported.
+            Called by grab_delta_tracker() """
+        if previous:
+            local_since = previous['run_started']
+        else:
+            with open( self.FULL_TRACKER_FILEPATH, 'rb' ) as f:
+                full_tracker = json.loads( f.read() )
+            grab_dates = [ entry['last_grabbed'] for entry in full_tracker['batches'] if entry['last_grabbed'] ]
+            local_since = min( grab_dates ) if grab_dates else full_tracker['last_updated']
+        local_since = local_since[0:19].replace( ' ', 'T' )  # baseline trackers wrote `last_updated` as str( datetime.now() )
+        since = datetime.datetime.strptime( local_since, '%Y-%m-%dT%H:%M:%S' ).astimezone( datetime.timezone.utc )
+        log.debug( 'since, `%s`' % since.isoformat() )
+        return since.strftime( '%Y-%m-%dT%H:%M:%SZ' )
+
+    def prepare_delta_tracker( self, since ):
+        """ Queries changed and deleted bib-ids, packs the changed ones into batches, and writes the deletes-list.
+            Called by grab_delta_tracker() """
+        run_started = datetime.datetime.now().isoformat()
+        changed_ids = set( self.query_bib_ids('updatedDate', since) )
+        changed_ids.update( self.query_bib_ids('createdDate', since) )
+        deleted_ids = self.query_bib_ids( 'deletedDate', since, deleted=True )
+        changed_ids.difference_update( deleted_ids )
+        self.write_deletes_file( deleted_ids )
+        batches = []
+        sorted_ids = sorted( changed_ids )
+        for ( file_count, position ) in enumerate( range(0, len(sorted_ids), self.batch_size) ):
+            bib_ids = sorted_ids[position:position+self.batch_size]
+            batches.append( {
+                'chunk_start_bib': bib_ids[0], 'chunk_end_bib': bib_ids[-1], 'bib_ids': bib_ids, 'last_grabbed': None,
+                'file_name': 'sierra_delta_%s.mrc' % str(file_count).rjust( 4, '0' ) } )
+        tracker = {
+            'mode': 'delta', 'since': since, 'run_started': run_started, 'last_updated': run_started, 'last_bib': None,
+            'batches': batches, 'deletes_file_name': self.deletes_file_name, 'deleted_count': len(deleted_ids), 'files_validated': False }
+        log.info( '`%s` changed bibs in `%s` batches; `%s` deleted bibs' % (len(sorted_ids), len(batches), len(deleted_ids)) )
+        return tracker
+
+    def query_bib_ids( self, date_field, since, deleted=False ):
+        """ Pages the bibs endpoint for ids whose `date_field` is on or after `since`; returns them as ints.
+            `deletedDate` is a day, not a timestamp, so it's queried from `since`'s (utc) date -- the whole day, which errs toward listing more deletes.
+            Called by prepare_delta_tracker() """
+        if date_field == 'deletedDate':
+            since = since[0:10]
+        ( bib_url, bib_ids, next_id ) = ( '%sbibs/' % self.API_ROOT_URL, [], None )
+        while True:
+            payload = { 'limit': '2000', 'fields': 'id', date_field: '[%s,]' % since }
+            if deleted:
+                payload['deleted'] = 'true'
+            if next_id:
+                payload['id'] = '[%s,]' % next_id
+            r = self.token_manager.authorized_get( bib_url, endpoint='bibs', params=payload )
+            if r.status_code == 404:  # sierra's answer to an empty result-set
+                break
+            if r.status_code != 200:
+                message = 'bad status querying `%s`, `%s`; raising Exception' % ( date_field, r.status_code )
+                log.error( message )
+                raise Exception( message )
+            entries = r.json().get( 'entries', [] )
+            bib_ids.extend( int(entry['id']) for entry in entries )
+            if len( entries ) < 2000:
+                break
+            next_id = int( entries[-1]['id'] ) + 1
+        log.debug( '`%s` ids for `%s` since `%s`' % (len(bib_ids), date_field, since) )
+        return bib_ids
+
+    def write_deletes_file( self, deleted_ids ):
+        """ Writes deleted bib-ids, one per line, for downstream consumers to remove.
+            Called by prepare_delta_tracker() """
+        filepath = '%s/%s' % ( self.DELTA_DOWNLOAD_DIR, self.deletes_file_name )
+        with open( filepath, 'w' ) as f:
+            f.write( ''.join('%s\n' % bib_id for bib_id in sorted(deleted_ids)) )
+        log.debug( 'deletes written to ```%s```' % filepath )
+        return
+
+    ## end class DeltaHelper()
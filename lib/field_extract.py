@@ -0,0 +1,145 @@
+import datetime, json, logging, os, sqlite3, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import marc_file_paths, open_buffer
+from lib.marc_check import SUBFIELD_DELIMITER, bib_number, check_record
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading field_extract module' )
+
+## db layout --
+##   records( bib, file_name, offset, length ) -- one row per bib; a later file's copy (eg a re-export) replaces an earlier one
+##   fields( bib, tag, occurrence, code, value ) -- one row per extracted subfield; control-fields have code ''
+##   meta( key, value )
+DEFAULT_FIELD_SPECS = '008,907bc,998abcd,945ly'  # fixed-data; sierra record-dates; bib cat-date & locations; item locations & record-numbers
+MAX_BIB_NUMBER = 10 ** 7  # bib-numbers are seven digits
+SUBFIELD_SEPARATOR = bytes( [SUBFIELD_DELIMITER] )
+
+
+def parse_field_specs( specs_string ):
+    """ Returns { tag-bytes: set of subfield-code bytes, or None for all } from eg '008,907bc,998'; a tag listed twice gets the union.
+        Called by extract_fields() callers """
+    specs = {}
+    for spec in [ spec.strip() for spec in specs_string.split(',') if spec.strip() ]:
+        ( tag, codes ) = ( spec[0:3].encode('ascii'), set(code.encode('ascii') for code in spec[3:]) )
+        if not codes or specs.get( tag, set() ) is None:
+            specs[tag] = None
+        else:
+            specs[tag] = specs.get( tag, set() ) | codes
+    return specs
+
+
+def extract_fields( file_paths, db_path, specs, batch_rows=50000 ):
+    """ Reads each marc file once, via compression.open_buffer(), and bulk-inserts the specified tags/subfields per bib into an indexed SQLite file; returns the record-count.
+        The db is built as a temp-file -- without journaling, since a failed build is simply discarded -- then renamed into place, so consumers always see
+          a complete db. Rows are inserted `batch_rows` at a time, in one transaction each. The bib-index is created up front, since consecutive range-batches
+          share their boundary bib, so nearly every file replaces one earlier bib's rows; the tag/code/value index is built once loaded.
+        Called by `if __name__ == '__main__':` """
+    start = datetime.datetime.now()
+    temp_path = '%s.tmp' % db_path
+    if os.path.exists( temp_path ):
+        os.remove( temp_path )
+    connection = sqlite3.connect( temp_path )
+    connection.execute( 'PRAGMA journal_mode=OFF' )
+    connection.execute( 'PRAGMA synchronous=OFF' )
+    connection.execute( 'CREATE TABLE meta ( key TEXT PRIMARY KEY, value TEXT )' )
+    connection.execute( 'CREATE TABLE records ( bib INTEGER PRIMARY KEY, file_name TEXT, offset INTEGER, length INTEGER )' )
+    connection.execute( 'CREATE TABLE fields ( bib INTEGER, tag TEXT, occurrence INTEGER, code TEXT, value TEXT )' )
+    connection.execute( 'CREATE INDEX fields_bib ON fields ( bib )' )
+    ( record_rows, field_rows, record_count, replaced_count ) = ( [], [], 0, 0 )
+    seen = bytearray( MAX_BIB_NUMBER // 8 + 1 )  # bitmap of bibs inserted so far; a re-exported bib's earlier rows are deleted
+    for file_path in file_paths:
+        file_name = os.path.basename( file_path )
+        for ( number, offset, length, rows ) in scan_records( file_path, specs ):
+            if seen[number >> 3] & ( 1 << (number & 7) ):
+                write_rows( connection, record_rows, field_rows )
+                ( record_rows, field_rows ) = ( [], [] )
+                connection.execute( 'DELETE FROM fields WHERE bib = ?', (number,) )  # about once per file; uses fields_bib
+                replaced_count += 1
+            seen[number >> 3] |= 1 << ( number & 7 )
+            record_rows.append( (number, file_name, offset, length) )
+            field_rows.extend( rows )
+            record_count += 1
+            if len( field_rows ) >= batch_rows:
+                write_rows( connection, record_rows, field_rows )
+                ( record_rows, field_rows ) = ( [], [] )
+    write_rows( connection, record_rows, field_rows )
+    with connection:
+        connection.execute( 'CREATE INDEX fields_tag_code_value ON fields ( tag, code, value )' )
+        connection.executemany( 'INSERT INTO meta ( key, value ) VALUES ( ?, ? )', [
+            ('created', json.dumps(datetime.datetime.now().isoformat())), ('record_count', json.dumps(record_count)),
+            ('field_specs', json.dumps({tag.decode('ascii'): (sorted(code.decode('ascii') for code in codes) if codes else None) for ( tag, codes ) in specs.items()})),
+            ('file_names', json.dumps([os.path.basename(file_path) for file_path in file_paths])) ] )
+    connection.execute( 'ANALYZE' )
+    connection.close()
+    os.replace( temp_path, db_path )
+    log.info( '`%s` records (`%s` replaced by later files) from `%s` files extracted into ```%s```; time_taken, `%s`' % (
+        record_count, replaced_count, len(file_paths), db_path, datetime.datetime.now() - start) )
+    return record_count
+
+
+def write_rows( connection, record_rows, field_rows ):
+    """ Inserts a batch of rows in one transaction.
+        Called by extract_fields() """
+    with connection:
+        connection.executemany( 'INSERT OR REPLACE INTO records ( bib, file_name, offset, length ) VALUES ( ?, ?, ?, ? )', record_rows )
+        connection.executemany( 'INSERT INTO fields ( bib, tag, occurrence, code, value ) VALUES ( ?, ?, ?, ?, ? )', field_rows )
+    return
+
+
+def scan_records( file_path, specs ):
+    """ Yields ( bib-number, offset, length, field-rows ) for each structurally-valid record; stops at the first bad one.
+        Called by extract_fields() """
+    buffer = open_buffer( file_path )
+    try:
+        ( position, end_of_buffer ) = ( 0, len(buffer) )
+        while position < end_of_buffer:
+            ( record_length, error, bib_id ) = check_record( buffer, position, end_of_buffer, collect_bib_ids=True )
+            if error:
+                log.warning( 'stopped extracting ```%s``` at offset `%s`, ```%s```' % (file_path, position, error) )
+                break
+            number = bib_number( bib_id )
+            if number is not None:
+                yield ( number, position, record_length, extract_record(buffer, position, number, specs) )
+            position += record_length
+    finally:
+        buffer.close()
+
+
+def extract_record( buffer, position, number, specs ):
+    """ Returns the record's ( bib, tag, occurrence, code, value ) rows for the specified tags; walks the directory, so unwanted fields aren't decoded.
+        Called by scan_records() """
+    rows = []
+    base_address = int( buffer[position + 12:position + 17] )
+    ( directory, data_start ) = ( buffer[position + 24:position + base_address - 1], position + base_address )
+    occurrences = {}
+    for entry in range( 0, len(directory), 12 ):
+        tag = directory[entry:entry + 3]
+        if tag not in specs:
+            continue
+        ( field_length, field_start ) = ( int(directory[entry + 3:entry + 7]), int(directory[entry + 7:entry + 12]) )
+        field = buffer[data_start + field_start:data_start + field_start + field_length - 1]  # drops the field-terminator
+        occurrence = occurrences[tag] = occurrences.get( tag, 0 ) + 1
+        tag_text = tag.decode( 'ascii', 'replace' )
+        if tag < b'010':
+            rows.append( (number, tag_text, occurrence, '', field.decode('utf-8', 'replace')) )
+            continue
+        for subfield in field.split( SUBFIELD_SEPARATOR )[1:]:  # the first part holds the indicators
+            code = subfield[0:1]
+            if code and ( specs[tag] is None or code in specs[tag] ):
+                rows.append( (number, tag_text, occurrence, code.decode('ascii', 'replace'), subfield[1:].decode('utf-8', 'replace')) )
+    return rows
+
+
+if __name__ == '__main__':
+    log.debug( 'starting field-extraction for download-directory' )
+    extract_fields(
+        marc_file_paths( os.environ['SBE__FILE_DOWNLOAD_DIR'] ), os.environ['SBE__FIELD_DB_PATH'],
+        parse_field_specs( os.environ.get('SBE__EXTRACT_FIELDS', DEFAULT_FIELD_SPECS) ),
+        int( os.environ.get('SBE__EXTRACT_BATCH_ROWS', '50000') ) )
+    log.debug( 'complete' )
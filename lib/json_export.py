@@ -0,0 +1,141 @@
+import glob, gzip, json, logging, os, sys
+import requests
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.auth import get_token_manager
+from lib.scheduler import BackoffRequired, RateLimitExceeded, RateLimitScheduler
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading json_export module' )
+
+
+class JsonExporter( object ):
+    """ Exports bib data by paging the json `bibs/` endpoint, instead of requesting a `bibs/marc` file-job and then downloading the file.
+        Each batch's entries are streamed, one json object per line, into a gzip member appended to the current `sierra_bibs_NNNN.jsonl.gz` shard;
+          concatenated gzip members read back as one stream, so the shards are ordinary .jsonl.gz files. Memory is bounded by one page.
+        The tracker notes each batch's shard, offset, and length, so a crash is recovered by truncating the shard to its last recorded batch. """
+
+    def __init__( self ):
+        self.JSON_TRACKER_FILEPATH = os.environ['SBE__JSON_TRACKER_JSON_PATH']
+        self.JSON_EXPORT_DIR = os.environ['SBE__JSON_EXPORT_DIR']
+        self.fields = os.environ.get( 'SBE__JSON_FIELDS', 'default,fixedFields,varFields' )  # eg add `marc` for marc-in-json
+        self.page_size = int( os.environ.get('SBE__JSON_PAGE_SIZE', '500') )  # entries per request; at most 2000
+        self.shard_max_bytes = int( os.environ.get('SBE__JSON_SHARD_MAX_BYTES', str(256 * 1024 * 1024)) )  # compressed
+        self.token_manager = get_token_manager()
+        self.scheduler = RateLimitScheduler()  # the json endpoint's budget is learned separately from `bibs/marc`'s
+        self.bib_url = '%sbibs/' % self.token_manager.API_ROOT_URL
+        ( self.shard_number, self.shard_end ) = ( 0, 0 )  # see recover_shards()
+
+    def recover_shards( self, tracker ):
+        """ Finds the shard to append to from the tracker's recorded batches, truncating any bytes a crashed run wrote past the last one,
+              and removing shards no batch refers to.
+            Called by controller.manage_json_download() """
+        ends = {}
+        for entry in tracker['batches']:
+            if entry.get( 'json_shard', None ):
+                ends[ entry['json_shard'] ] = max( ends.get(entry['json_shard'], 0), entry['json_offset'] + entry['json_bytes'] )
+        self.shard_number = max( [int(name.split('_')[-1].split('.')[0]) for name in ends] or [0] )
+        self.shard_end = ends.get( self.shard_name(self.shard_number), 0 )
+        for file_path in glob.glob( '%s/sierra_bibs_*.jsonl.gz' % self.JSON_EXPORT_DIR ):
+            file_name = os.path.basename( file_path )
+            if file_name not in ends and file_name != self.shard_name( self.shard_number ):
+                log.debug( 'removing unrecorded shard ```%s```' % file_path )
+                os.remove( file_path )
+            elif os.path.getsize( file_path ) > ends.get( file_name, 0 ):
+                log.warning( 'truncating ```%s``` to its last recorded batch, at `%s`' % (file_path, ends.get(file_name, 0)) )
+                os.truncate( file_path, ends.get(file_name, 0) )
+        log.debug( 'appending to `%s` at `%s`' % (self.shard_name(self.shard_number), self.shard_end) )
+        return
+
+    def shard_name( self, shard_number ):
+        """ Returns the shard's file-name.
+            Called by recover_shards() and export_batch() """
+        return 'sierra_bibs_%s.jsonl.gz' % str( shard_number ).rjust( 4, '0' )
+
+    def export_batch( self, batch ):
+        """ Pages the batch's bibs into a new gzip member at the end of the current shard; returns stats for the tracker.
+            On any error, including BackoffRequired, the shard is truncated back to where the batch started, and the batch stays un-grabbed.
+            Called by controller.manage_json_download() """
+        if self.shard_end >= self.shard_max_bytes:
+            ( self.shard_number, self.shard_end ) = ( self.shard_number + 1, 0 )
+        shard_path = '%s/%s' % ( self.JSON_EXPORT_DIR, self.shard_name(self.shard_number) )
+        record_count = 0
+        with open( shard_path, 'ab' ) as shard_handle:
+            start_offset = shard_handle.tell()
+            try:
+                with gzip.GzipFile( fileobj=shard_handle, mode='wb', compresslevel=6 ) as gzip_handle:
+                    for entries in self.iterate_pages( batch ):
+                        gzip_handle.write( ''.join('%s\n' % json.dumps(entry, sort_keys=True) for entry in entries).encode('utf-8') )
+                        record_count += len( entries )
+                shard_handle.flush()
+                os.fsync( shard_handle.fileno() )
+            except BaseException:
+                shard_handle.truncate( start_offset )
+                raise
+            self.shard_end = shard_handle.tell()
+        file_stats = {
+            'outcome': 'ok' if record_count else 'zero_records', 'record_count': record_count,
+            'json_shard': self.shard_name( self.shard_number ), 'json_offset': start_offset, 'json_bytes': self.shard_end - start_offset }
+        log.debug( 'batch `%s` exported, ```%s```' % (batch['file_name'], file_stats) )
+        return file_stats
+
+    def iterate_pages( self, batch ):
+        """ Yields the batch's entries a page at a time: by id-list for batches carrying `bib_ids`, else by range.
+            Called by export_batch()
+            Note: raising BackoffRequired is a normal part of the operation of this code; the controller exits or waits. """
+        if batch.get( 'bib_ids', None ):
+            for position in range( 0, len(batch['bib_ids']), self.page_size ):
+                page_ids = batch['bib_ids'][position:position + self.page_size]
+                entries = self.request_page( { 'id': ','.join(str(bib_id) for bib_id in page_ids), 'limit': len(page_ids) } )
+                if entries:
+                    yield entries
+            return
+        next_id = batch['chunk_start_bib']
+        while next_id <= batch['chunk_end_bib']:
+            entries = self.request_page( { 'id': '[%s,%s]' % (next_id, batch['chunk_end_bib']), 'limit': self.page_size } )
+            if not entries:
+                return
+            yield entries
+            if len( entries ) < self.page_size:
+                return
+            next_id = int( entries[-1]['id'] ) + 1
+
+    def request_page( self, payload ):
+        """ Returns one page of entries; an empty list for sierra's 404 empty-result.
+            A timed-out or dropped request raises BackoffRequired, as sierra.MarcHelper.make_bibrange_request() does, so the batch is retried.
+            Called by iterate_pages() """
+        payload.update( {'fields': self.fields} )
+        self.scheduler.acquire()
+        try:
+            r = self.token_manager.authorized_get( self.bib_url, endpoint='bibs_json', params=payload )
+        except ( requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError ) as e:
+            log.warning( 'request failed, ```%s```; raising BackoffRequired' % e )
+            raise BackoffRequired( 'requests-%s' % e.__class__.__name__, self.scheduler.default_wait_seconds )
+        if r.status_code == 404:
+            return []
+        if r.status_code == 200:
+            return r.json().get( 'entries', [] )
+        try:
+            response_message = r.json()['name']
+        except Exception as e:
+            message = 'could not read response-message, ```%s```; raising BackoffRequired' % e
+            log.warning( message )
+            raise BackoffRequired( message, self.scheduler.default_wait_seconds )
+        if response_message == 'Rate exceeded for endpoint':
+            wait_seconds = self.scheduler.parse_wait_seconds( r )
+            self.scheduler.record_rate_limited( wait_seconds )
+            message = 'found response "%s"; estimated wait, `%s` seconds; raising RateLimitExceeded' % ( response_message, wait_seconds )
+            log.warning( message )
+            raise RateLimitExceeded( message, wait_seconds )
+        message = 'unhandled bibs-response, `%s`, ```%s```; raising Exception' % ( r.status_code, r.content )
+        log.error( message )
+        raise Exception( message )
+
+    ## end class JsonExporter()
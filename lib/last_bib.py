@@ -1,11 +1,15 @@
 '''
 SBE__ prefix for "Sierra API Experiementation"
 Code to reliably grab the truly last bib.
+Importable -- `update_last_bib()` -- or run directly, as the cron script does.
 '''
 
 import datetime, json, logging, os, pprint, sys
 import requests
 from requests.auth import HTTPBasicAuth
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.auth import get_token_manager
+from lib.client import get_http_client
 
 logging.basicConfig(
     filename=os.environ['SBE__LOG_PATH'],
@@ -14,104 +18,112 @@ logging.basicConfig(
     datefmt='%d/%b/%Y %H:%M:%S'
     )
 log = logging.getLogger(__name__)
-log.debug( '\n-------\nstarting standard log' )
+log.debug( 'loading last_bib module' )
 
 if (sys.version_info < (3, 0)):
     raise Exception( 'forcing myself to use python3 always' )
 
-API_ROOT_URL = os.environ['SBE__ROOT_URL']
-HTTPBASIC_KEY = os.environ['SBE__HTTPBASIC_USERNAME']
-HTTPBASIC_SECRET = os.environ['SBE__HTTPBASIC_PASSWORD']
-LASTBIB_JSON_PATH = os.environ['SBE__LASTBIB_JSON_PATH']
-
-# ===================================
-# get token
-# ===================================
-
-token_url = '%stoken' % API_ROOT_URL
-log.debug( 'token_url, ```%s```' % token_url )
-r = requests.post( token_url, auth=HTTPBasicAuth(HTTPBASIC_KEY, HTTPBASIC_SECRET) )
-log.debug( 'token r.content, ```%s```' % r.content )
-token = r.json()['access_token']
-log.debug( 'token, ```%s```' % token )
-custom_headers = {'Authorization': 'Bearer %s' % token }  # for use in subsequent request
-
-# ===================================
-# get api last bib data
-# ===================================
-
-log.debug( '\n-------\ngetting end-bib\n-------' )
-bib_url = '%sbibs/' % API_ROOT_URL
-
-## make last_week_date
-last_week_date = datetime.date.today() + datetime.timedelta( days=-7 )
-
-## create start_datetime
-start_datetime = '%sT00:00:00Z' % last_week_date.isoformat()
-
-## loop
-( temp_last_bib, actual_last_bib, iteration_count ) = ( None, None, 0 )
-while actual_last_bib is None:
-    iteration_count += 1
-    ## create payload
-    payload = {
-        'limit': '2000', 'suppressed': False, 'fields': 'id', 'createdDate': '[%s,]' % start_datetime  }
-    if temp_last_bib:
-        payload['id'] = '[%s,]' % temp_last_bib
-    log.debug( 'iteration_count, `%s`; payload, ```%s```' % (iteration_count, pprint.pformat(payload)) )
-    ## make request
-    r = requests.get( bib_url, headers=custom_headers, params=payload )
-    log.debug( 'bib r.content, ```%s```' % r.content )
-    tmp_bib_jdct = r.json()
-    ## check results
-    count_returned = tmp_bib_jdct['total']
-    if count_returned < 2000:  # we're done
-        actual_last_bib = tmp_bib_jdct['entries'][-1]['id']
-    else:
-        temp_last_bib = tmp_bib_jdct['entries'][-1]['id']
-    log.debug( 'temp_last_bib, `%s`; actual_last_bib, `%s`' % (temp_last_bib, actual_last_bib) )
-
-log.debug( 'out of loop -- temp_last_bib, `%s`; actual_last_bib, `%s`' % (temp_last_bib, actual_last_bib) )
-
-## actually get last-bib
-payload = {
-    'limit': '1', 'suppressed': False, 'id': actual_last_bib  }
-log.debug( 'payload, ```%s```' % payload )
-r = requests.get( bib_url, headers=custom_headers, params=payload )
-bib_jdct = r.json()['entries'][0]
-log.debug( 'bib_jdct, ```%s```' % pprint.pformat(bib_jdct) )
-
-# ===================================
-# get local last bib data
-# ===================================
-
-stored_lastbib = None
-try:
-    with open( LASTBIB_JSON_PATH ) as f:
-        stored_lastbib_data = json.loads( f.read() )
-        # stored_lastbib = stored_lastbib_data['entries'][0]['id']
-        stored_lastbib = stored_lastbib_data['id']
-    log.debug( 'stored_lastbib, `%s`' % stored_lastbib )
-except Exception as e:
-    log.error( 'exception getting stored_lastbib, ```%s```' % str(e) )
-    pass
-
-# ===================================
-# compare and act
-# ===================================
-
-keep_flag = True
-if stored_lastbib is None:
-    log.debug( 'could not determine stored_lastbib' )
-    keep_flag = False
-elif stored_lastbib:
-    if actual_last_bib > stored_lastbib:
-        log.debug( 'overwriting stored data' )
-        keep_flag = False
-if not keep_flag:
-    with open( LASTBIB_JSON_PATH, 'w+' ) as f:
-        bib_jdct['updated_with_api_data'] = datetime.datetime.now().isoformat()
+FIRST_BIB_ID = 1000000
+INITIAL_GALLOP_STEP = 1024
+
+
+def update_last_bib():
+    """ Finds the api's last bib, and overwrites the stored last_bib.json if it's newer (or unreadable); returns the last-bib id.
+        Called by `if __name__ == '__main__':`, ie the cron script """
+    api_root_url = os.environ['SBE__ROOT_URL']
+    lastbib_json_path = os.environ['SBE__LASTBIB_JSON_PATH']
+    token_manager = get_token_manager( api_root_url, os.environ['SBE__HTTPBASIC_USERNAME'], os.environ['SBE__HTTPBASIC_PASSWORD'] )  # re-uses the disk-cached token if SBE__TOKEN_CACHE_PATH is set
+    stored_lastbib = read_stored_last_bib( lastbib_json_path )
+    actual_last_bib = find_last_bib_id( token_manager, api_root_url, lower_bound=stored_lastbib )
+    if stored_lastbib is not None and actual_last_bib <= stored_lastbib:
+        log.debug( 'no need to overwrite' )
+        return actual_last_bib
+    bib_jdct = grab_bib( token_manager, api_root_url, actual_last_bib )
+    bib_jdct['updated_with_api_data'] = datetime.datetime.now().isoformat()
+    temp_path = '%s.tmp' % lastbib_json_path
+    with open( temp_path, 'w' ) as f:
         f.write( json.dumps(bib_jdct, sort_keys=True, indent=2) )
+    os.replace( temp_path, lastbib_json_path )
     log.debug( 'overwrite successful' )
-else:
-    log.debug( 'no need to overwrite' )
+    log.debug( 'connection_stats, ```%s```' % get_http_client().connection_stats() )
+    return actual_last_bib
+
+
+def read_stored_last_bib( lastbib_json_path ):
+    """ Returns the stored last-bib id as an int, or None.
+        Called by update_last_bib() """
+    stored_lastbib = None
+    try:
+        with open( lastbib_json_path ) as f:
+            stored_lastbib = int( json.loads(f.read())['id'] )
+        log.debug( 'stored_lastbib, `%s`' % stored_lastbib )
+    except Exception as e:
+        log.error( 'exception getting stored_lastbib, ```%s```' % str(e) )
+    return stored_lastbib
+
+
+def find_last_bib_id( token_manager, api_root_url, lower_bound=None ):
+    """ Returns the highest unsuppressed bib-id, in O(log n) one-id probes instead of paging through recent bibs 2000 at a time.
+        Gallops up from `lower_bound` (normally the stored last-bib, since ids only grow), doubling the step until a probe finds nothing,
+          then binary-searches the gap. Each probe returns the first id at or above its start, so every hit also raises the floor.
+        Called by update_last_bib() """
+    bib_url = '%sbibs/' % api_root_url
+    probe_count = 1
+    low = probe_next_bib_id( token_manager, bib_url, lower_bound or FIRST_BIB_ID )
+    if low is None and lower_bound:  # the stored last-bib, and everything after it, has been deleted or suppressed
+        log.warning( 'no bib at or after lower_bound `%s`; searching from the start' % lower_bound )
+        ( low, probe_count ) = ( probe_next_bib_id(token_manager, bib_url, FIRST_BIB_ID), probe_count + 1 )
+    if low is None:
+        message = 'no bibs found; raising Exception'
+        log.error( message )
+        raise Exception( message )
+    step = INITIAL_GALLOP_STEP
+    while True:  # gallop: find a start with no bib at or above it
+        probe_count += 1
+        found = probe_next_bib_id( token_manager, bib_url, low + step )
+        if found is None:
+            high = low + step
+            break
+        ( low, step ) = ( found, step * 2 )
+    while high - low > 1:  # invariant: `low` exists; nothing at or above `high`
+        probe_count += 1
+        middle = ( low + high ) // 2
+        found = probe_next_bib_id( token_manager, bib_url, middle )
+        if found is None:
+            high = middle
+        else:
+            low = found
+    log.debug( 'last bib, `%s`; lower_bound, `%s`; probes, `%s`' % (low, lower_bound, probe_count) )
+    return low
+
+
+def probe_next_bib_id( token_manager, bib_url, start_id ):
+    """ Returns the first unsuppressed bib-id at or above `start_id`, or None.
+        Called by find_last_bib_id() """
+    payload = { 'limit': '1', 'suppressed': False, 'fields': 'id', 'id': '[%s,]' % start_id }
+    r = token_manager.authorized_get( bib_url, endpoint='bibs', params=payload )
+    if r.status_code == 404:  # sierra's answer to an empty result-set
+        return None
+    if r.status_code != 200:
+        message = 'bad status probing from `%s`, `%s`; raising Exception' % ( start_id, r.status_code )
+        log.error( message )
+        raise Exception( message )
+    entries = r.json().get( 'entries', [] )
+    return int( entries[0]['id'] ) if entries else None
+
+
+def grab_bib( token_manager, api_root_url, bib_id ):
+    """ Returns the full api data for the bib, as stored in last_bib.json.
+        Called by update_last_bib() """
+    payload = { 'limit': '1', 'suppressed': False, 'id': bib_id }
+    log.debug( 'payload, ```%s```' % payload )
+    r = token_manager.authorized_get( '%sbibs/' % api_root_url, endpoint='bibs', params=payload )
+    bib_jdct = r.json()['entries'][0]
+    log.debug( 'bib_jdct, ```%s```' % pprint.pformat(bib_jdct) )
+    return bib_jdct
+
+
+if __name__ == '__main__':
+    log.debug( '\n-------\nstarting standard log' )
+    update_last_bib()
+    log.debug( 'complete' )
@@ -0,0 +1,199 @@
+import hashlib, logging, os, re, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import compression_of, open_buffer
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading marc_check module' )
+
+
+FIELD_TERMINATOR = 0x1E
+RECORD_TERMINATOR = 0x1D
+SUBFIELD_DELIMITER = 0x1F
+LEADER_PATTERN = re.compile( rb'\d{5}[ a-z]{4}[ a]22\d{5}' )  # candidate record-starts, for resynchronizing after a bad record
+BIB_ID_PATTERN = re.compile( rb'\x1fa\.?(b\d{7})[\dx]?' )  # sierra's 907 $a, eg '.b12345678' (the last character is a check-digit)
+
+
+def check_file_structure( file_path, collect_bib_ids=False, with_sha256=False ):
+    """ Validates the iso-2709 structure of every record in the file, over an mmap (or its decompressed content), without building pymarc objects.
+        Returns dict of `valid`, `record_count`, `first_bad_offset`, `error`, `bib_ids` (when requested), and `sha256` (when requested, for plain files) --
+          hashed from the pages just walked, so the validation-cache doesn't read the file again.
+        Called by validator.check_marc_file() """
+    buffer = open_buffer( file_path )
+    try:
+        structure = check_buffer_structure( buffer, collect_bib_ids )
+        if with_sha256 and compression_of( file_path ) is None:
+            structure['sha256'] = hashlib.sha256( buffer ).hexdigest()
+        return structure
+    finally:
+        buffer.close()
+
+
+def check_buffer_structure( buffer, collect_bib_ids=False ):
+    """ Walks records in a bytes-like buffer (bytes, mmap, memoryview), checking each leader, directory, and terminator.
+        Stops at the first bad record; its offset is returned so callers can report or resynchronize.
+        Called by check_file_structure() """
+    ( position, record_count, bib_ids, end_of_buffer ) = ( 0, 0, [], len(buffer) )
+    while position < end_of_buffer:
+        ( record_length, error, bib_id ) = check_record( buffer, position, end_of_buffer, collect_bib_ids )
+        if error:
+            return { 'valid': False, 'record_count': record_count, 'first_bad_offset': position, 'error': error, 'bib_ids': bib_ids }
+        if collect_bib_ids:
+            bib_ids.append( bib_id )
+        record_count += 1
+        position += record_length
+    return { 'valid': True, 'record_count': record_count, 'first_bad_offset': None, 'error': None, 'bib_ids': bib_ids }
+
+
+def check_record( buffer, position, end_of_buffer, collect_bib_ids=False ):
+    """ Checks the record starting at `position`; returns ( record_length, error-or-None, bib_id-or-None ).
+        Called by check_buffer_structure(), and by salvage code resynchronizing on a candidate leader """
+    if end_of_buffer - position < 24:
+        return ( 0, 'truncated leader', None )
+    record_length = parse_digits( buffer, position, 5 )
+    base_address = parse_digits( buffer, position + 12, 5 )
+    if record_length is None or base_address is None:
+        return ( 0, 'non-numeric leader length or base-address', None )
+    record_end = position + record_length
+    if record_length < 26 or base_address < 25 or base_address >= record_length:
+        return ( 0, 'impossible leader length `%s` or base-address `%s`' % (record_length, base_address), None )
+    if record_end > end_of_buffer:
+        return ( 0, 'record length `%s` runs past end of data' % record_length, None )
+    if buffer[record_end - 1] != RECORD_TERMINATOR:
+        return ( 0, 'missing record terminator', None )
+    directory_end = position + base_address - 1
+    if buffer[directory_end] != FIELD_TERMINATOR or ( directory_end - position - 24 ) % 12 != 0:
+        return ( 0, 'malformed directory', None )
+    directory = bytes( buffer[position + 24:directory_end] )  # the one small copy per record
+    ( bib_id, data_start, data_length ) = ( None, position + base_address, record_length - base_address )
+    for entry in range( 0, len(directory), 12 ):
+        numbers = directory[entry + 3:entry + 12]
+        if not numbers.isdigit():
+            return ( 0, 'bad directory entry at offset `%s`' % (entry + 24), None )
+        ( field_length, field_start ) = ( int(numbers[0:4]), int(numbers[4:9]) )
+        if field_length == 0 or field_start + field_length > data_length:
+            return ( 0, 'directory entry at offset `%s` points outside the record' % (entry + 24), None )
+        if buffer[data_start + field_start + field_length - 1] != FIELD_TERMINATOR:
+            return ( 0, 'missing field terminator at offset `%s`' % (field_start + base_address), None )
+        if collect_bib_ids:
+            tag = directory[entry:entry + 3]
+            if tag == b'907' or ( tag == b'001' and bib_id is None ):
+                bib_id = extract_bib_id( buffer, data_start + field_start, field_length, tag )
+    return ( record_length, None, bib_id )
+
+
+def salvage_buffer( buffer ):
+    """ Walks the buffer like check_buffer_structure(), but resynchronizes after a bad record at the next position that checks out as a record.
+        Returns dict of `good_spans` ( [start, end) pairs, adjacent records merged ), `record_count`, and `bad_spans`,
+          each with `offset`, `length`, `error`, the `bib_ids` (ints) found in its bytes, and the bib-ids of the good records either side.
+        Called by validator.FileChecker.salvage_file() """
+    ( position, record_count, good_spans, bad_spans, end_of_buffer, previous_bib_id ) = ( 0, 0, [], [], len(buffer), None )
+    while position < end_of_buffer:
+        ( record_length, error, bib_id ) = check_record( buffer, position, end_of_buffer, collect_bib_ids=True )
+        if not error:
+            if good_spans and good_spans[-1][1] == position:
+                good_spans[-1][1] = position + record_length
+            else:
+                good_spans.append( [position, position + record_length] )
+            if bad_spans and bad_spans[-1]['next_bib_id'] is None and bad_spans[-1]['offset'] + bad_spans[-1]['length'] == position:
+                bad_spans[-1]['next_bib_id'] = bib_number( bib_id )
+            ( record_count, position, previous_bib_id ) = ( record_count + 1, position + record_length, bib_id )
+            continue
+        resume_at = find_next_record( buffer, position + 1, end_of_buffer )
+        span = bytes( buffer[position:resume_at] )
+        bad_spans.append( {
+            'offset': position, 'length': resume_at - position, 'error': error,
+            'bib_ids': sorted( set(int(match[1:]) for match in BIB_ID_PATTERN.findall(span)) ),
+            'previous_bib_id': bib_number( previous_bib_id ), 'next_bib_id': None } )
+        position = resume_at
+    return { 'good_spans': good_spans, 'record_count': record_count, 'bad_spans': bad_spans }
+
+
+def find_next_record( buffer, start, end_of_buffer ):
+    """ Returns the offset of the next leader-like position at or after `start` holding a structurally valid record; else end_of_buffer.
+        Called by salvage_buffer() """
+    for match in LEADER_PATTERN.finditer( buffer, start ):
+        if check_record( buffer, match.start(), end_of_buffer )[1] is None:
+            return match.start()
+    return end_of_buffer
+
+
+def bib_number( bib_id ):
+    """ Returns the api's integer id for a 'b1234567'-style bib-id (any check-digit dropped), or None if it isn't one.
+        Called by salvage_buffer() """
+    match = re.match( r'^b(\d{7})', bib_id or '' )
+    return int( match.group(1) ) if match else None
+
+
+def parse_digits( buffer, start, width ):
+    """ Returns the ascii-digit run as an int, or None if any byte isn't a digit.
+        Called by check_record() """
+    digits = bytes( buffer[start:start + width] )
+    return int( digits ) if digits.isdigit() else None
+
+
+def extract_bib_id( buffer, field_start, field_length, tag ):
+    """ Returns the bib-id: sierra's 907 $a (eg '.b12345678'), else the 001 control-number.
+        Called by check_record() """
+    field = bytes( buffer[field_start:field_start + field_length - 1] )
+    if tag == b'001':
+        return field.decode( 'utf-8', 'replace' ).strip()
+    for subfield in field.split( bytes([SUBFIELD_DELIMITER]) )[1:]:
+        if subfield[0:1] == b'a':
+            return subfield[1:].decode( 'utf-8', 'replace' ).strip().lstrip( '.' )
+    return None
+
+
+class MarcStreamChecker( object ):
+    """ Incremental version of check_buffer_structure(), fed download-chunks as they arrive.
+        Holds back only the bytes of the current incomplete record, so a file is validated without a second read from disk.
+        Used by sierra.MarcHelper.stream_to_temp_file() """
+
+    def __init__( self, collect_bib_ids=False ):
+        self.collect_bib_ids = collect_bib_ids
+        self.pending = bytearray()
+        self.consumed_bytes = 0  # file-offset of pending[0]
+        self.record_count = 0
+        self.bib_ids = []
+        self.error = None
+        self.first_bad_offset = None
+
+    def feed( self, chunk ):
+        """ Checks every record completed by this chunk; after an error, further chunks are ignored.
+            Called by sierra.MarcHelper.stream_to_temp_file() """
+        if self.error:
+            return
+        self.pending.extend( chunk )
+        ( position, end_of_buffer ) = ( 0, len(self.pending) )
+        while end_of_buffer - position >= 24:
+            record_length = parse_digits( self.pending, position, 5 )
+            if record_length is not None and position + record_length > end_of_buffer:
+                break  # wait for the rest of the record
+            ( record_length, error, bib_id ) = check_record( self.pending, position, end_of_buffer, self.collect_bib_ids )
+            if error:
+                ( self.error, self.first_bad_offset ) = ( error, self.consumed_bytes + position )
+                break
+            if self.collect_bib_ids:
+                self.bib_ids.append( bib_id )
+            self.record_count += 1
+            position += record_length
+        del self.pending[0:position]
+        self.consumed_bytes += position
+        return
+
+    def finish( self ):
+        """ Returns the same dict as check_buffer_structure(); bytes left over at the end are a truncated record.
+            Called by sierra.MarcHelper.stream_to_temp_file() """
+        if not self.error and self.pending:
+            ( record_length, error, bib_id ) = check_record( self.pending, 0, len(self.pending) )
+            ( self.error, self.first_bad_offset ) = ( error or 'trailing bytes after last record', self.consumed_bytes )
+        return {
+            'valid': self.error is None, 'record_count': self.record_count, 'first_bad_offset': self.first_bad_offset,
+            'error': self.error, 'bib_ids': self.bib_ids }
+
+    ## end class MarcStreamChecker()
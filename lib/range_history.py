@@ -0,0 +1,194 @@
+import bisect, datetime, fcntl, json, logging, os, pprint, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading range_history module' )
+
+
+class RangeHistory( object ):
+    """ Persists the `outputRecords` observed for each queried bib-range, across runs.
+        Deleted bibs never come back, so a range that returned zero records is dead for good and needn't be queried again.
+        The observed counts also give the record-density the tracker uses to size batches.
+        Several workers may share the file (see SBE__WORKER_ID), so save() merges this run's changes into the file's current content, under a lock. """
+
+    def __init__( self ):
+        self.HISTORY_FILEPATH = os.environ.get( 'SBE__RANGE_HISTORY_JSON_PATH', None )  # optional; unset disables skipping
+        self.ranges = {}  # chunk_start_bib (str, for json) -> { 'end': int, 'output_records': int, 'observed': isoformat }
+        self.changes = {}  # this run's changes, merged in by save(): chunk_start_bib -> entry, or None for a superseded observation
+        self.superseded = {}  # chunk_start_bib -> `observed` of the observation this run superseded
+        self.dead_starts = []  # sorted starts of merged dead intervals
+        self.dead_ends = []
+        self.observed_starts = []  # sorted; parallel to observed_entries
+        self.observed_entries = []  # ( start, end, output_records )
+        self.dirty = False
+        self.load()
+
+    def load( self ):
+        """ Loads history file, if configured and present.
+            Called by __init__() """
+        if not self.HISTORY_FILEPATH:
+            return
+        self.ranges = self.read_ranges()
+        self.build_intervals()
+        log.debug( '`%s` ranges loaded; `%s` dead intervals' % (len(self.ranges), len(self.dead_starts)) )
+        return
+
+    def read_ranges( self ):
+        """ Returns the history file's ranges; empty if it's missing or unreadable.
+            Called by load() and save() """
+        try:
+            with open( self.HISTORY_FILEPATH, 'r' ) as f:
+                return json.loads( f.read() )['ranges']
+        except Exception as e:
+            log.warning( 'no range-history loaded, ```%s```; starting fresh' % e )
+            return {}
+
+    def build_intervals( self ):
+        """ Sorts observations for density lookups, and merges zero-record ranges into non-overlapping intervals for containment checks.
+            Called by load() and save() """
+        self.observed_entries = sorted( (int(start), entry['end'], entry['output_records']) for (start, entry) in self.ranges.items() )
+        self.observed_starts = [ entry[0] for entry in self.observed_entries ]
+        dead = sorted( (int(start), entry['end']) for (start, entry) in self.ranges.items() if entry['output_records'] == 0 )
+        ( self.dead_starts, self.dead_ends ) = ( [], [] )
+        for ( start, end ) in dead:
+            if self.dead_ends and start <= self.dead_ends[-1] + 1:
+                self.dead_ends[-1] = max( self.dead_ends[-1], end )
+            else:
+                self.dead_starts.append( start )
+                self.dead_ends.append( end )
+        return
+
+    def is_dead( self, start_bib, end_bib ):
+        """ Returns True if every id in [start_bib, end_bib] is inside a known-dead interval.
+            Called by tracker.TrackerHelper.prepare_tracker_batches() """
+        position = bisect.bisect_right( self.dead_starts, start_bib ) - 1
+        return position >= 0 and self.dead_ends[position] >= end_bib
+
+    def estimate_records( self, start_bib, end_bib ):
+        """ Estimates the records in [start_bib, end_bib] from overlapping observations, pro-rated by overlap.
+            Ids not covered by any observation count as one record each, so unobserved ranges plan like today's full 2000-bib batches.
+            Called by tracker.TrackerHelper.prepare_tracker_batches() """
+        ( estimate, covered ) = ( 0.0, 0 )
+        position = bisect.bisect_right( self.observed_starts, end_bib ) - 1
+        while position >= 0:
+            ( start, end, output_records ) = self.observed_entries[position]
+            if end < start_bib:
+                break
+            overlap = min( end, end_bib ) - max( start, start_bib ) + 1
+            if overlap > 0:
+                estimate += output_records * float( overlap ) / ( end - start + 1 )
+                covered += overlap
+            position -= 1
+        uncovered = max( (end_bib - start_bib + 1) - covered, 0 )
+        return int( round(estimate) ) + uncovered
+
+    def record( self, batch ):
+        """ Notes the batch's observed record-count, if the api returned one.
+            Called by controller.request_batch() """
+        if batch.get( 'output_records', None ) is None or batch.get( 'bib_ids', None ):  # delta id-lists say nothing about range-density
+            return
+        for start in list( self.ranges.keys() ):  # a re-planned batch supersedes older live observations inside it; dead ones stay dead
+            if batch['chunk_start_bib'] <= int( start ) <= batch['chunk_end_bib'] and self.ranges[start]['output_records'] > 0:
+                self.superseded.setdefault( start, self.ranges.pop(start)['observed'] )
+                self.changes[start] = None
+        start = str( batch['chunk_start_bib'] )
+        if start in self.ranges:
+            self.superseded.setdefault( start, self.ranges[start]['observed'] )
+        self.ranges[start] = self.changes[start] = {
+            'end': batch['chunk_end_bib'], 'output_records': batch['output_records'], 'observed': datetime.datetime.now().isoformat() }
+        self.dirty = True
+        return
+
+    def save( self ):
+        """ Writes history atomically, once per run rather than per batch.
+            The file is re-read under an exclusive lock and this run's changes applied to it, so other workers' observations since load() are kept;
+              a superseded observation is only dropped if it's unchanged in the file, so another worker's newer one (or a dead range) is kept.
+            Called by controller """
+        if not self.HISTORY_FILEPATH or not self.dirty:
+            return
+        with open( '%s.lock' % self.HISTORY_FILEPATH, 'a' ) as lock_handle:
+            fcntl.lockf( lock_handle, fcntl.LOCK_EX )  # released on close
+            ranges = self.read_ranges()
+            for ( start, entry ) in self.changes.items():
+                if entry is not None:
+                    ranges[start] = entry
+                elif start in ranges and ranges[start]['observed'] == self.superseded.get( start ) and ranges[start]['output_records'] > 0:
+                    del ranges[start]
+            temp_path = '%s.tmp' % self.HISTORY_FILEPATH
+            with open( temp_path, 'w' ) as f:
+                f.write( json.dumps({'ranges': ranges}, sort_keys=True) )
+            os.replace( temp_path, self.HISTORY_FILEPATH )
+        ( self.ranges, self.changes, self.superseded ) = ( ranges, {}, {} )
+        self.build_intervals()
+        self.dirty = False
+        log.debug( 'range-history saved; `%s` ranges, `%s` dead intervals' % (len(self.ranges), len(self.dead_starts)) )
+        return
+
+    def update_from_deleted_query( self, token_manager, api_root_url ):
+        """ Marks live ranges dead when at least as many of their bibs have been deleted since they were observed as they then held.
+            Each range only counts deletions dated after its own observation -- earlier ones were already left out of its `output_records` --
+              and over [start, end), since adjacent ranges share their boundary bib. `deletedDate` is a day, so same-day deletions are left
+              for the range's next observation; undercounting only keeps a range live.
+            Called by `if __name__ == '__main__':` """
+        live_entries = [ entry for entry in self.ranges.values() if entry['output_records'] > 0 ]
+        if not live_entries:
+            return
+        since = min( entry['observed'] for entry in live_entries )[0:10]
+        deletions = self.query_deleted_ids( token_manager, api_root_url, since )
+        deleted_ids = [ bib_id for ( bib_id, deleted_date ) in deletions ]
+        for ( start, entry ) in self.ranges.items():
+            if entry['output_records'] == 0:
+                continue
+            ( low, high ) = ( bisect.bisect_left(deleted_ids, int(start)), bisect.bisect_left(deleted_ids, entry['end']) )
+            observed_date = entry['observed'][0:10]
+            deleted_count = sum( 1 for ( bib_id, deleted_date ) in deletions[low:high] if deleted_date > observed_date )
+            if deleted_count >= entry['output_records']:
+                log.debug( 'range starting `%s` now fully deleted' % start )
+                entry['output_records'] = 0
+                entry['observed'] = datetime.datetime.now().isoformat()
+                self.changes[start] = entry
+                self.dirty = True
+        self.save()
+        return
+
+    def query_deleted_ids( self, token_manager, api_root_url, since ):
+        """ Pages the bibs endpoint for bibs deleted on or after `since` (yyyy-mm-dd); returns ( id, deleted-date ) tuples sorted by id.
+            Raises on any unexpected status, so a partial list is never applied.
+            Called by update_from_deleted_query() """
+        ( bib_url, deletions, next_id ) = ( '%sbibs/' % api_root_url, [], None )
+        while True:
+            payload = { 'limit': '2000', 'fields': 'id,deletedDate', 'deleted': 'true', 'deletedDate': '[%s,]' % since }
+            if next_id:
+                payload['id'] = '[%s,]' % next_id
+            r = token_manager.authorized_get( bib_url, endpoint='bibs', params=payload )
+            if r.status_code == 404:  # sierra's answer to an empty result-set
+                break
+            if r.status_code != 200:
+                message = 'bad status querying deleted bibs, `%s`; raising Exception' % r.status_code
+                log.error( message )
+                raise Exception( message )
+            entries = r.json().get( 'entries', [] )
+            deletions.extend( (int(entry['id']), entry.get('deletedDate', since)[0:10]) for entry in entries )
+            if len( entries ) < 2000:
+                break
+            next_id = int( entries[-1]['id'] ) + 1
+        log.debug( '`%s` deleted ids since `%s`' % (len(deletions), since) )
+        return sorted( deletions )
+
+    ## end class RangeHistory()
+
+
+if __name__ == '__main__':
+    from lib.auth import get_token_manager
+    log.debug( 'starting deleted-date update' )
+    history = RangeHistory()
+    history.update_from_deleted_query( get_token_manager(), os.environ['SBE__ROOT_URL'] )
+    log.debug( 'complete' )
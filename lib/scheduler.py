@@ -0,0 +1,112 @@
+import json, logging, math, os, re, threading, time
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading scheduler module' )
+
+
+class BackoffRequired( Exception ):
+    """ Raised when the api needs us to pause before the next bib-range request; carries the wait estimate in seconds. """
+
+    def __init__( self, message, wait_seconds ):
+        super( BackoffRequired, self ).__init__( message )
+        self.wait_seconds = wait_seconds
+
+
+class RateLimitExceeded( BackoffRequired ):
+    """ Raised on the api's 'Rate exceeded for endpoint' response. """
+    pass
+
+
+class RateLimitScheduler( object ):
+    """ Paces bib-range requests with a token-bucket model of the endpoint budget.
+        The bucket starts unknown (no pacing); each 'Rate exceeded' response teaches it how many calls fit in how long a window. """
+
+    def __init__( self ):
+        self.default_wait_seconds = int( os.environ.get('SBE__RATE_LIMIT_DEFAULT_WAIT_SECONDS', '300') )
+        self.wait_padding_seconds = int( os.environ.get('SBE__RATE_LIMIT_WAIT_PADDING_SECONDS', '5') )
+        self.capacity = None  # learned calls-per-window
+        self.refill_per_second = None  # learned
+        self.tokens = 0.0
+        self.last_refill = time.time()
+        self.blocked_until = 0.0  # end of the api's last wait-estimate; nothing refills before it
+        self.calls_in_window = 0
+        self.window_started = time.time()
+        self.lock = threading.Lock()
+
+    def acquire( self ):
+        """ Blocks, if the learned budget is spent, until a call's worth has refilled; then counts the call.
+            Called by sierra.MarcHelper.make_bibrange_request() """
+        with self.lock:
+            if self.capacity is not None:
+                self.refill()
+                if self.tokens < 1:
+                    pause = max( self.blocked_until - time.time(), 0 ) + ( 1 - self.tokens ) / self.refill_per_second
+                    log.debug( 'budget spent; pacing for `%.1f` seconds' % pause )
+                    time.sleep( pause )
+                    self.refill()
+                self.tokens -= 1
+            self.calls_in_window += 1
+        return
+
+    def refill( self ):
+        """ Adds tokens for the time elapsed since the last refill -- or since the end of a rate-limit wait, if later -- capped at capacity.
+            Called by acquire() """
+        now = time.time()
+        elapsed = max( now - max(self.last_refill, self.blocked_until), 0 )
+        self.tokens = min( float(self.capacity), self.tokens + elapsed * self.refill_per_second )
+        self.last_refill = now
+        return
+
+    def record_rate_limited( self, wait_seconds ):
+        """ Learns the budget from a 'Rate exceeded' response: the calls made this window fit in (elapsed + wait) seconds.
+            Called by sierra.MarcHelper.assess_bibrange_response() """
+        with self.lock:
+            observed_calls = max( self.calls_in_window - 1, 1 )  # the rejected call doesn't count
+            window_seconds = max( time.time() - self.window_started, 0 ) + wait_seconds  # the window starts at the end of any previous wait
+            if self.capacity is None:
+                self.capacity = observed_calls
+            else:  # smooth; budgets vary with other api traffic
+                self.capacity = max( int(round((self.capacity + observed_calls) / 2.0)), 1 )
+            self.refill_per_second = float( self.capacity ) / window_seconds
+            ( self.tokens, self.last_refill, self.blocked_until ) = ( 0.0, time.time(), time.time() + wait_seconds )  # nothing refills until the wait ends
+            ( self.calls_in_window, self.window_started ) = ( 0, self.blocked_until )
+            log.info( 'learned budget -- capacity, `%s` calls; refill, `%.4f` calls/second' % (self.capacity, self.refill_per_second) )
+        return
+
+    def parse_wait_seconds( self, response ):
+        """ Returns the api's wait estimate in seconds, from a Retry-After header or the response message; else the default.
+            Called by sierra.MarcHelper.assess_bibrange_response() """
+        retry_after = response.headers.get( 'Retry-After', '' )
+        if retry_after.isdigit():
+            return int( retry_after )
+        try:
+            response_text = json.dumps( response.json() )
+        except Exception:
+            response_text = response.text
+        match = re.search( r'(\d+(?:\.\d+)?)\s*(second|sec|minute|min)', response_text, re.IGNORECASE )
+        if match is None:
+            log.warning( 'no wait-estimate found in ```%s```; using default' % response_text )
+            return self.default_wait_seconds
+        amount = float( match.group(1) )
+        if match.group(2).lower().startswith( 'min' ):
+            amount *= 60
+        return int( math.ceil(amount) )
+
+    def wait( self, backoff ):
+        """ Sleeps for the exception's wait estimate plus padding.
+            Called by controller in daemon mode """
+        seconds = backoff.wait_seconds + self.wait_padding_seconds
+        log.info( 'backing off `%s` seconds, ```%s```' % (seconds, backoff) )
+        time.sleep( seconds )
+        return
+
+    ## end class RateLimitScheduler()
+
@@ -1,7 +1,11 @@
-import json, logging, os, sys, time
+import hashlib, json, logging, os, sys, time
 import requests
 from requests.auth import HTTPBasicAuth
 from requests.exceptions import ReadTimeout as requests_ReadTimeout
+from lib.auth import get_token_manager
+from lib.compression import StreamCompressor, configured_method, stored_name
+from lib.marc_check import MarcStreamChecker
+from lib.scheduler import BackoffRequired, RateLimitExceeded, RateLimitScheduler
 
 
 logging.basicConfig(
@@ -25,23 +29,17 @@ class MarcHelper( object ):
         self.FILE_DOWNLOAD_DIR = os.environ['SBE__FILE_DOWNLOAD_DIR']
         self.INVALID_PARAM_FILE_URL = os.environ['SBE__INVALID_PARAM_FILE_URL']
         self.chunk_number_of_bibs = json.loads( os.environ['SBE__CHUNK_NUMBER_OF_BIBS_JSON'] )  # normally null -> None, or an int
+        self.token_manager = get_token_manager( self.API_ROOT_URL, self.HTTPBASIC_KEY, self.HTTPBASIC_SECRET )
+        self.scheduler = RateLimitScheduler()
+        self.download_chunk_bytes = int( os.environ.get('SBE__DOWNLOAD_CHUNK_BYTES', str(1024 * 1024)) )
+        self.download_retries = int( os.environ.get('SBE__DOWNLOAD_RETRIES', '3') )
+        self.worker_id = os.environ.get( 'SBE__WORKER_ID', None )  # optional; see tracker.TrackerHelper.claim_next_batch()
+        self.compression = configured_method()  # None, 'gzip', or 'zstd'; see lib/compression.py
 
     def get_token( self ):
-        """ Gets API token.
-            Called by controller.download_file() """
-        token = 'init'
-        token_url = '%stoken' % self.API_ROOT_URL
-        log.debug( 'token_url, ```%s```' % token_url )
-        try:
-            r = requests.post( token_url, auth=HTTPBasicAuth(self.HTTPBASIC_KEY, self.HTTPBASIC_SECRET), timeout=20 )
-            log.debug( 'token r.content, ```%s```' % r.content )
-            token = r.json()['access_token']
-            log.debug( 'token, ```%s```' % token )
-            return token
-        except Exception as e:
-            message = 'exception getting token, ```%s```' % str(e)
-            log.error( message )
-            raise Exception( message )
+        """ Gets API token -- cached, and only re-requested shortly before expiry.
+            Not needed for batch-requests, which go through self.token_manager.authorized_get() """
+        return self.token_manager.get_token()
 
     # def make_bibrange_request( self, token, next_batch ):
     #     """ Forms and executes the bib-range query.
@@ -58,26 +56,54 @@ class MarcHelper( object ):
     #     log.debug( 'returning err, ```%s```' % err )
     #     return ( file_url, err )
 
-    def make_bibrange_request( self, token, next_batch ):
+    def make_bibrange_request( self, next_batch ):
         """ Forms and executes the bib-range query.
             Called by controller.download_file()
-            Note: halting script execution is a normal part of the operation of this code. """
+            Note: raising BackoffRequired is a normal part of the operation of this code; the controller exits or waits. """
         start_bib = next_batch['chunk_start_bib']
         end_bib = next_batch['chunk_end_bib'] if self.chunk_number_of_bibs is None else start_bib + self.chunk_number_of_bibs
         marc_url = '%sbibs/marc' % self.API_ROOT_URL
-        payload = { 'id': '[%s,%s]' % (start_bib, end_bib), 'limit': (end_bib - start_bib) + 1, 'mapping': 'toc' }
+        if next_batch.get( 'bib_ids', None ):  # delta batches list their ids
+            payload = { 'id': ','.join( str(bib_id) for bib_id in next_batch['bib_ids'] ), 'limit': self.job_record_limit( next_batch ), 'mapping': 'toc' }
+        else:
+            payload = { 'id': '[%s,%s]' % (start_bib, end_bib), 'limit': self.job_record_limit( next_batch ), 'mapping': 'toc' }
         log.debug( 'payload, ```%s```' % payload )
-        custom_headers = {'Authorization': 'Bearer %s' % token }
+        self.scheduler.acquire()
         try:
-            r = requests.get( marc_url, headers=custom_headers, params=payload, timeout=30 )
+            r = self.token_manager.authorized_get( marc_url, endpoint='bibs_marc', params=payload )
         except requests_ReadTimeout:
-            log.warning( 'requests-ReadTimeout; will exit script' )
-            sys.exit()
+            log.warning( 'requests-ReadTimeout; raising BackoffRequired' )
+            raise BackoffRequired( 'requests-ReadTimeout', self.scheduler.default_wait_seconds )
         ( file_url, err ) = self.assess_bibrange_response( r )
+        if r.status_code == 200:
+            next_batch['output_records'] = r.json()['outputRecords']  # kept in the tracker, and used by range-history
         log.debug( 'returning file_url, ```%s```' % file_url )
         log.debug( 'returning err, ```%s```' % err )
         return ( file_url, err )
 
+    def job_record_limit( self, next_batch ):
+        """ Returns the `limit` param: the full range for standard 2000-bib batches, as before; capped at 2000 records for wider, sparse batches.
+            Called by make_bibrange_request() and needs_split() """
+        if next_batch.get( 'bib_ids', None ):
+            return len( next_batch['bib_ids'] )
+        start_bib = next_batch['chunk_start_bib']
+        end_bib = next_batch['chunk_end_bib'] if self.chunk_number_of_bibs is None else start_bib + self.chunk_number_of_bibs
+        span = ( end_bib - start_bib ) + 1
+        return span if span <= 2001 else 2000
+
+    def needs_split( self, next_batch, err ):
+        """ Returns True if the batch should be bisected: the api's 'External Process Failed', or a wide batch that hit the record-limit.
+            Called by controller.request_batch() """
+        if err:
+            try:
+                return json.loads( err ).get( 'name', None ) == 'External Process Failed'
+            except Exception:
+                return False
+        if next_batch.get( 'bib_ids', None ):  # an id-list can't overflow its own limit; inventory-packed ranges can, by their suppressed bibs
+            return False
+        output_records = next_batch.get( 'output_records', None )
+        return output_records is not None and ( next_batch['chunk_end_bib'] - next_batch['chunk_start_bib'] ) > 2000 and output_records >= self.job_record_limit( next_batch )
+
     # def assess_bibrange_response( self, r ):
     #     """ Analyzes bib-range response.
     #         Called by make_bibrange_request() """
@@ -139,7 +165,7 @@ class MarcHelper( object ):
     def assess_bibrange_response( self, r ):
         """ Analyzes bib-range response.
             Called by make_bibrange_request()
-            Note: halting script execution is a normal part of the operation of this code. """
+            Note: raising BackoffRequired is a normal part of the operation of this code. """
         log.debug( 'r.status_code, `%s`' % r.status_code )
         log.debug( 'bib r.content, ```%s```' % r.content )
         file_url = err = None
@@ -148,21 +174,19 @@ class MarcHelper( object ):
             try:
                 response_message = r.json()['name']
             except Exception as e:
-                message = 'could not read response-message, ```%s```; will exit script' % e
-                # log.error( message )
-                # raise Exception( message )
+                message = 'could not read response-message, ```%s```; raising BackoffRequired' % e
                 log.warning( message )
-                sys.exit()
+                raise BackoffRequired( message, self.scheduler.default_wait_seconds )
             if response_message  == 'External Process Failed':
                 log.warning( 'found response "%s"; returning this bib-range-response to continue' % response_message )
                 err = r.content
                 return ( file_url, err )
-            elif response_message  == 'Rate exceeded for endpoint':  ## don't continue; stop until cron re-initiates
-                message = 'found response "%s"; will exit script' % response_message
-                # log.error( message )
-                # raise Exception( message )
+            elif response_message  == 'Rate exceeded for endpoint':  ## don't continue; controller exits until cron re-initiates, or waits in daemon mode
+                wait_seconds = self.scheduler.parse_wait_seconds( r )
+                self.scheduler.record_rate_limited( wait_seconds )
+                message = 'found response "%s"; estimated wait, `%s` seconds; raising RateLimitExceeded' % ( response_message, wait_seconds )
                 log.warning( message )
-                sys.exit()
+                raise RateLimitExceeded( message, wait_seconds )
             else:
                 message = 'unhandled bib-range-response found, ```%s```; raising Exception' % response_message
                 log.error( message )
@@ -200,10 +224,11 @@ class MarcHelper( object ):
             raise Exception( message )
 
 
-    def handle_bib_range_request_err( self, err, file_name ):
+    def handle_bib_range_request_err( self, err ):
         """ Handles known bib-range-response problem that should not stop processing.
-            Called by: controller.download_file() """
-        handled_check = 'failure'
+            Returns the outcome to record on the tracker batch -- no file is written, so the download-dir holds only real marc.
+            Called by: controller.request_batch() """
+        outcome = None
         try:
             bibrange_response_dct = json.loads( err )
         except Exception as e:
@@ -211,12 +236,10 @@ class MarcHelper( object ):
             log.error( message )
             raise Exception( message )
         if bibrange_response_dct.get( 'outputRecords', None ) == 0:
-            self.save_file( err, file_name)
-            handled_check = 'success'
+            outcome = { 'outcome': 'zero_records' }
         elif bibrange_response_dct.get( 'name', None ) == 'External Process Failed':
-            self.save_file( err, file_name)
-            handled_check = 'success'
-        return handled_check  # checked to determine whether to update tracker
+            outcome = { 'outcome': 'failed', 'api_response': bibrange_response_dct }
+        return outcome  # checked to determine whether to update tracker
 
 
     # def handle_bib_range_request_err( self, err, file_name ):
@@ -235,47 +258,98 @@ class MarcHelper( object ):
     #         raise Exception( message )
 
 
-    def grab_file( self, token, file_url, file_name ):
-        """ Downloads file.
-            Called by controller.download_file() """
+    def grab_file( self, file_url, file_name, expected_records=None ):
+        """ Streams file to a `.part` temp-file in large chunks, resuming via http-range after a dropped connection, then renames it into place.
+            Records are checked as the bytes arrive, and the count compared with the bib-range response's `outputRecords`;
+              an invalid file lands with a .txt suffix, as validator.FileChecker would rename it.
+            With SBE__COMPRESSION set, the file is compressed as it streams, and stored with a .gz or .zst suffix.
+            Returns byte-count, sha256, and validation results, for the tracker.
+            Called by controller.download_file() and controller.download_and_track() """
         log.debug( 'starting grab_file()' )
-        custom_headers = {'Authorization': 'Bearer %s' % token }
-        r = requests.get( file_url, headers=custom_headers, timeout=60 )
-        log.debug( 'r.status_code, `%s`' % r.status_code )
-        if r.status_code is not 200:
-            message = 'problem: bad status_code; r.content, ```%s```; raising Exception' % r.content
-            log.error( message )
-            raise Exception( message )
-        filepath = '%s/%s' % ( self.FILE_DOWNLOAD_DIR, file_name )
+        filepath = '%s/%s' % ( self.FILE_DOWNLOAD_DIR, stored_name(file_name, self.compression) )
+        temp_filepath = '%s.%s.part' % ( filepath, self.worker_id ) if self.worker_id else '%s.part' % filepath  # a re-claimed batch's old worker may still be writing
         log.debug( 'filepath, ```%s```' % filepath )
-        try:
-            with open(filepath, 'wb') as file_handler:
-                for chunk in r.iter_content( chunk_size=128 ):
-                    file_handler.write( chunk )
-                log.debug( 'file written to ```%s```' % filepath )
-        except Exception as e:
-            message = 'exception writing file, ```%s```; raising Exception' % e
-            log.error( message )
-            raise Exception( message )
-        return
-
-
+        if os.path.exists( temp_filepath ):  # left by a crashed run, for a different export-job; only resume within this call
+            os.remove( temp_filepath )
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                file_stats = self.stream_to_temp_file( file_url, temp_filepath )
+                break
+            except ( requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests_ReadTimeout ) as e:
+                if attempt > self.download_retries:
+                    message = 'download still failing after `%s` attempts, ```%s```; raising Exception' % ( attempt, e )
+                    log.error( message )
+                    raise Exception( message )
+                log.warning( 'download interrupted, ```%s```; will resume' % e )
+        if file_stats['records_valid'] and expected_records is not None and file_stats['record_count'] != expected_records:
+            file_stats['records_valid'] = False
+            file_stats['validation_error'] = 'record-count `%s` does not match outputRecords `%s`' % ( file_stats['record_count'], expected_records )
+        if not file_stats['records_valid']:
+            log.error( 'invalid marc in ```%s```, ```%s```' % (file_name, file_stats['validation_error']) )
+            filepath = filepath.replace( '.mrc', '.txt' )
+        os.replace( temp_filepath, filepath )
+        log.debug( 'file written to ```%s```; stats, ```%s```' % (filepath, file_stats) )
+        return file_stats
 
-    def save_file( self, err_output, file_name ):
-        """ Saves file.
-            Called by manage_download() """
-        filepath = '%s/%s' % ( self.FILE_DOWNLOAD_DIR, file_name )
-        log.debug( 'filepath, ```%s```' % filepath )
+    def stream_to_temp_file( self, file_url, temp_filepath ):
+        """ Downloads into temp_filepath, appending to any partial content if the server honors the range request.
+            Every chunk also goes through a MarcStreamChecker, so the file is validated in the same pass.
+            When compressing, the written bytes are compressed output, so a partial file can't be resumed by byte-range; the download restarts.
+            `file_bytes` and `file_sha256` describe the stored file; `marc_bytes` the uncompressed marc.
+            Called by grab_file() """
+        ( hasher, checker, existing_bytes ) = ( hashlib.sha256(), MarcStreamChecker(), 0 )
+        compressor = StreamCompressor( self.compression ) if self.compression else None
+        if compressor and os.path.exists( temp_filepath ):
+            os.remove( temp_filepath )
+        if os.path.exists( temp_filepath ):
+            existing_bytes = os.path.getsize( temp_filepath )
+        range_headers = { 'Range': 'bytes=%s-' % existing_bytes } if existing_bytes else None
+        r = self.token_manager.authorized_get( file_url, endpoint='file', headers=range_headers, stream=True )
+        log.debug( 'r.status_code, `%s`' % r.status_code )
         try:
-            with open(filepath, 'wb') as file_handler:
-                file_handler.write( err_output )
-                log.debug( 'file written to ```%s```' % filepath )
-        except Exception as e:
-            message = 'exception writing error-output file, ```%s```; raising Exception' % e
-            log.error( message )
-            raise Exception( message )
-        return
-
-
+            if r.status_code == 206:
+                log.debug( 'resuming at byte, `%s`' % existing_bytes )
+                with open( temp_filepath, 'rb' ) as existing_handler:  # the checksum and record-check cover the whole file
+                    for chunk in iter( lambda: existing_handler.read(self.download_chunk_bytes), b'' ):
+                        hasher.update( chunk )
+                        checker.feed( chunk )
+                mode = 'ab'
+            elif r.status_code == 200:
+                ( existing_bytes, mode ) = ( 0, 'wb' )  # a fresh download, or the server ignored the range
+            elif r.status_code == 416:
+                os.remove( temp_filepath )
+                raise requests.exceptions.ConnectionError( 'range not satisfiable for partial file; restarting download' )
+            else:
+                message = 'problem: bad status_code, `%s`; r.content, ```%s```; raising Exception' % ( r.status_code, r.content )
+                log.error( message )
+                raise Exception( message )
+            ( byte_count, marc_bytes ) = ( existing_bytes, existing_bytes )
+            with open( temp_filepath, mode ) as file_handler:
+                for chunk in r.iter_content( chunk_size=self.download_chunk_bytes ):
+                    checker.feed( chunk )
+                    marc_bytes += len( chunk )
+                    output = compressor.compress( chunk ) if compressor else chunk
+                    file_handler.write( output )
+                    hasher.update( output )
+                    byte_count += len( output )
+                if compressor:
+                    output = compressor.flush()
+                    file_handler.write( output )
+                    hasher.update( output )
+                    byte_count += len( output )
+                file_handler.flush()
+                os.fsync( file_handler.fileno() )
+        finally:
+            r.close()
+        structure = checker.finish()
+        validation_error = None
+        if not structure['valid']:
+            validation_error = 'structural error after `%s` good records, at byte-offset `%s`: %s' % (
+                structure['record_count'], structure['first_bad_offset'], structure['error'] )
+        return {
+            'file_bytes': byte_count, 'file_sha256': hasher.hexdigest(), 'marc_bytes': marc_bytes,
+            'record_count': structure['record_count'], 'records_valid': structure['valid'], 'validation_error': validation_error }
 
     ## end of MarcHelper()
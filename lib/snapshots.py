@@ -0,0 +1,109 @@
+import datetime, json, logging, os, shutil, sys
+sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import logical_name, marc_file_paths
+from lib.tracker import TrackerHelper
+from lib.validation_cache import file_sha256
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading snapshots module' )
+
+
+class SnapshotStore( object ):
+    """ Keeps each completed export as its own snapshot directory, before the next run clears the download directory.
+        A file whose sha256 matches one in the previous snapshot is hardlinked to it, so unchanged ranges share an inode across snapshots
+          and take no new space; downstream consumers can skip a file whose inode (or `snapshot.json` hash) hasn't changed.
+        This saves space only: every file was still downloaded and written in full, and the download directory's copy is dropped when it's next cleared.
+        Changed files are hardlinked from the download directory, or copied if it's on another filesystem. """
+
+    def __init__( self ):
+        self.SNAPSHOT_DIR = os.environ['SBE__SNAPSHOT_DIR']
+        self.FILE_DOWNLOAD_DIR = os.environ['SBE__FILE_DOWNLOAD_DIR']
+        self.retention = int( os.environ.get('SBE__SNAPSHOT_RETENTION', '4') )  # snapshots kept, including the newest
+        self.manifest_file_name = 'snapshot.json'
+
+    def take_snapshot( self, tracker ):
+        """ Snapshots the validated export's *.mrc files; returns the snapshot's name, or None if the export isn't ready or is already snapshotted.
+            Called by `if __name__ == '__main__':` """
+        if not tracker.get( 'files_validated', False ) or [ entry for entry in tracker['batches'] if entry['last_grabbed'] is None ]:
+            log.debug( 'export not complete and validated; no snapshot' )
+            return None
+        if tracker.get( 'snapshot_name', None ):
+            log.debug( 'export already snapshotted as `%s`' % tracker['snapshot_name'] )
+            return None
+        ( previous, previous_files ) = self.load_previous()
+        by_hash = { entry['sha256']: '%s/%s/%s' % (self.SNAPSHOT_DIR, previous, file_name) for ( file_name, entry ) in previous_files.items() }
+        tracker_hashes = { entry['file_name']: entry for entry in tracker['batches'] if entry.get('file_sha256', None) }
+        snapshot_name = datetime.datetime.now().strftime( '%Y%m%d_%H%M%S' )
+        ( snapshot_path, files, linked_count ) = ( '%s/%s' % (self.SNAPSHOT_DIR, snapshot_name), {}, 0 )
+        os.makedirs( '%s.part' % snapshot_path )
+        for file_path in marc_file_paths( self.FILE_DOWNLOAD_DIR ):
+            file_name = os.path.basename( file_path )
+            file_bytes = os.path.getsize( file_path )
+            tracked = tracker_hashes.get( logical_name(file_name), {} )  # the tracker knows compressed files by their .mrc name
+            sha256 = tracked['file_sha256'] if tracked.get( 'file_bytes', None ) == file_bytes else file_sha256( file_path )  # salvaged files no longer match the download
+            target_path = '%s.part/%s' % ( snapshot_path, file_name )
+            unchanged = sha256 in by_hash
+            self.link_or_copy( by_hash[sha256] if unchanged else file_path, target_path )
+            linked_count += 1 if unchanged else 0
+            files[file_name] = { 'sha256': sha256, 'bytes': file_bytes, 'unchanged': unchanged }
+        with open( '%s.part/%s' % (snapshot_path, self.manifest_file_name), 'w' ) as f:
+            f.write( json.dumps({'previous': previous, 'files': files}, sort_keys=True, indent=2) )
+        os.replace( '%s.part' % snapshot_path, snapshot_path )  # a snapshot directory without `.part` is always complete
+        tracker['snapshot_name'] = snapshot_name
+        log.info( 'snapshot `%s`: `%s` files, `%s` unchanged from `%s`' % (snapshot_name, len(files), linked_count, previous) )
+        self.apply_retention()
+        return snapshot_name
+
+    def load_previous( self ):
+        """ Returns ( name, files-dict ) of the newest complete snapshot, or ( None, {} ).
+            Called by take_snapshot() """
+        names = self.list_snapshots()
+        if not names:
+            return ( None, {} )
+        with open( '%s/%s/%s' % (self.SNAPSHOT_DIR, names[-1], self.manifest_file_name), 'r' ) as f:
+            return ( names[-1], json.loads(f.read())['files'] )
+
+    def list_snapshots( self ):
+        """ Returns complete snapshot names, oldest first; the timestamp names sort chronologically.
+            Called by load_previous() and apply_retention() """
+        return sorted( name for name in os.listdir(self.SNAPSHOT_DIR)
+            if not name.endswith('.part') and os.path.isfile('%s/%s/%s' % (self.SNAPSHOT_DIR, name, self.manifest_file_name)) )
+
+    def link_or_copy( self, source_path, target_path ):
+        """ Hardlinks source to target; copies if they're on different filesystems.
+            Called by take_snapshot() """
+        try:
+            os.link( source_path, target_path )
+        except OSError as e:
+            log.debug( 'hardlink failed, ```%s```; copying' % e )
+            shutil.copy2( source_path, target_path )
+        return
+
+    def apply_retention( self ):
+        """ Removes the oldest snapshots beyond the retention count; files still linked from newer snapshots survive via their other links.
+            Called by take_snapshot() """
+        names = self.list_snapshots()
+        for name in names[:max( len(names) - self.retention, 0 )]:
+            log.debug( 'removing snapshot `%s`' % name )
+            shutil.rmtree( '%s/%s' % (self.SNAPSHOT_DIR, name) )
+        return
+
+    ## end class SnapshotStore()
+
+
+if __name__ == '__main__':
+    log.debug( 'starting snapshot' )
+    tracker_helper = TrackerHelper()
+    tracker = tracker_helper.grab_tracker_file()
+    if SnapshotStore().take_snapshot( tracker ):
+        tracker_helper.save_tracker( tracker, changed_batches=[] )
+        tracker_helper.export_tracker_json( tracker )
+    log.debug( 'complete' )
@@ -1,6 +1,12 @@
-import datetime, glob, json, logging, math, os, pprint
+import datetime, glob, itertools, json, logging, math, os, pprint, threading, time
 import requests
 from requests.auth import HTTPBasicAuth
+from lib.auth import get_token_manager
+from lib.bib_inventory import BibInventory, build_inventory, pack_batches
+from lib.client import get_http_client
+from lib.range_history import RangeHistory
+from lib.tracker_store import TrackerStore
+from lib.validation_cache import ValidationCache
 
 logging.basicConfig(
     filename=os.environ['SBE__LOG_PATH'],
@@ -21,38 +27,129 @@ class TrackerHelper( object ):
         self.TRACKER_FILEPATH = os.environ['SBE__TRACKER_JSON_PATH']
         self.LASTBIB_URL = os.environ['SBE__LASTBIB_URL']
         self.chunk_number_of_bibs = json.loads( os.environ['SBE__CHUNK_NUMBER_OF_BIBS_JSON'] )  # normally null -> None, or an int
+        self.target_records_per_batch = int( os.environ.get('SBE__TARGET_RECORDS_PER_BATCH', '1800') )  # headroom below the 2000-record limit; overflows are split
+        self.max_batch_span = int( os.environ.get('SBE__MAX_BATCH_SPAN', '100000') )  # widest bib-range a sparse batch may cover
+        self.min_split_span = int( os.environ.get('SBE__MIN_SPLIT_SPAN', '50') )  # failed ranges this narrow are no longer bisected; each level costs two more export-jobs
+        self.INVENTORY_PATH = os.environ.get( 'SBE__BIB_INVENTORY_PATH', None )  # optional; when set, batches are planned from a prepass of live bib-ids
+        self.inventory_records_per_batch = int( os.environ.get('SBE__INVENTORY_RECORDS_PER_BATCH', str(self.target_records_per_batch)) )  # below the job-limit, leaving room for suppressed bibs
+        if not 0 < self.inventory_records_per_batch < 2000:
+            message = 'SBE__INVENTORY_RECORDS_PER_BATCH, `%s`, must be 1-1999, below the 2000-record export-job limit; raising Exception' % self.inventory_records_per_batch
+            log.error( message )
+            raise Exception( message )
         self.last_bibber = LastBibHelper()
         self.FILE_DOWNLOAD_DIR = os.environ['SBE__FILE_DOWNLOAD_DIR']
+        self.http_client = get_http_client()
+        self.lock = threading.RLock()  # pipelined mode updates the tracker from download-worker threads
+        self.range_history = RangeHistory()
+        self.TRACKER_DB_PATH = os.environ.get( 'SBE__TRACKER_DB_PATH', None )  # optional; when set, batches are saved per-row and tracker.json is an export
+        self.worker_id = os.environ.get( 'SBE__WORKER_ID', None )  # optional; when set, batches are leased from the shared store, so several hosts can export at once
+        self.store = TrackerStore( self.TRACKER_DB_PATH, shared=bool(self.worker_id) ) if self.TRACKER_DB_PATH else None
+        self.lease_seconds = int( os.environ.get('SBE__LEASE_SECONDS', '900') )  # an unfinished claim is re-offered to other workers after this
+        self.setup_wait_seconds = int( os.environ.get('SBE__TRACKER_SETUP_WAIT_SECONDS', '3600') )  # how long other workers wait for the first to plan batches
+        if self.worker_id and not self.store:
+            message = 'SBE__WORKER_ID requires SBE__TRACKER_DB_PATH, for the shared batch-leases; raising Exception'
+            log.error( message )
+            raise Exception( message )
+        ( self.indexed_tracker, self.batch_index, self.cursor ) = ( None, {}, 0 )  # see index_tracker()
 
     def grab_tracker_file( self ):
-        """ Returns (creates if necessary) tracker from json file.
+        """ Returns (creates if necessary) tracker from json file, or from the store if configured.
+            With leasing, only the worker whose create_if_missing() succeeds clears the download-directory and plans batches;
+              the others wait for its batches (see wait_for_batches()), so concurrent starts can't clear each other's work.
             Called by controller.check_tracker_file() """
+        tracker = None
         try:
-            with open(self.TRACKER_FILEPATH, 'rb') as f:
-                tracker = json.loads( f.read() )
+            if self.store:
+                tracker = self.store.load() if self.store.exists() else None
+            else:
+                with open(self.TRACKER_FILEPATH, 'rb') as f:
+                    tracker = json.loads( f.read() )
         except Exception as e:
-            log.warning( 'problem getting tracker file, ```%s```; will clear download-directory and creating tracker file' % e )
+            log.warning( 'problem getting tracker file, ```%s```' % e )
+        if tracker is None and self.leasing():
+            tracker = {
+                'last_updated': str(datetime.datetime.now()), 'last_bib': None, 'batches': [], 'files_validated': False }
+            if self.store.create_if_missing( tracker ):
+                log.warning( 'no tracker; worker `%s` created it, and will clear download-directory' % self.worker_id )
+                self.clear_download_directory()
+                return tracker
+            tracker = None
+        if self.leasing() and ( tracker is None or not tracker['batches'] ):
+            tracker = self.wait_for_batches()
+        if tracker is None:
+            log.warning( 'no tracker; will clear download-directory and create tracker' )
             self.clear_download_directory()
-            with open(self.TRACKER_FILEPATH, 'wb') as f:
-                tracker = {
-                    'last_updated': str(datetime.datetime.now()), 'last_bib': None, 'batches': [], 'files_validated': False }
-                f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+            if self.store:
+                self.store.clear()
+            tracker = {
+                'last_updated': str(datetime.datetime.now()), 'last_bib': None, 'batches': [], 'files_validated': False }
+            self.save_tracker( tracker )
         log.debug( 'tracker[-500], ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
         return tracker
 
+    def wait_for_batches( self ):
+        """ Waits, up to `setup_wait_seconds`, for the worker setting up the export to save its batches; returns the loaded tracker.
+            Called by grab_tracker_file() """
+        deadline = time.time() + self.setup_wait_seconds
+        while self.store.batch_count() == 0:
+            if time.time() > deadline:
+                message = 'no batches planned by another worker after `%s` seconds; raising Exception' % self.setup_wait_seconds
+                log.error( message )
+                raise Exception( message )
+            log.debug( 'waiting for another worker to plan batches' )
+            time.sleep( 10 )
+        return self.store.load()
+
+    def save_tracker( self, tracker, changed_batches=None ):
+        """ Persists the tracker: with the store, only tracker-level fields and `changed_batches` (default: all) are written;
+              otherwise tracker.json is rewritten atomically.
+            Called by methods that change the tracker """
+        with self.lock:
+            if self.store:
+                self.store.save( tracker, changed_batches )
+            else:
+                temp_filepath = '%s.tmp' % self.TRACKER_FILEPATH
+                with open(temp_filepath, 'wb') as f:
+                    f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+                os.replace( temp_filepath, self.TRACKER_FILEPATH )
+        return
+
+    def export_tracker_json( self, tracker ):
+        """ Writes the web-accessible tracker.json from the store; a no-op without one, since the json is then always current.
+            Called by controller at the end of a run """
+        if self.store:
+            with self.lock:
+                self.store.export_json( self.TRACKER_FILEPATH )
+        return
+
+    def index_tracker( self, tracker ):
+        """ Builds the file_name lookup and resets the next-batch cursor when a different tracker is passed in.
+            Called by get_next_batch(), update_tracker(), split_batch() """
+        if tracker is not self.indexed_tracker:
+            self.batch_index = { entry['file_name']: entry for entry in tracker['batches'] }
+            ( self.indexed_tracker, self.cursor ) = ( tracker, 0 )
+        return
+
     def clear_download_directory( self ):
         """ Empties download directory of existing files.
             Reason: new file should overwrite previous ones, and the names should be sequential so this should not be needed,
                     but I've noticed occasional file datestamp odditites.
+            Also drops the directory's validation-cache entries, so re-used file-names are checked afresh.
             Called by grab_tracker_file() """
         filepath_list = glob.glob( '%s/*.mrc' % self.FILE_DOWNLOAD_DIR )
         filepath_list.extend( glob.glob('%s/*.txt' % self.FILE_DOWNLOAD_DIR) )
+        filepath_list.extend( glob.glob('%s/*.part' % self.FILE_DOWNLOAD_DIR) )
+        filepath_list.extend( glob.glob('%s/*.mrc.*' % self.FILE_DOWNLOAD_DIR) )  # compressed files
+        filepath_list.extend( glob.glob('%s/*.txt.*' % self.FILE_DOWNLOAD_DIR) )
+        filepath_list.extend( glob.glob('%s/*_quarantine.json' % self.FILE_DOWNLOAD_DIR) )
+        filepath_list.extend( glob.glob('%s/*.jsonl.gz' % self.FILE_DOWNLOAD_DIR) )
         if len( filepath_list ) == 0:
             log.debug( 'no files to delete' )
         else:
-            for f in filepath_list:
+            for f in sorted( set(filepath_list) ):  # a compressed .part matches two patterns
                 log.debug( 'about to remove filepath, %s```' % f )
                 os.remove( f )
+        ValidationCache().forget_directory( self.FILE_DOWNLOAD_DIR )
         log.debug( 'deletion-step complete' )
         return
 
@@ -65,8 +162,7 @@ class TrackerHelper( object ):
             last_bib = self.grab_last_bib( )
             tracker['last_bib'] = last_bib
             tracker['last_updated'] = datetime.datetime.now().isoformat()
-            with open(self.TRACKER_FILEPATH, 'wb') as f:
-                f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+            self.save_tracker( tracker, changed_batches=[] )
         log.debug( 'tracker[-500], ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
         return tracker
 
@@ -74,7 +170,7 @@ class TrackerHelper( object ):
         """ Hits last-bib url.
             Called by check_tracker_lastbib() """
         try:
-            r = requests.get( self.LASTBIB_URL, timeout=10 )
+            r = self.http_client.get( self.LASTBIB_URL, endpoint='last_bib_url' )
             last_bib = r.json()['id']
         except Exception as e:
             message = 'problem getting last bib, ```%s```; raising Exception' % e
@@ -102,61 +198,216 @@ class TrackerHelper( object ):
         log.debug( 'no batches in tracker; will add')
         tracker['batches'] = []
         tracker = self.prepare_tracker_batches( tracker, start_bib, end_bib )
-        with open(self.TRACKER_FILEPATH, 'wb') as f:
-            f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+        self.save_tracker( tracker )
         log.debug( 'tracker[-500:], ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
         return tracker
 
     def prepare_tracker_batches( self, tracker, start_bib, end_bib ):
-        """ Prepares the batches.
+        """ Prepares the batches, sized by the record-density observed in previous runs.
+            Walks the 2000-bib grid; ranges known to be fully deleted are left out, and consecutive sparse ranges are combined
+              while their estimated records stay within the target. Without history every batch is a single 2000-bib range, as before.
+            File-numbering still counts every grid range, so a given file-name always starts at the same bib.
             Called by check_tracker_batches() """
+        if self.INVENTORY_PATH and self.chunk_number_of_bibs is None:
+            return self.prepare_inventory_batches( tracker, start_bib, end_bib )
         # ( chunk_start_bib, chunk_end_bib, file_count ) = ( start_bib, start_bib + 2000, 0 )  # 2000 is api-limit
-        ( chunk_start_bib, file_count ) = ( start_bib, 0 )
-        chunk_end_bib = start_bib + 2000 if self.chunk_number_of_bibs is None else start_bib + self.chunk_number_of_bibs
+        ( chunk_start_bib, file_count, skipped_count, batch ) = ( start_bib, 0, 0, None )
+        chunk_span = 2000 if self.chunk_number_of_bibs is None else self.chunk_number_of_bibs
         while chunk_start_bib < end_bib:
-            chunk_dct = { 'chunk_start_bib': chunk_start_bib, 'chunk_end_bib': chunk_end_bib, 'last_grabbed': None, 'file_name': 'sierra_export_%s.mrc' % str(file_count).rjust( 4, '0' ) }
-            tracker['batches'].append( chunk_dct )
+            chunk_end_bib = chunk_start_bib + chunk_span
+            if self.range_history.is_dead( chunk_start_bib, chunk_end_bib ):
+                skipped_count += 1
+            else:
+                estimated_records = self.range_history.estimate_records( chunk_start_bib, chunk_end_bib )
+                if batch and self.chunk_number_of_bibs is None and ( batch['estimated_records'] + estimated_records ) <= self.target_records_per_batch and ( chunk_end_bib - batch['chunk_start_bib'] ) <= self.max_batch_span:
+                    batch['chunk_end_bib'] = chunk_end_bib
+                    batch['estimated_records'] += estimated_records
+                else:
+                    batch = { 'chunk_start_bib': chunk_start_bib, 'chunk_end_bib': chunk_end_bib, 'last_grabbed': None, 'file_name': 'sierra_export_%s.mrc' % str(file_count).rjust( 4, '0' ), 'estimated_records': estimated_records }
+                    tracker['batches'].append( batch )
             chunk_start_bib += 2000  # 2000 is api-limit
-            chunk_end_bib += 2000
             file_count += 1
+        log.info( '`%s` batches planned; `%s` known-dead ranges skipped' % (len(tracker['batches']), skipped_count) )
         tracker['last_updated'] = datetime.datetime.now().isoformat()
         log.debug( 'tracker[-500:], ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
         return tracker
 
-    def get_next_batch( self, tracker ):
-        """ Returns the next batch of bibs to grab.
-            Called by controller.manage_download() """
+    def prepare_inventory_batches( self, tracker, start_bib, end_bib ):
+        """ Prepares batches of exactly `inventory_records_per_batch` live bibs each (the last one short), from a fresh inventory of live bib-ids.
+            Each batch is still requested as a range -- first to last of its ids -- so the request stays small. The export-job also returns the range's
+              suppressed bibs, which the inventory leaves out, so batches are packed below the 2000-record limit, and one that fills it is split
+              like any other wide batch (see sierra.MarcHelper.needs_split()). Sparse stretches of the catalog then cost one export-job per ~2000 records,
+              rather than one per 2000 ids.
+            Called by prepare_tracker_batches() """
+        build_inventory( self.INVENTORY_PATH, start_bib, end_bib )
+        inventory = BibInventory( self.INVENTORY_PATH )
+        try:
+            for ( file_count, ( first_id, last_id, count ) ) in enumerate( pack_batches(inventory.bib_ids, self.inventory_records_per_batch) ):
+                tracker['batches'].append( {
+                    'chunk_start_bib': first_id, 'chunk_end_bib': last_id, 'last_grabbed': None,
+                    'file_name': 'sierra_export_%s.mrc' % str(file_count).rjust( 4, '0' ), 'inventory_records': count } )
+            tracker['inventory_count'] = len( inventory )
+        finally:
+            inventory.close()
+        log.info( '`%s` batches planned from `%s` live bibs' % (len(tracker['batches']), tracker['inventory_count']) )
+        tracker['last_updated'] = datetime.datetime.now().isoformat()
+        return tracker
+
+    def split_batch( self, batch, tracker ):
+        """ Replaces a failed or over-full batch with its two halves, queued right after it, so a bad sub-range gets isolated by repeated bisection.
+            Returns False if the range is already too narrow to split.
+            Called by controller.request_batch() """
+        ( start_bib, end_bib ) = ( batch['chunk_start_bib'], batch['chunk_end_bib'] )
+        if ( end_bib - start_bib ) <= self.min_split_span:
+            log.error( 'range, `%s-%s`, of ```%s``` is too narrow to split further; if its job failed, it\'s listed in the tracker\'s `failed_ranges` once files are validated' % (
+                start_bib, end_bib, batch['file_name']) )
+            return False
+        file_stem = batch['file_name'].replace( '.mrc', '' )
+        if batch.get( 'bib_ids', None ):  # delta batch; halve the id-list
+            middle = len( batch['bib_ids'] ) // 2
+            ( first_ids, second_ids ) = ( batch['bib_ids'][:middle], batch['bib_ids'][middle:] )
+            halves = [
+                { 'chunk_start_bib': first_ids[0], 'chunk_end_bib': first_ids[-1], 'bib_ids': first_ids, 'last_grabbed': None, 'file_name': '%s_1.mrc' % file_stem },
+                { 'chunk_start_bib': second_ids[0], 'chunk_end_bib': second_ids[-1], 'bib_ids': second_ids, 'last_grabbed': None, 'file_name': '%s_2.mrc' % file_stem } ]
+        else:
+            middle_bib = ( start_bib + end_bib ) // 2
+            halves = [
+                { 'chunk_start_bib': start_bib, 'chunk_end_bib': middle_bib, 'last_grabbed': None, 'file_name': '%s_1.mrc' % file_stem },
+                { 'chunk_start_bib': middle_bib + 1, 'chunk_end_bib': end_bib, 'last_grabbed': None, 'file_name': '%s_2.mrc' % file_stem } ]
+        with self.lock:
+            self.index_tracker( tracker )
+            entry = self.batch_index[ batch['file_name'] ]
+            entry['last_grabbed'] = datetime.datetime.now().isoformat()
+            entry['split_into'] = [ half['file_name'] for half in halves ]
+            index = tracker['batches'].index( entry, self.cursor )  # un-grabbed until now, so at or after the cursor
+            tracker['batches'][index+1:index+1] = halves
+            self.batch_index.update( (half['file_name'], half) for half in halves )
+            tracker['last_updated'] = datetime.datetime.now().isoformat()
+            self.save_tracker( tracker, changed_batches=[entry] + halves )
+        log.info( 'split `%s` into ```%s```' % (batch['file_name'], halves) )
+        return True
+
+    def get_next_batch( self, tracker, skip_file_names=() ):
+        """ Returns the next batch of bibs to grab; `skip_file_names` holds batches already in-flight in pipelined mode.
+            The cursor only moves past grabbed batches, so each call scans just the in-flight ones instead of the whole list.
+            Called by controller.manage_download() and controller.manage_pipelined_download() """
+        if self.leasing():
+            return self.claim_next_batch( tracker )
         batch = None
-        for entry in tracker['batches']:
-            # twentyfour_hours_ago = datetime.datetime.now() + datetime.timedelta( hours=-24 )
-            # if entry['last_grabbed'] is None or datetime.datetime.strptime( entry['last_grabbed'], '%Y-%m-%dT%H:%M:%S.%f' ) < twentyfour_hours_ago:  # the second 'or' condition converts the isoformat-date back into a date-object to be able to compare
-            if entry['last_grabbed'] is None:
-                batch = entry
-                break
+        with self.lock:
+            self.index_tracker( tracker )
+            batches = tracker['batches']
+            while self.cursor < len( batches ) and batches[self.cursor]['last_grabbed'] is not None:
+                self.cursor += 1
+            for entry in itertools.islice( batches, self.cursor, None ):
+                # twentyfour_hours_ago = datetime.datetime.now() + datetime.timedelta( hours=-24 )
+                # if entry['last_grabbed'] is None or datetime.datetime.strptime( entry['last_grabbed'], '%Y-%m-%dT%H:%M:%S.%f' ) < twentyfour_hours_ago:  # the second 'or' condition converts the isoformat-date back into a date-object to be able to compare
+                if entry['last_grabbed'] is None and entry['file_name'] not in skip_file_names:
+                    batch = entry
+                    batch.setdefault( 'output_records', None )  # fields filled in during the request then only change value, so pipelined tracker-writes never see the dict resize
+                    break
         log.debug( 'batch, ```%s```' % pprint.pformat(batch) )
         return batch
 
-    def update_tracker( self, batch, tracker ):
-        """ Updates current batch information.
-            Called by controller.download_file() """
-        log.debug( 'tracker initially, ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
-        for entry in tracker['batches']:
-            if entry['chunk_start_bib'] == batch['chunk_start_bib']:
+    def leasing( self ):
+        """ Returns True if batches are leased from the shared store: SBE__WORKER_ID is set, and the store is in use --
+              the delta and json modes keep their own plain-json trackers (store None), so run as a single worker.
+            Called by get_next_batch() and release_batch() """
+        return bool( self.worker_id ) and self.store is not None
+
+    def claim_next_batch( self, tracker ):
+        """ Returns the next batch leased to this worker from the shared store, merged into the in-memory tracker; None when none are left unclaimed.
+            The store's row is authoritative -- another worker may have added it (eg a split's halves) -- and its lease keeps it off the other workers.
+            Called by get_next_batch() """
+        with self.lock:
+            self.index_tracker( tracker )
+            claimed = self.store.claim_batch( self.worker_id, self.lease_seconds )
+            batch = None
+            if claimed is not None:
+                batch = self.batch_index.get( claimed['file_name'], None )
+                if batch is None:
+                    tracker['batches'].append( claimed )
+                    self.batch_index[ claimed['file_name'] ] = claimed
+                    batch = claimed
+                else:
+                    batch.update( claimed )
+                batch.setdefault( 'output_records', None )
+        log.debug( 'worker `%s` claimed batch, ```%s```' % (self.worker_id, pprint.pformat(batch)) )
+        return batch
+
+    def release_batch( self, batch ):
+        """ Gives up this worker's lease on an un-finished batch, eg when backing off, so another worker can take it; a no-op without leasing.
+            Called by controller.manage_download() and controller.manage_pipelined_download() """
+        if self.leasing() and batch is not None:
+            with self.lock:
+                self.store.release_batch( batch['file_name'], self.worker_id )
+            log.debug( 'worker `%s` released `%s`' % (self.worker_id, batch['file_name']) )
+        return
+
+    def update_tracker( self, batch, tracker, file_stats=None ):
+        """ Updates current batch information, including its outcome ('ok', 'zero_records', 'failed', 'invalid') and the downloaded file's stats when given.
+            Called by controller.download_file() and controller.download_and_track() """
+        with self.lock:
+            self.index_tracker( tracker )
+            entry = self.batch_index.get( batch['file_name'], None )  # a split batch's first half shares its chunk_start_bib, so match on file_name
+            if entry is not None:
+                entry.update( file_stats or {} )
                 entry['last_grabbed'] = datetime.datetime.now().isoformat()
                 tracker['last_updated'] = datetime.datetime.now().isoformat()
-                break
-        log.debug( 'tracker subsequently, ```%s```' % pprint.pformat(tracker)[-500:] + '...' )
-        with open(self.TRACKER_FILEPATH, 'wb') as f:
-            f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+                self.save_tracker( tracker, changed_batches=[entry] )
+            log.debug( 'tracker batch updated, ```%s```' % entry )
+        return
+
+    def record_salvage( self, tracker, file_name, salvage, reexport_ids, whole_range=False ):
+        """ Notes a salvaged file's results on its batch, and queues a batch of just the damaged records' bib-ids for re-export.
+            The re-export batch carries `bib_ids`, like delta batches, so it's requested as an id-list rather than a range.
+            With `whole_range`, for damage that couldn't be pinned to bib-ids, the re-export batch repeats the original batch's range (or id-list) instead.
+            Called by validator.FileChecker.salvage_file() """
+        with self.lock:
+            self.index_tracker( tracker )
+            entry = self.batch_index.get( file_name, None )
+            if entry is None:
+                log.warning( 'no tracker batch for ```%s```; salvage not recorded' % file_name )
+                return
+            changed_batches = [ entry ]
+            if whole_range and entry.get( 'reexport_of', None ):  # don't chain re-exports of a range that keeps failing
+                log.error( '```%s``` is already a re-export; not queuing another -- its range needs a manual look' % file_name )
+                ( whole_range, reexport_ids ) = ( False, [] )
+            elif whole_range:
+                reexport_ids = entry.get( 'bib_ids', None )
+                reexport = {
+                    'chunk_start_bib': entry['chunk_start_bib'], 'chunk_end_bib': entry['chunk_end_bib'], 'last_grabbed': None,
+                    'file_name': file_name.replace( '.mrc', '_reexport.mrc' ), 'reexport_of': file_name }
+                if reexport_ids:
+                    reexport['bib_ids'] = reexport_ids
+            elif reexport_ids:
+                reexport = {
+                    'chunk_start_bib': reexport_ids[0], 'chunk_end_bib': reexport_ids[-1], 'bib_ids': reexport_ids, 'last_grabbed': None,
+                    'file_name': file_name.replace( '.mrc', '_reexport.mrc' ), 'reexport_of': file_name }
+            if whole_range or reexport_ids:
+                tracker['batches'].append( reexport )
+                self.batch_index[ reexport['file_name'] ] = reexport
+                changed_batches.append( reexport )
+                salvage['reexport_file_name'] = reexport['file_name']
+            entry['salvage'] = salvage
+            tracker['last_updated'] = datetime.datetime.now().isoformat()
+            self.save_tracker( tracker, changed_batches=changed_batches )
+        log.debug( 'salvage recorded for ```%s```, ```%s```' % (file_name, salvage) )
         return
 
     def update_validation_status( self, tracker ):
-        """ Sets files_validated to True.
+        """ Sets files_validated to True, and lists the ranges whose export-jobs failed (and couldn't be split further) in `failed_ranges`.
             Called by validator.FileChecker.validate_marc_files() """
+        tracker['failed_ranges'] = [
+            { 'file_name': entry['file_name'], 'chunk_start_bib': entry['chunk_start_bib'], 'chunk_end_bib': entry['chunk_end_bib'] }
+            for entry in tracker['batches'] if entry.get( 'outcome', None ) == 'failed' ]
+        if tracker['failed_ranges']:
+            log.error( '`%s` ranges failed to export; their bibs are missing from the download, ```%s```' % (
+                len(tracker['failed_ranges']), tracker['failed_ranges']) )
         tracker['files_validated'] = True
         tracker['last_updated'] = datetime.datetime.now().isoformat()
-        with open(self.TRACKER_FILEPATH, 'wb') as f:
-            f.write( json.dumps(tracker, sort_keys=True, indent=2).encode('utf-8') )
+        self.save_tracker( tracker, changed_batches=[] )
+        self.export_tracker_json( tracker )
         log.debug( 'files validated; tracker updated')
         return
 
@@ -170,30 +421,16 @@ class LastBibHelper( object):
         self.API_ROOT_URL = os.environ['SBE__ROOT_URL']
         self.HTTPBASIC_KEY = os.environ['SBE__HTTPBASIC_USERNAME']
         self.HTTPBASIC_SECRET = os.environ['SBE__HTTPBASIC_PASSWORD']
-        self.custom_headers = None
-
+        self.token_manager = get_token_manager( self.API_ROOT_URL, self.HTTPBASIC_KEY, self.HTTPBASIC_SECRET )
 
     def get_last_bib( self ):
         """ Controller to manage call to api to obtain last-bib.
             Called by TrackerHelper.check_tracker_lastbib()
             TODO: replace with J.M. method of posting a json query to the api to really get the last bib. """
-        token = self.get_token()
-        last_bib = self.get_api_last_bib( token )
+        last_bib = self.get_api_last_bib()
         return last_bib
 
-    def get_token( self ):
-        """ Gets api token.
-            Called by get_last_bib() """
-        token_url = '%stoken' % self.API_ROOT_URL
-        log.debug( 'token_url, ```%s```' % token_url )
-        r = requests.post( token_url, auth=HTTPBasicAuth(self.HTTPBASIC_KEY, self.HTTPBASIC_SECRET) )
-        log.debug( 'token r.content, ```%s```' % r.content )
-        token = r.json()['access_token']
-        log.debug( 'token, ```%s```' % token )
-        self.custom_headers = {'Authorization': 'Bearer %s' % token }  # for use in subsequent request
-        return
-
-    def get_api_last_bib( self, token ):
+    def get_api_last_bib( self ):
         """ Hits api and obtains last bib (really first bib for last day).
             Called by get_last_bib() """
         log.debug( '\n-------\ngetting end-bib\n-------' )
@@ -203,7 +440,7 @@ class LastBibHelper( object):
         end_datetime = '%sT23:59:59Z' % today_date
         payload = {
             'limit': '1', 'createdDate': '[%s,%s]' % (start_datetime, end_datetime)  }
-        r = requests.get( bib_url, headers=self.custom_headers, params=payload )
+        r = self.token_manager.authorized_get( bib_url, endpoint='bibs', params=payload )
         log.debug( 'bib r.content, ```%s```' % r.content )
         api_lastbib = r.json()['entries'][0]['id']
         log.debug( 'api_lastbib, `%s`' % api_lastbib )
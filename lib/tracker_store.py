@@ -0,0 +1,138 @@
+import json, logging, os, sqlite3, sys, time
+sys.path.append( os.path.abspath(os.getcwd()) )
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
+log.debug( 'loading tracker_store module' )
+
+
+class TrackerStore( object ):
+    """ SQLite-backed tracker: each batch is a row, so completing a batch is one small transaction instead of a whole-file rewrite.
+        tracker.json stays the web-accessible view, written on demand via export_json().
+        Used by tracker.TrackerHelper when SBE__TRACKER_DB_PATH is set.
+        With `shared` (several workers, possibly on different hosts), the db uses a rollback journal rather than WAL: WAL's index lives in
+          shared memory on one host, so it isn't safe over NFS/SMB; writes then rely on the file-locks taken by `BEGIN IMMEDIATE`. """
+
+    def __init__( self, db_path, shared=False ):
+        self.db_path = db_path
+        self.connection = sqlite3.connect( db_path, timeout=30, check_same_thread=False )  # TrackerHelper serializes access with its lock; other workers' writes are waited on
+        if shared:
+            self.connection.execute( 'PRAGMA journal_mode=DELETE' )  # also converts a db left in WAL mode by a single-worker run
+            self.connection.execute( 'PRAGMA synchronous=FULL' )
+        else:
+            self.connection.execute( 'PRAGMA journal_mode=WAL' )
+            self.connection.execute( 'PRAGMA synchronous=NORMAL' )  # with WAL, commits survive process crashes and skip the per-commit fsync
+        with self.connection:
+            self.connection.execute( 'CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value TEXT )' )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS batches ( file_name TEXT PRIMARY KEY, chunk_start_bib INTEGER, last_grabbed TEXT, data TEXT )' )
+            columns = [ row[1] for row in self.connection.execute('PRAGMA table_info(batches)') ]
+            for ( column, column_type ) in ( ('lease_owner', 'TEXT'), ('lease_expires', 'REAL') ):  # added for multi-worker claiming
+                if column not in columns:
+                    self.connection.execute( 'ALTER TABLE batches ADD COLUMN %s %s' % (column, column_type) )
+
+    def exists( self ):
+        """ Returns True if a tracker has been saved.
+            Called by tracker.TrackerHelper.grab_tracker_file() """
+        return self.connection.execute( 'SELECT COUNT(*) FROM meta' ).fetchone()[0] > 0
+
+    def load( self ):
+        """ Returns the tracker dict, batches ordered by start-bib (a split batch's halves follow it).
+            Called by tracker.TrackerHelper.grab_tracker_file() """
+        tracker = { key: json.loads(value) for ( key, value ) in self.connection.execute('SELECT key, value FROM meta') }
+        tracker['batches'] = [
+            json.loads( data ) for ( data, ) in self.connection.execute( 'SELECT data FROM batches ORDER BY chunk_start_bib, file_name' ) ]
+        return tracker
+
+    def save( self, tracker, batches=None ):
+        """ Saves tracker-level fields and the given batches (default: all) in one transaction.
+            Called by tracker.TrackerHelper.save_tracker() """
+        batches = tracker['batches'] if batches is None else batches
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO meta ( key, value ) VALUES ( ?, ? )',
+                [ (key, json.dumps(value)) for ( key, value ) in tracker.items() if key != 'batches' ] )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO batches ( file_name, chunk_start_bib, last_grabbed, data ) VALUES ( ?, ?, ?, ? )',
+                [ (batch['file_name'], batch['chunk_start_bib'], batch['last_grabbed'], json.dumps(batch, sort_keys=True)) for batch in batches ] )
+        return
+
+    def claim_batch( self, worker_id, lease_seconds ):
+        """ Leases the first un-grabbed batch that isn't leased (or whose lease has expired) to `worker_id`; returns its data, or None.
+            The select-and-lease runs in one write-transaction, so concurrent workers never claim the same batch.
+            Saving a batch (see save()) replaces its row, which clears the lease.
+            Called by tracker.TrackerHelper.claim_next_batch() """
+        now = time.time()
+        with self.connection:
+            self.connection.execute( 'BEGIN IMMEDIATE' )
+            row = self.connection.execute(
+                'SELECT file_name, data, lease_owner FROM batches WHERE last_grabbed IS NULL AND ( lease_expires IS NULL OR lease_expires < ? ) '
+                'ORDER BY chunk_start_bib, file_name LIMIT 1', (now,) ).fetchone()
+            if row is None:
+                return None
+            ( file_name, data, previous_owner ) = row
+            self.connection.execute(
+                'UPDATE batches SET lease_owner = ?, lease_expires = ? WHERE file_name = ?', (worker_id, now + lease_seconds, file_name) )
+        if previous_owner:
+            log.warning( 'reclaimed `%s` from expired lease of `%s`' % (file_name, previous_owner) )
+        return json.loads( data )
+
+    def release_batch( self, file_name, worker_id ):
+        """ Gives up `worker_id`'s lease on the batch, so any worker can claim it right away.
+            Called by tracker.TrackerHelper.release_batch() """
+        with self.connection:
+            self.connection.execute(
+                'UPDATE batches SET lease_owner = NULL, lease_expires = NULL WHERE file_name = ? AND lease_owner = ?', (file_name, worker_id) )
+        return
+
+    def create_if_missing( self, tracker ):
+        """ Saves `tracker` as a new, empty export only if no tracker is saved yet; returns True if this call created it.
+            The check and the save run in one write-transaction, so when several workers start at once exactly one of them sets up the export.
+            Called by tracker.TrackerHelper.grab_tracker_file() """
+        with self.connection:
+            self.connection.execute( 'BEGIN IMMEDIATE' )
+            if self.connection.execute( 'SELECT COUNT(*) FROM meta' ).fetchone()[0] > 0:
+                return False
+            self.connection.execute( 'DELETE FROM batches' )
+            self.connection.executemany(
+                'INSERT INTO meta ( key, value ) VALUES ( ?, ? )', [ (key, json.dumps(value)) for ( key, value ) in tracker.items() if key != 'batches' ] )
+        return True
+
+    def batch_count( self ):
+        """ Returns the number of saved batches.
+            Called by tracker.TrackerHelper.wait_for_batches() """
+        return self.connection.execute( 'SELECT COUNT(*) FROM batches' ).fetchone()[0]
+
+    def clear( self ):
+        """ Removes the saved tracker, so the next run starts a new export.
+            Called by tracker.TrackerHelper.grab_tracker_file() """
+        with self.connection:
+            self.connection.execute( 'DELETE FROM meta' )
+            self.connection.execute( 'DELETE FROM batches' )
+        return
+
+    def export_json( self, json_path ):
+        """ Writes the tracker.json view atomically.
+            Called by tracker.TrackerHelper.export_tracker_json() and `if __name__ == '__main__':` """
+        temp_path = '%s.tmp' % json_path
+        with open( temp_path, 'wb' ) as f:
+            f.write( json.dumps(self.load(), sort_keys=True, indent=2).encode('utf-8') )
+        os.replace( temp_path, json_path )
+        log.debug( 'tracker exported to ```%s```' % json_path )
+        return
+
+    ## end class TrackerStore()
+
+
+if __name__ == '__main__':
+    log.debug( 'starting tracker export' )
+    store = TrackerStore( os.environ['SBE__TRACKER_DB_PATH'], shared=bool(os.environ.get('SBE__WORKER_ID', None)) )
+    store.export_json( os.environ['SBE__TRACKER_JSON_PATH'] )
+    log.debug( 'complete' )
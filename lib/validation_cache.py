@@ -0,0 +1,107 @@
+import hashlib, json, logging, os
+
+logging.basicConfig(
+    filename=os.environ['SBE__LOG_PATH'],
+    level=logging.DEBUG,
+    format='[%(asctime)s] %(levelname)s [%(module)s-%(funcName)s()::%(lineno)d] %(message)s',
+    datefmt='%d/%b/%Y %H:%M:%S'
+    )
+log = logging.getLogger(__name__)
+log.debug( 'loading validation_cache module' )
+
+
+class ValidationCache( object ):
+    """ Remembers each validated file's size, mtime, sha256, record-count, and check-mode, so validation reruns only check new or changed files.
+        A matching size and mtime is trusted as-is; a matching size with a new mtime is confirmed by hash before the cached result is reused.
+        Entries are keyed by full path, since full and delta exports use different download directories. """
+
+    def __init__( self ):
+        self.CACHE_FILEPATH = os.environ.get( 'SBE__VALIDATION_CACHE_JSON_PATH', None )  # optional; unset disables caching
+        self.files = {}  # file_path -> { 'size', 'mtime_ns', 'sha256', 'record_count', 'mode' }
+        self.dirty = False
+        self.load()
+
+    def load( self ):
+        """ Loads cache file, if configured and present.
+            Called by __init__() """
+        if not self.CACHE_FILEPATH:
+            return
+        try:
+            with open( self.CACHE_FILEPATH, 'r' ) as f:
+                self.files = json.loads( f.read() )['files']
+        except Exception as e:
+            log.warning( 'no validation-cache loaded, ```%s```; starting fresh' % e )
+            self.files = {}
+        log.debug( '`%s` cached validations loaded' % len(self.files) )
+        return
+
+    def lookup( self, file_path, mode ):
+        """ Returns the cached record-count if the file passed a check at least as thorough as `mode` and is unchanged; else None.
+            Called by validator.FileChecker.skip_cached() """
+        entry = self.files.get( file_path, None )
+        if entry is None or ( mode == 'deep' and entry['mode'] != 'deep' ):
+            return None
+        stat = os.stat( file_path )
+        if stat.st_size != entry['size']:
+            return None
+        if stat.st_mtime_ns != entry['mtime_ns']:
+            if file_sha256( file_path ) != entry['sha256']:
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns  # touched, not changed
+            self.dirty = True
+        return entry['record_count']
+
+    def remember( self, file_path, record_count, mode, sha256=None ):
+        """ Caches a passing result; `sha256` may be supplied from the tracker to save a read.
+            A no-op when caching is disabled, so nothing is re-read just to be discarded.
+            Called by validator.FileChecker """
+        if not self.CACHE_FILEPATH:
+            return
+        stat = os.stat( file_path )
+        self.files[ file_path ] = {
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256 or file_sha256( file_path ),
+            'record_count': record_count, 'mode': mode }
+        self.dirty = True
+        return
+
+    def forget( self, file_path ):
+        """ Drops a file's entry, eg once it's been quarantined.
+            Called by validator.FileChecker """
+        if self.files.pop( file_path, None ) is not None:
+            self.dirty = True
+        return
+
+    def forget_directory( self, directory ):
+        """ Drops every entry for files in `directory`, and saves.
+            Called by tracker.TrackerHelper.clear_download_directory() """
+        prefix = '%s/' % directory.rstrip( '/' )
+        for file_path in [ path for path in self.files if path.startswith(prefix) ]:
+            del self.files[ file_path ]
+            self.dirty = True
+        self.save()
+        return
+
+    def save( self ):
+        """ Writes cache atomically, if anything changed.
+            Called by validator.FileChecker.validate_marc_files() and forget_directory() """
+        if not self.CACHE_FILEPATH or not self.dirty:
+            return
+        temp_path = '%s.tmp' % self.CACHE_FILEPATH
+        with open( temp_path, 'w' ) as f:
+            f.write( json.dumps({'files': self.files}, sort_keys=True) )
+        os.replace( temp_path, self.CACHE_FILEPATH )
+        self.dirty = False
+        log.debug( 'validation-cache saved; `%s` files' % len(self.files) )
+        return
+
+    ## end class ValidationCache()
+
+
+def file_sha256( file_path ):
+    """ Returns the file's sha256 hex-digest, read in 1MB chunks.
+        Called by ValidationCache and snapshots.SnapshotStore.take_snapshot() """
+    hasher = hashlib.sha256()
+    with open( file_path, 'rb' ) as f:
+        for chunk in iter( lambda: f.read(1024 * 1024), b'' ):
+            hasher.update( chunk )
+    return hasher.hexdigest()
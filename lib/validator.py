@@ -1,6 +1,9 @@
-import datetime, glob, logging, ntpath, os, pprint, shutil, sys
+import base64, concurrent.futures, datetime, glob, itertools, json, logging, ntpath, os, pprint, shutil, sys, time
 sys.path.append( os.path.abspath(os.getcwd()) )
+from lib.compression import compression_of, find_stored, logical_name, marc_file_paths, open_buffer, open_stream, write_marc_file
+from lib.marc_check import check_file_structure, salvage_buffer
 from lib.tracker import TrackerHelper
+from lib.validation_cache import ValidationCache
 from pymarc import MARCReader
 
 logging.basicConfig(
@@ -24,6 +27,12 @@ class FileChecker( object ):
     def __init__( self ):
         self.FILE_DOWNLOAD_DIR = os.environ['SBE__FILE_DOWNLOAD_DIR']
         self.TRACKER_JSON_PATH = os.environ['SBE__TRACKER_JSON_PATH']
+        self.validation_workers = int( os.environ.get('SBE__VALIDATION_WORKERS', '1') )
+        self.validation_mode = os.environ.get( 'SBE__VALIDATION_MODE', 'structural' )  # 'structural' (fast byte-level checks), or 'deep' (structural, then pymarc)
+        self.validation_cache = ValidationCache()
+        self.tracker_hashes = {}  # file_name -> tracker entry with `file_sha256`; see tracked_sha256()
+        self.salvage = json.loads( os.environ.get('SBE__VALIDATION_SALVAGE_JSON', 'false') )  # when true, good records are recovered from quarantined files
+        self.salvage_max_gap = int( os.environ.get('SBE__SALVAGE_MAX_GAP', '50') )  # a bad record with no readable bib-id is re-exported via the ids between its neighbors, if they're this close
         self.non_marc_indicators = [
             '"description": "happens when submitted bib-range is invalid"',
             'ErrorCode(',
@@ -33,42 +42,178 @@ class FileChecker( object ):
 
     def validate_marc_files( self ):
         """ Checks all the downloaded marc files, and changes the suffix for invalid ones.
+            Files already checked during download (see skip_inline_validated()), or unchanged since a previous run (see skip_cached()), aren't re-read.
+            With SBE__VALIDATION_WORKERS above 1, files are parsed across a process-pool; results come back in file-order,
+              so warnings and renames happen exactly as in the sequential run.
             Called by controller -> manage_download() """
-        marc_file_list = sorted( glob.glob('%s/*.mrc' % self.FILE_DOWNLOAD_DIR) )
+        tracker = tracker_helper.grab_tracker_file()
+        self.tracker_hashes = { entry['file_name']: entry for entry in tracker['batches'] if entry.get('file_sha256', None) }
+        marc_file_list = marc_file_paths( self.FILE_DOWNLOAD_DIR )  # plain or compressed
         # marc_file_list = sorted( glob.glob( '%s/*.*' % self.FILE_DOWNLOAD_DIR ) )
         log.debug( 'marc_file_list, ```%s```' % marc_file_list )
         start = datetime.datetime.now()
-        for file_path in marc_file_list:
-            size_in_bytes = os.path.getsize( file_path )
-            validity = self.open_and_check_file( file_path )
-            if validity == False and size_in_bytes > (1000 * 100):  # files over 100K will generate a log-warning
-                log.warning( 'bad file, ```%s``` is `%s` bytes' % (file_path, size_in_bytes) )
-        tracker = tracker_helper.grab_tracker_file()
+        ( marc_file_list, record_total ) = self.skip_inline_validated( marc_file_list, tracker )
+        ( marc_file_list, cached_total ) = self.skip_cached( marc_file_list )
+        record_total += cached_total
+        if self.validation_workers > 1:
+            with concurrent.futures.ProcessPoolExecutor( max_workers=self.validation_workers ) as executor:
+                for result in executor.map( check_marc_file, marc_file_list, itertools.repeat(self.validation_mode), itertools.repeat(self.hashing()), chunksize=8 ):  # yields in submission-order
+                    record_total += self.handle_check_result( result )
+        else:
+            for file_path in marc_file_list:
+                record_total += self.handle_check_result( check_marc_file(file_path, self.validation_mode, self.hashing()) )
+        self.validation_cache.save()
+        if self.salvage:
+            self.salvage_quarantined_files( tracker )
         tracker_helper.update_validation_status( tracker )
         time_taken = str( datetime.datetime.now() - start )
-        log.debug( 'time_taken, `%s`' % time_taken )
+        log.debug( 'time_taken, `%s`; files, `%s`; records, `%s`; workers, `%s`; mode, `%s`' % (
+            time_taken, len(marc_file_list), record_total, self.validation_workers, self.validation_mode) )
         return
 
-    def open_and_check_file( self, file_path ):
-        """ Opens suspicious file.
+    def skip_inline_validated( self, marc_file_list, tracker ):
+        """ Returns ( files still needing a check, record-count of the skipped ones ).
+            A file is skipped if the tracker shows it passed the structural check while downloading, and its size is unchanged since;
+              'deep' mode re-checks everything, since the download-check is structural only.
+            Called by validate_marc_files() """
+        if self.validation_mode == 'deep':
+            return ( marc_file_list, 0 )
+        checked = { entry['file_name']: entry for entry in tracker['batches'] if entry.get('records_valid', None) == True }
+        ( remaining, record_total ) = ( [], 0 )
+        for file_path in marc_file_list:
+            entry = checked.get( logical_name(os.path.basename(file_path)), None )
+            if entry and entry.get( 'file_bytes', None ) == os.path.getsize( file_path ):
+                record_total += entry['record_count']
+            else:
+                remaining.append( file_path )
+        log.debug( '`%s` files validated during download; `%s` to check' % (len(marc_file_list) - len(remaining), len(remaining)) )
+        return ( remaining, record_total )
+
+    def skip_cached( self, marc_file_list ):
+        """ Returns ( files still needing a check, record-count of the skipped ones ), skipping files the validation-cache shows unchanged since they passed.
             Called by validate_marc_files() """
-        validity = False
-        log.debug( 'file about to be checked, ```%s```' % file_path )
-        with open( file_path, 'rb' ) as fh:
-            reader = MARCReader( fh )
-            try:
-                for record in reader:
-                    pass
-                validity = True
-            except Exception as e:
-                log.error( 'exception, `%s`' % e )
-                file_name = os.path.basename( file_path )
-                new_file_name = file_name.replace( '.mrc', '.txt' )
-                new_file_path = '%s/%s' % ( self.FILE_DOWNLOAD_DIR, new_file_name)
-                log.debug( 'moving bad-file to new_file_path, ```%s```' % new_file_path )
-                shutil.move( file_path, new_file_path )
+        ( remaining, record_total ) = ( [], 0 )
+        for file_path in marc_file_list:
+            record_count = self.validation_cache.lookup( file_path, self.validation_mode )
+            if record_count is None:
+                remaining.append( file_path )
+            else:
+                record_total += record_count
+        log.debug( '`%s` files unchanged since validated; `%s` to check' % (len(marc_file_list) - len(remaining), len(remaining)) )
+        return ( remaining, record_total )
+
+    def hashing( self ):
+        """ Returns True if passing files should be hashed, ie only when the validation-cache is enabled to store the hash.
+            Called by validate_marc_files() and open_and_check_file() """
+        return bool( self.validation_cache.CACHE_FILEPATH )
+
+    def handle_check_result( self, result ):
+        """ Logs a file's check-result, caching a pass and moving an invalid file aside; returns its record-count.
+            Called by validate_marc_files() """
+        ( file_path, validity, record_count, seconds, error, sha256 ) = result
+        log.debug( 'checked ```%s```; valid, `%s`; records, `%s`; seconds, `%.3f`' % (file_path, validity, record_count, seconds) )
+        if validity == True:
+            self.validation_cache.remember( file_path, record_count, self.validation_mode, sha256 or self.tracked_sha256(file_path) )
+        if validity == False:
+            log.error( 'exception, `%s`' % error )
+            size_in_bytes = os.path.getsize( file_path )
+            self.validation_cache.forget( file_path )
+            self.quarantine_file( file_path )
+            if size_in_bytes > (1000 * 100):  # files over 100K will generate a log-warning
+                log.warning( 'bad file, ```%s``` is `%s` bytes' % (file_path, size_in_bytes) )
+        return record_count
+
+    def tracked_sha256( self, file_path ):
+        """ Returns the tracker's sha256 for the file if its size still matches the download, else None, as snapshots.py does.
+            Called by handle_check_result(), for files check_marc_file() didn't hash (compressed ones) """
+        entry = self.tracker_hashes.get( logical_name(os.path.basename(file_path)), {} )
+        return entry['file_sha256'] if entry.get( 'file_bytes', None ) == os.path.getsize( file_path ) else None
+
+    def open_and_check_file( self, file_path ):
+        """ Opens suspicious file, moving it aside if invalid.
+            For checking a single file; validate_marc_files() uses check_marc_file() directly. """
+        ( file_path, validity, record_count, seconds, error, sha256 ) = check_marc_file( file_path, self.validation_mode, self.hashing() )
+        if validity == False:
+            log.error( 'exception, `%s`' % error )
+            self.quarantine_file( file_path )
         return validity
 
+    def quarantine_file( self, file_path ):
+        """ Renames a bad .mrc file to .txt, so downstream *.mrc globs skip it.
+            Called by handle_check_result() and open_and_check_file() """
+        file_name = os.path.basename( file_path )
+        new_file_name = file_name.replace( '.mrc', '.txt' )
+        new_file_path = '%s/%s' % ( self.FILE_DOWNLOAD_DIR, new_file_name)
+        log.debug( 'moving bad-file to new_file_path, ```%s```' % new_file_path )
+        shutil.move( file_path, new_file_path )
+        return
+
+    def salvage_quarantined_files( self, tracker ):
+        """ Salvages each quarantined .txt file not already salvaged -- whether moved aside here or while downloading.
+            Called by validate_marc_files() """
+        for entry in list( tracker['batches'] ):
+            txt_path = find_stored( '%s/%s' % (self.FILE_DOWNLOAD_DIR, entry['file_name'].replace('.mrc', '.txt')) )
+            if 'salvage' not in entry and txt_path:
+                self.salvage_file( txt_path, entry['file_name'], tracker )
+        return
+
+    def salvage_file( self, txt_path, file_name, tracker ):
+        """ Writes the structurally good records of a quarantined file back to its .mrc, and the bad byte-spans to a `_quarantine.json` file.
+            The bib-ids of the bad records are queued in the tracker as a small re-export batch, instead of re-fetching the whole range.
+            Files that are structurally sound (eg a pymarc-only or record-count failure) stay quarantined, with no bad span to cut out,
+              and the batch's whole range is queued for re-export.
+            If any bad span can't be resolved to bib-ids -- no readable 907, and no good neighbors within `salvage_max_gap` -- the file stays quarantined
+              and the batch's whole range is queued for re-export instead, so those records aren't silently lost.
+            Called by salvage_quarantined_files() """
+        if os.path.getsize( txt_path ) == 0:
+            return
+        buffer = open_buffer( txt_path )
+        try:
+            result = salvage_buffer( buffer )
+            if not result['bad_spans']:
+                log.error( 'no structural damage found in ```%s```; leaving it quarantined, and re-exporting its whole range' % txt_path )
+                salvage = { 'records': 0, 'bad_spans': 0, 'unresolved_spans': 0, 'quarantine_file_name': None }
+                tracker_helper.record_salvage( tracker, file_name, salvage, [], whole_range=True )
+                return
+            ( reexport_ids, unresolved_spans ) = self.resolve_reexport_ids( result['bad_spans'] )
+            if unresolved_spans:
+                log.error( '`%s` bad spans in ```%s``` have no recoverable bib-ids; leaving it quarantined, and re-exporting its whole range' % (
+                    unresolved_spans, txt_path) )
+            elif result['record_count']:  # written back compressed as the quarantined file was
+                mrc_path = write_marc_file(
+                    logical_name( txt_path ).replace( '.txt', '.mrc' ), ( buffer[start:end] for (start, end) in result['good_spans'] ), compression_of( txt_path ) )
+                self.validation_cache.remember( mrc_path, result['record_count'], 'structural' )
+            for span in result['bad_spans']:
+                span['data_base64'] = base64.b64encode( buffer[span['offset']:span['offset'] + span['length']] ).decode( 'ascii' )
+        finally:
+            buffer.close()
+        quarantine_path = logical_name( txt_path ).replace( '.txt', '_quarantine.json' )
+        with open( quarantine_path, 'w' ) as f:
+            f.write( json.dumps({'source_file_name': os.path.basename(txt_path), 'bad_spans': result['bad_spans']}, sort_keys=True, indent=2) )
+        salvage = {
+            'records': 0 if unresolved_spans else result['record_count'], 'bad_spans': len(result['bad_spans']),
+            'unresolved_spans': unresolved_spans, 'quarantine_file_name': os.path.basename(quarantine_path) }
+        tracker_helper.record_salvage( tracker, file_name, salvage, reexport_ids, whole_range=bool(unresolved_spans) )
+        self.validation_cache.save()
+        log.info( 'salvaged ```%s```; ```%s```; `%s` bib-ids queued for re-export' % (txt_path, salvage, len(reexport_ids)) )
+        return
+
+    def resolve_reexport_ids( self, bad_spans ):
+        """ Returns ( sorted bib-ids to re-export, count of spans that couldn't be resolved to ids ).
+            A span's ids are its readable 907s; failing those, the ids between its good neighbors, if they're within `salvage_max_gap`.
+            Called by salvage_file() """
+        ( reexport_ids, unresolved_spans ) = ( set(), 0 )
+        for span in bad_spans:
+            reexport_ids.update( span['bib_ids'] )
+            if span['bib_ids']:
+                continue
+            ( previous_id, next_id ) = ( span['previous_bib_id'], span['next_bib_id'] )
+            if previous_id and next_id and 0 < ( next_id - previous_id ) <= self.salvage_max_gap:
+                reexport_ids.update( range(previous_id + 1, next_id) )
+            else:
+                unresolved_spans += 1
+        return ( sorted(reexport_ids), unresolved_spans )
+
     # def open_and_check_file( self, file_path ):
     #     """ Opens suspicious file.
     #         Called by validate_marc_files() """
@@ -86,6 +231,38 @@ class FileChecker( object ):
     ## end class FileChecker()
 
 
+def check_marc_file( file_path, mode='structural', with_sha256=False ):
+    """ Checks every record in the file; returns ( file_path, validity, record_count, seconds, error, sha256 ).
+          If `with_sha256`, sha256 is taken in the structural pass (None for compressed files, or on error), so caching a pass doesn't re-read the file.
+        'structural' walks leaders, directories, and terminators over an mmap, without building pymarc objects;
+          'deep' also parses each record with pymarc, for files that pass the structural check.
+        Module-level so process-pool workers can run it.
+        Called by FileChecker.validate_marc_files() and FileChecker.open_and_check_file() """
+    start = time.time()
+    try:
+        structure = check_file_structure( file_path, with_sha256=with_sha256 )
+    except Exception as e:
+        return ( file_path, False, 0, time.time() - start, repr(e), None )
+    if not structure['valid']:
+        error = 'structural error after `%s` good records, at byte-offset `%s`: %s' % (
+            structure['record_count'], structure['first_bad_offset'], structure['error'] )
+        return ( file_path, False, structure['record_count'], time.time() - start, error, None )
+    if mode != 'deep':
+        return ( file_path, True, structure['record_count'], time.time() - start, None, structure.get('sha256', None) )
+    ( validity, record_count, error ) = ( False, 0, None )
+    with open_stream( file_path ) as fh:
+        reader = MARCReader( fh )
+        try:
+            for record in reader:
+                if record is None:  # newer pymarc versions yield None for a bad record instead of raising
+                    raise Exception( 'unreadable record after `%s` good ones, ```%r```' % (record_count, getattr(reader, 'current_exception', None)) )
+                record_count += 1
+            validity = True
+        except Exception as e:
+            error = repr( e )
+    return ( file_path, validity, record_count, time.time() - start, error, structure.get('sha256', None) )
+
+
 if __name__ == '__main__':
     log.debug( 'starting' )
     checker = FileChecker()
@@ -0,0 +1,75 @@
+import os, sys, tempfile, unittest
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib.bib_index import BibIndex, build_index
+
+
+def make_record( bib_number, title=b'a title' ):
+    """ Returns an iso-2709 record with a 245 and sierra-style 907. """
+    ( directory, data ) = ( b'', b'' )
+    for ( tag, content ) in ( (b'245', b'10\x1fa' + title), (b'907', b'  \x1fa.b%07dx' % bib_number) ):
+        content += b'\x1e'
+        directory += tag + b'%04d%05d' % ( len(content), len(data) )
+        data += content
+    base_address = 24 + len( directory ) + 1
+    leader = b'%05dnam a22%05d   4500' % ( base_address + len(data) + 1, base_address )
+    return leader + directory + b'\x1e' + data + b'\x1d'
+
+
+class BibIndexTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.records = {}
+        file_paths = []
+        for ( file_number, ( bib_numbers, title ) ) in enumerate( (([1000005, 1000001], b'first'), ([1000003, 1000001], b'reexported')) ):
+            file_path = os.path.join( self.temp_dir.name, 'sierra_export_%04d.mrc' % file_number )
+            with open( file_path, 'wb' ) as f:
+                for bib_number in bib_numbers:
+                    self.records[bib_number] = make_record( bib_number, title )
+                    f.write( self.records[bib_number] )
+            file_paths.append( file_path )
+        self.index_path = os.path.join( self.temp_dir.name, 'bib_index.bin' )
+        self.record_count = build_index( file_paths, self.index_path )
+        self.index = BibIndex( self.index_path )
+
+    def tearDown( self ):
+        self.index.close()
+        self.temp_dir.cleanup()
+
+    def test_every_record_indexed( self ):
+        self.assertEqual( 4, self.record_count )
+
+    def test_lookup_by_number_and_bib_id( self ):
+        self.assertEqual( self.records[1000005], self.index.get_record(1000005) )
+        self.assertEqual( self.records[1000003], self.index.get_record('.b1000003x') )
+
+    def test_later_file_wins_for_a_repeated_bib( self ):
+        ( file_path, offset, length ) = self.index.locate( 1000001 )
+        self.assertTrue( file_path.endswith('sierra_export_0001.mrc') )
+        self.assertIn( b'reexported', self.index.get_record(1000001) )
+
+    def test_missing_bib( self ):
+        self.assertIsNone( self.index.get_record(1000002) )
+        self.assertIsNone( self.index.get_record(999999) )
+        self.assertIsNone( self.index.get_record('not-a-bib') )
+
+    def test_get_records_in_bib_order( self ):
+        found = list( self.index.get_records(['b1000005', 1000002, 1000003]) )
+        self.assertEqual( [1000002, 1000003, 'b1000005'], [ bib_id for ( bib_id, record ) in found ] )
+        self.assertIsNone( found[0][1] )
+
+
+class EmptyIndexTest( unittest.TestCase ):
+
+    def test_empty_index_finds_nothing( self ):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join( temp_dir, 'bib_index.bin' )
+            self.assertEqual( 0, build_index([], index_path) )
+            index = BibIndex( index_path )
+            self.assertIsNone( index.get_record(1000001) )
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import json, os, sys, tempfile, unittest
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib.compression import BLOCKS_SUFFIX, BlockBuffer, StreamCompressor, logical_name, open_buffer, stored_name, write_block_table
+
+
+class BlockBufferTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.content = bytes( range(256) ) * 40  # 10240 bytes
+        self.file_path = os.path.join( self.temp_dir.name, 'sierra_shard_0001.mrc.gz' )
+        compressor = StreamCompressor( 'gzip', block_bytes=1000 )
+        with open( self.file_path, 'wb' ) as f:
+            for position in range( 0, len(self.content), 333 ):  # writes that don't line up with blocks
+                f.write( compressor.compress(self.content[position:position + 333]) )
+            f.write( compressor.flush() )
+        write_block_table( self.file_path, compressor )
+
+    def tearDown( self ):
+        self.temp_dir.cleanup()
+
+    def open( self, cached_blocks=4 ):
+        with open( self.file_path + BLOCKS_SUFFIX, 'r' ) as f:
+            return BlockBuffer( self.file_path, json.loads(f.read()), cached_blocks )
+
+    def test_block_table_starts_a_block_every_block_bytes( self ):
+        buffer = self.open()
+        self.assertEqual( list(range(0, len(self.content), 1000)), buffer.uncompressed_starts )
+        buffer.close()
+
+    def test_open_buffer_uses_the_block_table( self ):
+        buffer = open_buffer( self.file_path )
+        self.assertIsInstance( buffer, BlockBuffer )
+        self.assertEqual( len(self.content), len(buffer) )
+        buffer.close()
+
+    def test_indexing_and_slicing_match_the_content( self ):
+        buffer = self.open( cached_blocks=2 )
+        for key in ( 0, 999, 1000, 5555, len(self.content) - 1, -1 ):
+            self.assertEqual( self.content[key], buffer[key] )
+        for ( start, stop ) in ( (0, 10), (990, 1010), (500, 3500), (10000, 20000) ):
+            self.assertEqual( self.content[start:stop], buffer[start:stop] )
+        buffer.close()
+
+    def test_cache_is_bounded( self ):
+        buffer = self.open( cached_blocks=2 )
+        buffer[0:len(self.content)]
+        self.assertEqual( 2, len(buffer.cache) )
+        buffer.close()
+
+    def test_out_of_range_index_raises( self ):
+        buffer = self.open()
+        with self.assertRaises( IndexError ):
+            buffer[len(self.content)]
+        buffer.close()
+
+
+class NamingTest( unittest.TestCase ):
+
+    def test_stored_and_logical_names_round_trip( self ):
+        self.assertEqual( 'sierra_export_0001.mrc.gz', stored_name('sierra_export_0001.mrc', 'gzip') )
+        self.assertEqual( 'sierra_export_0001.mrc', stored_name('sierra_export_0001.mrc', None) )
+        self.assertEqual( 'sierra_export_0001.mrc', logical_name('sierra_export_0001.mrc.gz') )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os, sys, tempfile, unittest
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib.content_manifest import build_manifest, diff_manifests, parse_ignore_tags
+
+
+def make_record( bib_number, title=b'a title', stamp=b'20260101000000.0' ):
+    """ Returns an iso-2709 record with a 005, 245, and sierra-style 907. """
+    ( directory, data ) = ( b'', b'' )
+    for ( tag, content ) in ( (b'005', stamp), (b'245', b'10\x1fa' + title), (b'907', b'  \x1fa.b%07dx' % bib_number) ):
+        content += b'\x1e'
+        directory += tag + b'%04d%05d' % ( len(content), len(data) )
+        data += content
+    base_address = 24 + len( directory ) + 1
+    leader = b'%05dnam a22%05d   4500' % ( base_address + len(data) + 1, base_address )
+    return leader + directory + b'\x1e' + data + b'\x1d'
+
+
+class DiffManifestsTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown( self ):
+        self.temp_dir.cleanup()
+
+    def build( self, name, records, ignore_tags=frozenset() ):
+        os.makedirs( os.path.join(self.temp_dir.name, name) )
+        file_path = os.path.join( self.temp_dir.name, name, 'sierra_export_0001.mrc' )
+        with open( file_path, 'wb' ) as f:
+            f.write( b''.join(records) )
+        manifest_path = os.path.join( self.temp_dir.name, name, 'manifest.tsv' )
+        build_manifest( [file_path], manifest_path, ignore_tags )
+        return manifest_path
+
+    def diff( self, old_manifest_path, new_manifest_path ):
+        output_dir = os.path.join( self.temp_dir.name, 'diff' )
+        os.makedirs( output_dir, exist_ok=True )
+        counts = diff_manifests( old_manifest_path, new_manifest_path, output_dir )
+        outcomes = {}
+        for name in ( 'added', 'changed', 'deleted' ):
+            with open( os.path.join(output_dir, '%s.txt' % name), 'r' ) as f:
+                outcomes[name] = [ int(line) for line in f.read().split() ]
+        with open( os.path.join(output_dir, 'updates.mrc'), 'rb' ) as f:
+            outcomes['updates'] = f.read()
+        return ( counts, outcomes )
+
+    def test_added_changed_and_deleted( self ):
+        old_manifest_path = self.build( 'old', [make_record(1000001), make_record(1000002), make_record(1000003)] )
+        new_records = [ make_record(1000001), make_record(1000003, title=b'a new title'), make_record(1000004) ]
+        new_manifest_path = self.build( 'new', new_records )
+        ( counts, outcomes ) = self.diff( old_manifest_path, new_manifest_path )
+        self.assertEqual( {'added': 1, 'changed': 1, 'deleted': 1, 'unchanged': 1}, counts )
+        self.assertEqual( ( [1000004], [1000003], [1000002] ), ( outcomes['added'], outcomes['changed'], outcomes['deleted'] ) )
+        self.assertEqual( new_records[1] + new_records[2], outcomes['updates'] )
+
+    def test_ignored_tags_do_not_count_as_changes( self ):
+        ignore_tags = parse_ignore_tags( '005, 998' )
+        old_manifest_path = self.build( 'old', [make_record(1000001)], ignore_tags )
+        new_manifest_path = self.build( 'new', [make_record(1000001, stamp=b'20260701120000.0')], ignore_tags )
+        ( counts, outcomes ) = self.diff( old_manifest_path, new_manifest_path )
+        self.assertEqual( 1, counts['unchanged'] )
+        self.assertEqual( b'', outcomes['updates'] )
+
+    def test_later_file_wins_for_a_repeated_bib( self ):
+        os.makedirs( os.path.join(self.temp_dir.name, 'reexport') )
+        file_paths = [ os.path.join(self.temp_dir.name, 'reexport', name) for name in ('sierra_export_0001.mrc', 'sierra_export_0001_reexport.mrc') ]
+        for ( file_path, title ) in zip( file_paths, (b'damaged', b're-exported') ):
+            with open( file_path, 'wb' ) as f:
+                f.write( make_record(1000001, title=title) )
+        manifest_path = os.path.join( self.temp_dir.name, 'reexport', 'manifest.tsv' )
+        self.assertEqual( 1, build_manifest(file_paths, manifest_path) )
+        with open( manifest_path, 'r' ) as f:
+            self.assertIn( 'sierra_export_0001_reexport.mrc', f.read() )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os, sys, tempfile, unittest
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib.marc_check import MarcStreamChecker, check_file_structure, salvage_buffer
+
+
+def make_record( bib_number, title=b'a title' ):
+    """ Returns an iso-2709 record with a 001, 245, and sierra-style 907. """
+    ( directory, data ) = ( b'', b'' )
+    for ( tag, content ) in ( (b'001', b'ocm%08d' % bib_number), (b'245', b'10\x1fa' + title), (b'907', b'  \x1fa.b%07dx' % bib_number) ):
+        content += b'\x1e'
+        directory += tag + b'%04d%05d' % ( len(content), len(data) )
+        data += content
+    base_address = 24 + len( directory ) + 1
+    leader = b'%05dnam a22%05d   4500' % ( base_address + len(data) + 1, base_address )
+    return leader + directory + b'\x1e' + data + b'\x1d'
+
+
+class CheckFileStructureTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown( self ):
+        self.temp_dir.cleanup()
+
+    def write( self, content ):
+        file_path = os.path.join( self.temp_dir.name, 'sierra_export_0001.mrc' )
+        with open( file_path, 'wb' ) as f:
+            f.write( content )
+        return file_path
+
+    def test_valid_file_counts_records_and_collects_bib_ids( self ):
+        structure = check_file_structure( self.write(make_record(1000001) + make_record(1000002)), collect_bib_ids=True )
+        self.assertTrue( structure['valid'] )
+        self.assertEqual( 2, structure['record_count'] )
+        self.assertEqual( ['b1000001x', 'b1000002x'], structure['bib_ids'] )
+
+    def test_sha256_only_when_requested( self ):
+        file_path = self.write( make_record(1000001) )
+        self.assertNotIn( 'sha256', check_file_structure(file_path) )
+        self.assertEqual( 64, len(check_file_structure(file_path, with_sha256=True)['sha256']) )
+
+    def test_truncated_record_reports_its_offset( self ):
+        first = make_record( 1000001 )
+        structure = check_file_structure( self.write(first + make_record(1000002)[:-10]) )
+        self.assertFalse( structure['valid'] )
+        self.assertEqual( 1, structure['record_count'] )
+        self.assertEqual( len(first), structure['first_bad_offset'] )
+
+    def test_missing_record_terminator( self ):
+        structure = check_file_structure( self.write(make_record(1000001)[:-1] + b'x') )
+        self.assertEqual( 'missing record terminator', structure['error'] )
+
+    def test_empty_file_is_valid( self ):
+        structure = check_file_structure( self.write(b'') )
+        self.assertTrue( structure['valid'] )
+        self.assertEqual( 0, structure['record_count'] )
+
+
+class SalvageBufferTest( unittest.TestCase ):
+
+    def test_resynchronizes_after_bad_record( self ):
+        ( first, bad, last ) = ( make_record(1000001), bytearray(make_record(1000002)), make_record(1000003) )
+        bad[-1:] = b'x'  # no record terminator
+        salvage = salvage_buffer( first + bytes(bad) + last )
+        self.assertEqual( 2, salvage['record_count'] )
+        self.assertEqual( 1, len(salvage['bad_spans']) )
+        span = salvage['bad_spans'][0]
+        self.assertEqual( ( len(first), len(bad) ), ( span['offset'], span['length'] ) )
+        self.assertEqual( [1000002], span['bib_ids'] )
+        self.assertEqual( ( 1000001, 1000003 ), ( span['previous_bib_id'], span['next_bib_id'] ) )
+
+
+class MarcStreamCheckerTest( unittest.TestCase ):
+
+    def test_records_split_across_chunks( self ):
+        content = make_record( 1000001 ) + make_record( 1000002 )
+        checker = MarcStreamChecker( collect_bib_ids=True )
+        for position in range( 0, len(content), 7 ):
+            checker.feed( content[position:position + 7] )
+        structure = checker.finish()
+        self.assertTrue( structure['valid'] )
+        self.assertEqual( 2, structure['record_count'] )
+
+    def test_trailing_bytes_are_invalid( self ):
+        checker = MarcStreamChecker()
+        checker.feed( make_record(1000001) + b'00042' )
+        self.assertFalse( checker.finish()['valid'] )
+
+
+if __name__ == '__main__':
+    unittest.main()
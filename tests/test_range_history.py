@@ -0,0 +1,74 @@
+import os, sys, tempfile, unittest
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+os.environ.pop( 'SBE__RANGE_HISTORY_JSON_PATH', None )
+from lib.range_history import RangeHistory
+
+
+class FakeResponse( object ):
+
+    def __init__( self, status_code, entries=None ):
+        ( self.status_code, self.entries ) = ( status_code, entries or [] )
+
+    def json( self ):
+        return { 'entries': self.entries }
+
+
+class FakeTokenManager( object ):
+
+    def __init__( self, responses ):
+        self.responses = list( responses )
+
+    def authorized_get( self, url, endpoint=None, params=None ):
+        return self.responses.pop( 0 )
+
+
+class UpdateFromDeletedQueryTest( unittest.TestCase ):
+
+    def make_history( self, ranges ):
+        history = RangeHistory()
+        history.ranges = ranges
+        return history
+
+    def test_older_deletions_do_not_kill_newly_observed_range( self ):
+        """ Deletions dated before a range's observation were already excluded from its output_records. """
+        history = self.make_history( {
+            '1000000': { 'end': 1002000, 'output_records': 2, 'observed': '2026-01-01T08:00:00' },
+            '1002000': { 'end': 1004000, 'output_records': 2, 'observed': '2026-06-01T08:00:00' } } )
+        deletions = [ {'id': '1002005', 'deletedDate': '2026-02-01'}, {'id': '1002006', 'deletedDate': '2026-03-01'} ]
+        history.update_from_deleted_query( FakeTokenManager([FakeResponse(200, deletions)]), 'http://x/' )
+        self.assertEqual( 2, history.ranges['1002000']['output_records'] )
+
+    def test_deletions_after_observation_kill_range( self ):
+        history = self.make_history( {
+            '1002000': { 'end': 1004000, 'output_records': 2, 'observed': '2026-06-01T08:00:00' } } )
+        deletions = [ {'id': '1002005', 'deletedDate': '2026-07-01'}, {'id': '1002006', 'deletedDate': '2026-07-02'} ]
+        history.update_from_deleted_query( FakeTokenManager([FakeResponse(200, deletions)]), 'http://x/' )
+        self.assertEqual( 0, history.ranges['1002000']['output_records'] )
+
+    def test_boundary_deletion_counts_once( self ):
+        """ Adjacent ranges share their boundary bib; it belongs to the range starting there. """
+        history = self.make_history( {
+            '1000000': { 'end': 1002000, 'output_records': 1, 'observed': '2026-01-01T08:00:00' },
+            '1002000': { 'end': 1004000, 'output_records': 2, 'observed': '2026-01-01T08:00:00' } } )
+        deletions = [ {'id': '1002000', 'deletedDate': '2026-07-01'} ]
+        history.update_from_deleted_query( FakeTokenManager([FakeResponse(200, deletions)]), 'http://x/' )
+        self.assertEqual( 1, history.ranges['1000000']['output_records'] )
+        self.assertEqual( 2, history.ranges['1002000']['output_records'] )
+
+    def test_bad_status_raises_without_updating( self ):
+        history = self.make_history( {
+            '1002000': { 'end': 1004000, 'output_records': 1, 'observed': '2026-06-01T08:00:00' } } )
+        with self.assertRaises( Exception ):
+            history.update_from_deleted_query( FakeTokenManager([FakeResponse(500)]), 'http://x/' )
+        self.assertEqual( 1, history.ranges['1002000']['output_records'] )
+
+    def test_not_found_is_an_empty_result( self ):
+        history = self.make_history( {
+            '1002000': { 'end': 1004000, 'output_records': 1, 'observed': '2026-06-01T08:00:00' } } )
+        history.update_from_deleted_query( FakeTokenManager([FakeResponse(404)]), 'http://x/' )
+        self.assertEqual( 1, history.ranges['1002000']['output_records'] )
+
+
+if __name__ == '__main__':
+    unittest.main()
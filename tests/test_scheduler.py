@@ -0,0 +1,94 @@
+import os, sys, tempfile, unittest
+from unittest import mock
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib import scheduler
+from lib.scheduler import RateLimitScheduler
+
+
+class FakeClock( object ):
+    """ Stands in for the scheduler module's `time`; sleeping just advances the clock. """
+
+    def __init__( self ):
+        ( self.now, self.sleeps ) = ( 1000.0, [] )
+
+    def time( self ):
+        return self.now
+
+    def sleep( self, seconds ):
+        self.sleeps.append( seconds )
+        self.now += seconds
+
+
+class FakeResponse( object ):
+
+    def __init__( self, headers=None, payload=None, text='' ):
+        ( self.headers, self.payload, self.text ) = ( headers or {}, payload, text )
+
+    def json( self ):
+        if self.payload is None:
+            raise ValueError( 'no json' )
+        return self.payload
+
+
+class TokenBucketTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.clock = FakeClock()
+        patcher = mock.patch.object( scheduler, 'time', self.clock )
+        patcher.start()
+        self.addCleanup( patcher.stop )
+        self.scheduler = RateLimitScheduler()
+
+    def test_no_pacing_until_rate_limited( self ):
+        for _ in range( 50 ):
+            self.scheduler.acquire()
+        self.assertEqual( [], self.clock.sleeps )
+        self.assertIsNone( self.scheduler.capacity )
+
+    def test_learns_budget_from_rate_limit( self ):
+        for _ in range( 11 ):  # the 11th call is the one rejected
+            self.scheduler.acquire()
+        self.clock.now += 40
+        self.scheduler.record_rate_limited( 60 )
+        self.assertEqual( 10, self.scheduler.capacity )
+        self.assertAlmostEqual( 10 / 100.0, self.scheduler.refill_per_second )
+
+    def test_nothing_refills_during_the_wait( self ):
+        self.scheduler.acquire()
+        self.scheduler.acquire()
+        self.scheduler.record_rate_limited( 60 )  # capacity 1, over a 60-second window
+        self.scheduler.acquire()
+        self.assertEqual( 1, len(self.clock.sleeps) )
+        self.assertAlmostEqual( 60 + 60, self.clock.sleeps[0] )  # the rest of the wait, then a token's refill
+
+    def test_refill_is_capped_at_capacity( self ):
+        for _ in range( 4 ):
+            self.scheduler.acquire()
+        self.scheduler.record_rate_limited( 30 )
+        self.clock.now += 10000
+        for _ in range( 3 ):
+            self.scheduler.acquire()
+        self.assertEqual( [], self.clock.sleeps )
+        self.scheduler.acquire()
+        self.assertEqual( 1, len(self.clock.sleeps) )
+
+
+class ParseWaitSecondsTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.scheduler = RateLimitScheduler()
+
+    def test_retry_after_header( self ):
+        self.assertEqual( 42, self.scheduler.parse_wait_seconds(FakeResponse(headers={'Retry-After': '42'})) )
+
+    def test_minutes_in_message( self ):
+        response = FakeResponse( payload={'description': 'Rate exceeded for endpoint; try again in 1.5 minutes'} )
+        self.assertEqual( 90, self.scheduler.parse_wait_seconds(response) )
+
+    def test_default_without_estimate( self ):
+        self.assertEqual( self.scheduler.default_wait_seconds, self.scheduler.parse_wait_seconds(FakeResponse(text='Rate exceeded')) )
+
+
+if __name__ == '__main__':
+    unittest.main()
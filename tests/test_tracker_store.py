@@ -0,0 +1,70 @@
+import os, sys, tempfile, unittest
+from unittest import mock
+sys.path.append( os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+os.environ.setdefault( 'SBE__LOG_PATH', os.path.join(tempfile.gettempdir(), 'sbe_tests.log') )
+from lib import tracker_store
+from lib.tracker_store import TrackerStore
+
+
+def make_batch( number, last_grabbed=None ):
+    return {
+        'chunk_start_bib': 1000000 + number * 2000, 'chunk_end_bib': 1002000 + number * 2000,
+        'file_name': 'sierra_export_%04d.mrc' % number, 'last_grabbed': last_grabbed }
+
+
+class TrackerStoreTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join( self.temp_dir.name, 'tracker.db' )
+        self.store = TrackerStore( self.db_path, shared=True )
+        self.store.save( {'last_bib': 1010000, 'batches': [make_batch(number) for number in range(3)]} )
+
+    def tearDown( self ):
+        self.store.connection.close()
+        self.temp_dir.cleanup()
+
+    def test_claims_go_to_different_workers_in_order( self ):
+        other_store = TrackerStore( self.db_path, shared=True )
+        claimed = [ self.store.claim_batch('a', 900)['file_name'], other_store.claim_batch('b', 900)['file_name'] ]
+        other_store.connection.close()
+        self.assertEqual( ['sierra_export_0000.mrc', 'sierra_export_0001.mrc'], claimed )
+
+    def test_grabbed_batches_are_not_claimed( self ):
+        self.store.save( {'last_bib': 1010000}, batches=[make_batch(0, last_grabbed='2026-01-01T00:00:00')] )
+        self.assertEqual( 'sierra_export_0001.mrc', self.store.claim_batch('a', 900)['file_name'] )
+
+    def test_nothing_left_to_claim( self ):
+        for worker_id in ( 'a', 'b', 'c' ):
+            self.store.claim_batch( worker_id, 900 )
+        self.assertIsNone( self.store.claim_batch('d', 900) )
+
+    def test_expired_lease_is_reclaimed( self ):
+        now = tracker_store.time.time()
+        self.store.claim_batch( 'a', 60 )
+        with mock.patch.object( tracker_store.time, 'time', return_value=now + 61 ):
+            self.assertEqual( 'sierra_export_0000.mrc', self.store.claim_batch('b', 60)['file_name'] )
+
+    def test_release_only_by_the_owner( self ):
+        self.store.claim_batch( 'a', 900 )
+        self.store.release_batch( 'sierra_export_0000.mrc', 'b' )
+        self.assertEqual( 'sierra_export_0001.mrc', self.store.claim_batch('b', 900)['file_name'] )
+        self.store.release_batch( 'sierra_export_0000.mrc', 'a' )
+        self.assertEqual( 'sierra_export_0000.mrc', self.store.claim_batch('c', 900)['file_name'] )
+
+    def test_saving_a_batch_clears_its_lease( self ):
+        batch = self.store.claim_batch( 'a', 900 )
+        self.store.save( {'last_bib': 1010000}, batches=[batch] )
+        self.assertEqual( 'sierra_export_0000.mrc', self.store.claim_batch('b', 900)['file_name'] )
+
+    def test_create_if_missing_only_once( self ):
+        self.store.clear()
+        other_store = TrackerStore( self.db_path, shared=True )
+        created = [ store.create_if_missing({'last_bib': None, 'batches': []}) for store in (self.store, other_store) ]
+        other_store.connection.close()
+        self.assertEqual( [True, False], created )
+        self.assertEqual( 0, self.store.batch_count() )
+
+
+if __name__ == '__main__':
+    unittest.main()